@@ -0,0 +1,94 @@
+"""
+Benchmark: vectorized query engine vs the equivalent SQL GROUP BY
+
+Usage:
+    DATABASE_URL=sqlite+aiosqlite:///./bench.db python -m benchmarks.bench_query_engine --events 200000
+    DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_query_engine
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+from benchmarks.bench_summary import seed, measure
+from database import engine, async_session_maker, create_db_and_tables, DatabaseOperation
+from models import AnalyticsQuery, Event
+from segments import SegmentStore
+
+QUERIES = {
+    "events_by_name": AnalyticsQuery(group_by=["event_name"], metrics=["count", "unique_users"]),
+    "hourly_by_project": AnalyticsQuery(group_by=["project_id"], metrics=["count", "unique_sessions"], grain="hour"),
+    "week_filtered": AnalyticsQuery(
+        start_date=datetime.utcnow() - timedelta(days=7), project_id=1,
+        filters={"event_name": ["event_1", "event_2"]}, metrics=["count", "unique_users"]
+    ),
+}
+
+
+def sql_for(query: AnalyticsQuery, dialect: str):
+    """The hand-written SQLAlchemy query the spec replaces"""
+    columns, filters = [], []
+    if query.grain:
+        if dialect == "postgresql":
+            columns.append(func.date_trunc(query.grain, Event.timestamp))
+        else:
+            formats = {"minute": "%Y-%m-%d %H:%M:00", "hour": "%Y-%m-%d %H:00:00", "day": "%Y-%m-%d 00:00:00"}
+            columns.append(func.strftime(formats[query.grain], Event.timestamp))
+    columns += [getattr(Event, name) for name in query.group_by]
+    metrics = {
+        "count": func.count(Event.id),
+        "unique_users": func.count(func.distinct(Event.user_id)),
+        "unique_sessions": func.count(func.distinct(Event.session_id)),
+    }
+    if query.start_date is not None:
+        filters.append(Event.timestamp >= query.start_date)
+    if query.end_date is not None:
+        filters.append(Event.timestamp <= query.end_date)
+    if query.project_id is not None:
+        filters.append(Event.project_id == query.project_id)
+    for name, values in query.filters.items():
+        filters.append(getattr(Event, name).in_(values))
+    statement = select(*columns, *(metrics[name] for name in query.metrics)).where(*filters)
+    if columns:
+        statement = statement.group_by(*columns)
+    return statement.order_by(metrics[query.metrics[0]].desc()).limit(query.limit)
+
+
+async def main(events: int, repeat: int):
+    engine.echo = False
+    await create_db_and_tables()
+    await seed(events)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SegmentStore(directory)
+        async with async_session_maker() as session:
+            await DatabaseOperation(session, store).compact_segments()
+
+        for name, query in QUERIES.items():
+            async def sql(db_ops, query=query):
+                result = await db_ops.session.execute(sql_for(query, engine.dialect.name))
+                return result.all()
+
+            cases = [
+                ("sql", sql, None),
+                ("engine_sql_batches", lambda db_ops, query=query: db_ops.run_query(query), None),
+                ("engine_segments", lambda db_ops, query=query: db_ops.run_query(query), store),
+            ]
+            for case, call, segments in cases:
+                result = await measure(f"{name}:{case}", call, repeat, segments)
+                result["events"] = events
+                result["dialect"] = engine.dialect.name
+                print(json.dumps(result))
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200000, help="Number of events to seed")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per case")
+    args = parser.parse_args()
+    asyncio.run(main(args.events, args.repeat))
@@ -0,0 +1,111 @@
+"""
+Benchmark: analytics summary as five sequential scans vs get_summary,
+and exact reads from SQL vs columnar segments
+
+Usage:
+    DATABASE_URL=sqlite+aiosqlite:///./bench.db python -m benchmarks.bench_summary --events 200000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+from database import engine, async_session_maker, create_db_and_tables, DatabaseOperation
+from models import Event
+from segments import SegmentStore
+
+
+async def seed(events: int, chunk_size: int = 5000):
+    """Load synthetic events unless the table already holds enough"""
+    async with async_session_maker() as session:
+        existing = (await session.execute(select(func.count(Event.id)))).scalar()
+    if existing >= events:
+        return
+
+    rng = random.Random(42)
+    start = datetime.utcnow() - timedelta(days=30)
+    for offset in range(existing, events, chunk_size):
+        batch = [
+            {
+                "event_name": f"event_{min(int(rng.paretovariate(1.2)), 50)}",
+                "user_id": f"user{rng.randrange(events // 20 or 1)}",
+                "session_id": f"session{rng.randrange(events // 5 or 1)}",
+                "project_id": rng.randrange(1, 4),
+                "timestamp": start + timedelta(seconds=rng.randrange(30 * 86400)),
+            }
+            for _ in range(min(chunk_size, events - offset))
+        ]
+        async with async_session_maker() as session:
+            await DatabaseOperation(session).create_events(batch)
+
+
+async def sequential_summary(db_ops: DatabaseOperation):
+    """The summary as computed before get_summary: one query after another"""
+    await db_ops.get_event_count()
+    await db_ops.get_unique_users_count()
+    await db_ops.get_unique_sessions_count()
+    await db_ops.get_data_range()
+    await db_ops.get_events_by_type()
+
+
+async def measure(name: str, call, repeat: int, segments=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        async with async_session_maker() as session:
+            db_ops = DatabaseOperation(session, segments)
+            started = time.perf_counter()
+            await call(db_ops)
+            timings.append((time.perf_counter() - started) * 1000)
+    return {
+        "benchmark": name,
+        "runs": repeat,
+        "p50_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "max_ms": round(max(timings), 3),
+    }
+
+
+async def main(events: int, repeat: int):
+    engine.echo = False
+    await create_db_and_tables()
+    await seed(events)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SegmentStore(directory)
+        async with async_session_maker() as session:
+            started = time.perf_counter()
+            compacted = await DatabaseOperation(session, store).compact_segments()
+        print(json.dumps({"benchmark": "compact_segments", "segments": len(compacted),
+                          "ms": round((time.perf_counter() - started) * 1000, 3)}))
+
+        cases = [
+            ("sequential_scans", sequential_summary, None),
+            ("get_summary_exact", lambda db_ops: db_ops.get_summary(exact=True), None),
+            ("get_summary_exact_segments", lambda db_ops: db_ops.get_summary(exact=True), store),
+            ("get_summary_approx", lambda db_ops: db_ops.get_summary(), None),
+            ("get_summary_project_week", lambda db_ops: db_ops.get_summary(
+                start_date=datetime.utcnow() - timedelta(days=7), project_id=1), None),
+            ("get_top_events_exact", lambda db_ops: db_ops.get_top_events(exact=True), None),
+            ("get_top_events_exact_segments", lambda db_ops: db_ops.get_top_events(exact=True), store),
+        ]
+        for name, call, segments in cases:
+            result = await measure(name, call, repeat, segments)
+            result["events"] = events
+            result["dialect"] = engine.dialect.name
+            print(json.dumps(result))
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200000, help="Number of events to seed")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per case")
+    args = parser.parse_args()
+    asyncio.run(main(args.events, args.repeat))
@@ -0,0 +1,119 @@
+"""
+Synthetic event generator: Zipfian event names and users, diurnal timestamps
+
+Usage:
+    DATABASE_URL=sqlite+aiosqlite:///./bench.db python -m benchmarks.generator --events 1000000
+    DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.generator --events 5000000 --days 60
+"""
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+# relative traffic per UTC hour: a sine wave from 20% at 03:00 up to the 15:00 peak
+HOURLY_WEIGHTS = [1 + 0.8 * math.sin((hour - 9) * math.pi / 12) for hour in range(24)]
+
+
+class ZipfSampler:
+    """Ranks 1..n drawn with probability proportional to 1 / rank**exponent"""
+
+    def __init__(self, n: int, exponent: float, rng: random.Random):
+        self.rng = rng
+        self.cumulative = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+    def sample(self) -> int:
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1]) + 1
+
+
+class EventGenerator:
+    """
+    Reproducible stream of event dicts shaped like POST /events/ payloads.
+
+    Event names and users follow Zipf laws, so a few names and heavy users
+    dominate like in real traffic; timestamps spread over days with a
+    diurnal cycle, and a user's events in the same 30-minute slot share a
+    session id.
+    """
+
+    def __init__(self, seed: int = 42, days: int = 30, event_names: int = 50, users: int = 100000,
+                 projects: int = 3, name_exponent: float = 1.2, user_exponent: float = 1.0,
+                 end: Optional[datetime] = None):
+        self.rng = random.Random(seed)
+        self.days = days
+        self.projects = projects
+        self.end = (end or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+        self.start = self.end - timedelta(days=days)
+        self.names = ZipfSampler(event_names, name_exponent, self.rng)
+        self.users = ZipfSampler(users, user_exponent, self.rng)
+        self.hours = list(itertools.accumulate(HOURLY_WEIGHTS))
+
+    def timestamp(self) -> datetime:
+        day = self.start + timedelta(days=self.rng.randrange(self.days))
+        hour = bisect.bisect_left(self.hours, self.rng.random() * self.hours[-1])
+        return day + timedelta(hours=hour, seconds=self.rng.randrange(3600))
+
+    def event(self, timestamp: Optional[datetime] = None) -> dict:
+        user = self.users.sample()
+        timestamp = timestamp or self.timestamp()
+        return {
+            "event_name": f"event_{self.names.sample()}",
+            "user_id": f"user{user}",
+            "session_id": f"user{user}-{timestamp:%Y%m%d%H}-{timestamp.minute // 30}",
+            # users stay in one project
+            "project_id": user % self.projects + 1,
+            "properties": {"plan": "pro" if user % 10 == 0 else "free"},
+            "timestamp": timestamp,
+        }
+
+    def batches(self, events: int, chunk_size: int = 5000) -> Iterator[list[dict]]:
+        for offset in range(0, events, chunk_size):
+            yield [self.event() for _ in range(min(chunk_size, events - offset))]
+
+
+async def bulk_load(events: int, generator: EventGenerator, chunk_size: int = 5000) -> dict:
+    """Insert events through DatabaseOperation.create_events, aggregates included"""
+    from database import engine, async_session_maker, create_db_and_tables, DatabaseOperation
+
+    engine.echo = False
+    await create_db_and_tables()
+    started = time.perf_counter()
+    for batch in generator.batches(events, chunk_size):
+        async with async_session_maker() as session:
+            await DatabaseOperation(session).create_events(batch)
+    seconds = time.perf_counter() - started
+    return {
+        "benchmark": "bulk_load",
+        "dialect": engine.dialect.name,
+        "events": events,
+        "chunk_size": chunk_size,
+        "seconds": round(seconds, 3),
+        "events_per_second": round(events / seconds, 1) if seconds else None,
+    }
+
+
+async def main(args):
+    from database import engine
+
+    generator = EventGenerator(seed=args.seed, days=args.days, event_names=args.event_names,
+                               users=args.users, projects=args.projects)
+    print(json.dumps(await bulk_load(args.events, generator, args.chunk_size)))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=1000000, help="Number of events to load")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Events per create_events call")
+    parser.add_argument("--days", type=int, default=30, help="Days of history ending now")
+    parser.add_argument("--event-names", type=int, default=50, help="Distinct event names")
+    parser.add_argument("--users", type=int, default=100000, help="Distinct users")
+    parser.add_argument("--projects", type=int, default=3, help="Distinct projects")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+"""
+Open-loop load driver: POST /events/ and analytics reads at a target rate through the ASGI app
+
+Usage:
+    DATABASE_URL=sqlite+aiosqlite:///./bench.db python -m benchmarks.load --rps 200 --duration 30 --output load.json
+    DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.load --rps 1000 --seed-events 1000000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+import httpx
+
+from benchmarks.generator import EventGenerator, bulk_load
+
+# (name, share of requests, method, path)
+SCENARIOS = (
+    ("ingest_event", 0.80, "POST", "/events/"),
+    ("analytics_summary", 0.08, "GET", "/analytics/summary/"),
+    ("top_events", 0.06, "GET", "/events/top/"),
+    ("top_events_window", 0.03, "GET", "/events/top/?window=5m"),
+    ("timeseries_hourly", 0.03, "GET", "/analytics/timeseries?period=hour"),
+)
+
+
+def percentile(sorted_values: list[float], share: float) -> Optional[float]:
+    """Nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * share // 1))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies: list[float], errors: int, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / seconds, 2) if seconds else None,
+        **{f"p{int(share * 100)}_ms": round(percentile(latencies, share), 3) if latencies else None
+           for share in (0.5, 0.95, 0.99)},
+        "max_ms": round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def drive(client: httpx.AsyncClient, rps: float, duration: float,
+                generator: EventGenerator, max_in_flight: int, seed: int = 42) -> dict:
+    """
+    Send requests on a fixed schedule of rps per second for duration seconds.
+
+    Latency is measured from each request's scheduled start, so time spent
+    waiting behind a slow server counts (no coordinated omission). Requests
+    beyond max_in_flight queue, and their wait is counted the same way.
+    """
+    rng = random.Random(seed)
+    names = [name for name, _, _, _ in SCENARIOS]
+    weights = [share for _, share, _, _ in SCENARIOS]
+    routes = {name: (method, path) for name, _, method, path in SCENARIOS}
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    limiter = asyncio.Semaphore(max_in_flight)
+
+    async def request(name: str, scheduled: float):
+        method, path = routes[name]
+        payload = None
+        if method == "POST":
+            payload = generator.event(timestamp=datetime.utcnow())
+            payload["timestamp"] = payload["timestamp"].isoformat()
+        async with limiter:
+            try:
+                response = await client.request(method, path, json=payload)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+        latencies[name].append((time.perf_counter() - scheduled) * 1000)
+        if failed:
+            errors[name] += 1
+
+    started = time.perf_counter()
+    tasks = []
+    for index in range(int(rps * duration)):
+        scheduled = started + index / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(request(rng.choices(names, weights)[0], scheduled)))
+    await asyncio.gather(*tasks)
+    seconds = time.perf_counter() - started
+
+    results = {name: summarize(latencies[name], errors[name], seconds) for name in names if latencies[name]}
+    results["all"] = summarize([value for values in latencies.values() for value in values],
+                               sum(errors.values()), seconds)
+    return results
+
+
+async def main(args):
+    from database import engine
+    from ingestion import INGEST_BUFFER_ENABLED
+    from main import app
+
+    generator = EventGenerator(seed=args.seed, days=7)
+    engine.echo = False
+    report = {
+        "benchmark": "load",
+        "commit": git_commit(),
+        "dialect": engine.dialect.name,
+        "started_at": datetime.utcnow().isoformat(),
+        "target_rps": args.rps,
+        "duration_seconds": args.duration,
+        "max_in_flight": args.max_in_flight,
+        "ingest_buffer": INGEST_BUFFER_ENABLED,
+    }
+    if args.seed_events:
+        report["seed"] = await bulk_load(args.seed_events, EventGenerator(seed=args.seed))
+
+    # run the app's startup and shutdown, so the ingestion buffer and background tasks are live
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            report["results"] = await drive(client, args.rps, args.duration, generator,
+                                            args.max_in_flight, args.seed)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    print(output)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rps", type=float, default=200, help="Target requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send requests for")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Concurrent requests at most")
+    parser.add_argument("--seed-events", type=int, default=0, help="Events to bulk-load first")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,214 @@
+"""
+Per-day active-user and first-seen bitmaps, and cohort retention matrices built from them
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import ActiveUserBitmap, FirstSeenBitmap, UserFirstSeen, UserIndex
+from roaring import RoaringBitmap
+from rollups import insert_for, to_utc_naive, truncate
+
+RETENTION_PERIODS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+# project_id of the first-seen rows and bitmaps that span every project
+ALL_PROJECTS = -1
+
+
+def period_start(day: datetime, period: str) -> datetime:
+    """Start of the day, or of the ISO week (Monday), containing day"""
+    day = truncate(day, "day")
+    return day - timedelta(days=day.weekday()) if period == "week" else day
+
+
+async def get_user_indexes(session: AsyncSession, user_ids: set[str]) -> dict[str, int]:
+    """Dense index of each user id, assigning new ones to ids seen for the first time"""
+    from sqlalchemy import select
+
+    if not user_ids:
+        return {}
+    query = select(UserIndex.user_id, UserIndex.id).where(UserIndex.user_id.in_(user_ids))
+    indexes = dict((await session.execute(query)).all())
+    missing = sorted(user_ids - indexes.keys())
+    if missing:
+        # only unseen ids are inserted, so PostgreSQL's sequence is not spent on conflicts
+        insert = insert_for(session)
+        await session.execute(
+            insert(UserIndex).on_conflict_do_nothing(index_elements=["user_id"]),
+            [{"user_id": user_id} for user_id in missing]
+        )
+        query = select(UserIndex.user_id, UserIndex.id).where(UserIndex.user_id.in_(missing))
+        indexes.update((await session.execute(query)).all())
+    return indexes
+
+
+async def _merge_bitmaps(session: AsyncSession, model, added: dict[tuple, set],
+                         removed: Optional[dict[tuple, set]] = None):
+    """
+    Add (and remove) user indexes in the (project, day) bitmaps of model
+    inside the caller's transaction: missing bitmaps are created empty,
+    then the affected ones are locked, merged and written back, like the
+    sketches.
+    """
+    from sqlalchemy import select, update, tuple_, bindparam
+
+    removed = removed or {}
+    keys = sorted(added.keys() | removed.keys())
+    if not keys:
+        return
+    empty = RoaringBitmap().to_bytes()
+    insert = insert_for(session)
+    await session.execute(
+        insert(model).on_conflict_do_nothing(),
+        [{"project_id": project_id, "day": day, "bitmap": empty} for project_id, day in sorted(added)]
+    )
+
+    query = select(model.project_id, model.day, model.bitmap).where(
+        tuple_(model.project_id, model.day).in_(keys)
+    ).order_by(model.project_id, model.day).with_for_update()
+    merged_rows = []
+    for project_id, day, data in (await session.execute(query)).all():
+        bitmap = RoaringBitmap.from_bytes(data)
+        bitmap.update(added.get((project_id, day), ()))
+        if (project_id, day) in removed:
+            bitmap = bitmap - RoaringBitmap.from_values(removed[(project_id, day)])
+        merged_rows.append({"k_project_id": project_id, "k_day": day, "bitmap": bitmap.to_bytes()})
+
+    table = model.__table__
+    query = update(table).where(
+        table.c.project_id == bindparam("k_project_id"),
+        table.c.day == bindparam("k_day"),
+    )
+    await session.execute(query, merged_rows)
+
+
+async def apply_active_users(session: AsyncSession, rows: list[dict]):
+    """Add the users of rows to their (project, day) active and first-seen bitmaps"""
+    indexes = await get_user_indexes(session, {row["user_id"] for row in rows if row.get("user_id") is not None})
+    if not indexes:
+        return
+    active = defaultdict(set)
+    for row in rows:
+        if row.get("user_id") is not None:
+            active[(row.get("project_id") or 0, truncate(row["timestamp"], "day"))].add(indexes[row["user_id"]])
+    await _merge_bitmaps(session, ActiveUserBitmap, active)
+    await apply_first_seen(session, active)
+
+
+async def apply_first_seen(session: AsyncSession, active: dict[tuple, set]):
+    """
+    Record the first day of each user in its project and in any project
+    (ALL_PROJECTS). New users join that day's first-seen bitmap; a late
+    event moves a known user to the earlier day's bitmap.
+    """
+    from sqlalchemy import select, update, tuple_, bindparam
+
+    earliest = {}
+    for (project_id, day), users in active.items():
+        for scope in (project_id, ALL_PROJECTS):
+            for user in users:
+                if day < earliest.get((scope, user), day + timedelta(days=1)):
+                    earliest[(scope, user)] = day
+
+    table = UserFirstSeen.__table__
+    insert = insert_for(session)
+    result = await session.execute(
+        insert(table).on_conflict_do_nothing().returning(table.c.project_id, table.c.user_index),
+        [{"project_id": scope, "user_index": user, "day": day} for (scope, user), day in sorted(earliest.items())]
+    )
+    inserted = {(scope, user) for scope, user in result.all()}
+    added = defaultdict(set)
+    removed = defaultdict(set)
+    for scope, user in inserted:
+        added[(scope, earliest[(scope, user)])].add(user)
+
+    known = sorted(earliest.keys() - inserted)
+    if known:
+        # most users were first seen before this batch; lock only the ones it moves earlier
+        columns = tuple_(UserFirstSeen.project_id, UserFirstSeen.user_index)
+        query = select(UserFirstSeen.project_id, UserFirstSeen.user_index, UserFirstSeen.day).where(
+            columns.in_(known)
+        )
+        later = [(scope, user) for scope, user, day in (await session.execute(query)).all()
+                 if earliest[(scope, user)] < day]
+        if later:
+            query = select(UserFirstSeen.project_id, UserFirstSeen.user_index, UserFirstSeen.day).where(
+                columns.in_(sorted(later))
+            ).order_by(UserFirstSeen.project_id, UserFirstSeen.user_index).with_for_update()
+            moved = []
+            for scope, user, day in (await session.execute(query)).all():
+                first = earliest[(scope, user)]
+                if first < day:
+                    removed[(scope, day)].add(user)
+                    added[(scope, first)].add(user)
+                    moved.append({"k_project_id": scope, "k_user_index": user, "day": first})
+            if moved:
+                await session.execute(update(table).where(
+                    table.c.project_id == bindparam("k_project_id"),
+                    table.c.user_index == bindparam("k_user_index"),
+                ), moved)
+    await _merge_bitmaps(session, FirstSeenBitmap, added, removed)
+
+
+async def get_retention_matrix(session: AsyncSession, period: str,
+                               start_date: datetime, end_date: datetime,
+                               project_id: Optional[int] = None,
+                               max_periods: int = 8,
+                               now: Optional[datetime] = None) -> list[dict]:
+    """
+    Cohorts of users first seen in each period from start_date to end_date,
+    with how many of them were active 0..max_periods periods later.
+
+    Each cohort is the union of its period's first-seen bitmaps, and each
+    matrix cell is one bitmap AND and popcount, so only bitmaps from
+    start_date to the last retained period are read.
+    """
+    from sqlalchemy import select
+
+    step = RETENTION_PERIODS[period]
+    first = period_start(start_date, period)
+    last = period_start(end_date, period)
+    horizon = min(last + step * (max_periods + 1), truncate(to_utc_naive(now or datetime.utcnow()), "day") + step)
+
+    query = select(FirstSeenBitmap.day, FirstSeenBitmap.bitmap).where(
+        FirstSeenBitmap.project_id == (ALL_PROJECTS if project_id is None else project_id),
+        FirstSeenBitmap.day >= first,
+        FirstSeenBitmap.day < min(last + step, horizon),
+    )
+    new_users: dict[datetime, RoaringBitmap] = {}
+    for day, data in (await session.execute(query)).all():
+        start = period_start(day, period)
+        bitmap = RoaringBitmap.from_bytes(data)
+        new_users[start] = new_users[start] | bitmap if start in new_users else bitmap
+
+    query = select(ActiveUserBitmap.day, ActiveUserBitmap.bitmap).where(
+        ActiveUserBitmap.day >= first, ActiveUserBitmap.day < horizon
+    )
+    if project_id is not None:
+        query = query.where(ActiveUserBitmap.project_id == project_id)
+    periods: dict[datetime, RoaringBitmap] = {}
+    for day, data in (await session.execute(query)).all():
+        start = period_start(day, period)
+        bitmap = RoaringBitmap.from_bytes(data)
+        periods[start] = periods[start] | bitmap if start in periods else bitmap
+
+    cohorts = []
+    start = first
+    while start <= last and start < horizon:
+        cohort = new_users.get(start, RoaringBitmap())
+        size = len(cohort)
+        retained = []
+        offset = start
+        while len(retained) <= max_periods and offset < horizon:
+            retained.append(len(cohort & periods[offset]) if offset in periods and size else 0)
+            offset += step
+        cohorts.append({
+            "cohort_start": start,
+            "users": size,
+            "retained": retained,
+            "retention": [round(count / size, 4) if size else 0.0 for count in retained],
+        })
+        start += step
+    return cohorts
@@ -2,46 +2,158 @@
 Database Connection and Session Manager
 """
 
+import asyncio
+import base64
+import json
 import os
-from typing import AsyncGenerator
+from datetime import datetime, timedelta
+import logging
+from typing import AsyncGenerator, Callable, Optional
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from sqlmodel import SQLModel
-from models import Event, Project
+from models import AnalyticsQuery, Event, Project, UserSession
+from rollups import ROLLUP_MODELS, insert_for, apply_rollups, split_range, truncate, to_utc_naive
+from sketches import ALL_EVENTS, SKETCH_COLUMNS, apply_sketches, merge_sketches
+from hll import HyperLogLog, HLL_PRECISION
+from cohorts import apply_active_users, get_retention_matrix
+from lookups import LOOKUPS, intern_lookups, remember_lookups
+from result_cache import record_ingested_rows
+from dedup import DEDUP_DUPLICATES, DuplicateFilter, duplicate_filter, find_duplicates
+from partitions import create_partitioned_events_table, ensure_partitions, apply_retention
+from property_index import get_promoted_properties, promote_property, property_filter_clauses
+from segments import EventScan, SegmentStore, segment_store
+from metrics import METRICS_ENABLED, instrument_engine
 from dotenv import load_dotenv
 
 #load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Database URL from the environment variable
 DATABASE_URL = os.getenv(
     "DATABASE_URL"
 )
 
-#creating async engine
-engine = create_async_engine(
-    DATABASE_URL,
-    echo = True,    # setting to false in  production
-    future = True
-)
+# Optional replica for reads; without one, reads still get their own pool on the primary
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL") or DATABASE_URL
+
+# log every statement; per-statement latency is in the metrics instead
+SQL_ECHO = os.getenv("SQL_ECHO", "false").lower() == "true"
+
+# connections kept open per pool, and extra ones opened under load
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "5"))
+DB_READ_MAX_OVERFLOW = int(os.getenv("DB_READ_MAX_OVERFLOW", "5"))
+# seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# reconnect connections older than this, before a server or proxy drops them
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# asyncpg prepared statements cached per connection; 0 behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
+
+def is_in_memory(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:")
+
+
+def engine_options(url: str, pool_size: int, max_overflow: int) -> dict:
+    """create_async_engine arguments for url's dialect and pool"""
+    options = {"echo": SQL_ECHO, "future": True, "pool_pre_ping": DB_POOL_PRE_PING}
+    if is_in_memory(url):
+        # in-memory databases live in a single static connection
+        return options
+    options.update(pool_size=pool_size, max_overflow=max_overflow,
+                   pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    if make_url(url).get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return options
+
 
+#creating async engines: ingestion and background work on the primary, reads on their own pool
+engine = create_async_engine(DATABASE_URL, **engine_options(DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW))
+if DATABASE_READ_URL == DATABASE_URL and is_in_memory(DATABASE_URL):
+    read_engine = engine
+else:
+    read_engine = create_async_engine(
+        DATABASE_READ_URL, **engine_options(DATABASE_READ_URL, DB_READ_POOL_SIZE, DB_READ_MAX_OVERFLOW)
+    )
+if METRICS_ENABLED:
+    instrument_engine(engine, pool="primary")
+    if read_engine is not engine:
+        instrument_engine(read_engine, pool="read")
 
-#Create async session factory 
+
+class RoutingSession(Session):
+    """
+    Sends plain SELECTs to read_engine and everything else (flushes, DML,
+    DDL, text SQL, SELECT ... FOR UPDATE) to write_engine. After its first
+    write a session stays on the primary, so it reads its own writes; a
+    replica may otherwise lag slightly behind. get_bind() with no statement
+    (dialect checks) answers with the primary without making it sticky;
+    setting info["primary"] pins a session to the primary up front.
+    """
+
+    write_engine = engine.sync_engine
+    read_engine = read_engine.sync_engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (not self.info.get("primary") and not self._flushing
+                and getattr(clause, "is_select", False) and getattr(clause, "_for_update_arg", None) is None):
+            return self.read_engine
+        if self._flushing or clause is not None:
+            self.info["primary"] = True
+        return self.write_engine
+
+
+#Create async session factories: primary only, and routed for API requests
 async_session_maker = sessionmaker(
     engine,
     class_=AsyncSession,
     expire_on_commit= False
 )
 
+routing_session_maker = sessionmaker(
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
+    expire_on_commit=False
+)
+
 
 async def create_db_and_tables():
     """Create database tables"""
     async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.run_sync(create_partitioned_events_table)
         await conn.run_sync(SQLModel.metadata.create_all)
 
-async def get_session() -> AsyncGenerator[ç,None]:
-    """get database session for fastapi dependency"""
-    async with async_session_maker() as session:
+# In-memory consumers of committed events (top-K trackers, live counters, ...)
+ingest_listeners: list[Callable[[list[dict]], None]] = []
+
+
+def register_ingest_listener(listener: Callable[[list[dict]], None]):
+    """Call listener with the rows of every committed ingestion batch"""
+    if listener not in ingest_listeners:
+        ingest_listeners.append(listener)
+
+
+def notify_ingest_listeners(rows: list[dict]):
+    """Hand committed rows to every listener; a failing listener never fails ingestion"""
+    for listener in ingest_listeners:
+        try:
+            listener(rows)
+        except Exception:
+            logger.exception("Ingest listener %r failed", listener)
+
+
+async def get_session() -> AsyncGenerator[AsyncSession, None]:
+    """get database session for fastapi dependency, routing reads to the read pool"""
+    async with routing_session_maker() as session:
         try:
             yield session
         finally:
@@ -50,45 +162,292 @@ async def get_session() -> AsyncGenerator[ç,None]:
 
 
 
+# Pagination cursors
+
+def encode_cursor(timestamp: datetime, event_id: int) -> str:
+    """Encode the (timestamp, id) of the last row of a page as an opaque token"""
+    payload = json.dumps({"t": timestamp.isoformat(), "i": event_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decode a token from encode_cursor; raises ValueError if it is malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(payload["t"]), int(payload["i"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
 # Database Operation
 
 class DatabaseOperation:
     """ Database Operation for analytics platform """
 
-    def __init__(self,session:AsyncSession):
+    def __init__(self,session:AsyncSession, segments: Optional[SegmentStore] = segment_store,
+                 dedup: Optional[DuplicateFilter] = duplicate_filter):
         self.session = session 
+        self.segments = segments
+        self.dedup = dedup
 
 
     async def create_event(self , 
-                           event_data:dict , ip_adress:str = None , 
+                           event_data:dict , ip_address:str = None , 
                            user_agent:str= None)-> Event:
-        """Create new Event in the database """
-        event = Event(
-            **event_data,
-            ip_address=ip_adress,
-            user_agent=user_agent
-        )
+        """Create new Event in the database; a known event_uuid returns the stored event instead"""
+        from sqlalchemy import select
+
+        event_data = {key: value for key, value in event_data.items() if value is not None}
+        event_data.update(ip_address=ip_address, user_agent=user_agent)
+        # duplicate checks must not read a lagging replica
+        self.session.info["primary"] = True
+        uuid = event_data.get("event_uuid")
+        existing = await find_duplicates(self.session, [event_data], self.dedup)
+        if existing:
+            DEDUP_DUPLICATES.inc()
+            return await self.session.get(Event, existing[uuid]["id"])
+        pending = await intern_lookups(self.session, [event_data])
+        event = Event(**event_data)
+        values = event.model_dump(exclude={"id"})
 
-        self.session.add(event)
+        # a concurrent retry of the same event_uuid and timestamp may commit first; the unique index decides
+        insert = insert_for(self.session)
+        result = await self.session.execute(
+            insert(Event.__table__).values(**values).on_conflict_do_nothing().returning(Event.__table__.c.id)
+        )
+        event_id = result.scalar()
+        if event_id is None:
+            await self.session.commit()
+            DEDUP_DUPLICATES.inc()
+            result = await self.session.execute(
+                select(Event).where(Event.event_uuid == uuid, Event.timestamp == values["timestamp"])
+            )
+            return result.scalars().first()
+        row = {
+            "project_id": event.project_id,
+            "event_name": event.event_name,
+            "user_id": event.user_id,
+            "session_id": event.session_id,
+            "timestamp": event.timestamp,
+        }
+        await self._apply_aggregates([row])
         await self.session.commit()
-        await self.session.refresh(event)
+        remember_lookups(pending)
+        event = await self.session.get(Event, event_id)
+        row["id"] = event.id
+        notify_ingest_listeners([row])
         return event
+
+    async def _apply_aggregates(self, rows: list[dict]):
+        """Update the aggregates maintained on ingest, in the current transaction"""
+        await apply_rollups(self.session, rows)
+        await apply_sketches(self.session, rows)
+        await apply_active_users(self.session, rows)
+        await record_ingested_rows(self.session, rows)
+
+    async def create_events(self,
+                            events_data: list[dict], ip_address: str = None,
+                            user_agent: str = None) -> list[dict]:
+        """
+        Create many events in a single transaction, together with their
+        time-bucket rollups and distinct-count sketches.
+
+        Rows are sent as one executemany, which SQLAlchemy renders as batched
+        multi-row INSERT ... VALUES statements with RETURNING, so ids and
+        timestamps come back without a refresh per row.
+        An event dict may carry its own ip_address/user_agent, which take
+        precedence over the arguments; both are stored as lookup table ids.
+
+        Events whose event_uuid is already stored, or repeated within the
+        batch, are skipped; their entry in the returned list (one per input,
+        in order) is the stored event's, with duplicate=True.
+        """
+        from sqlalchemy import select
+
+        if not events_data:
+            return []
+
+        # duplicate checks must not read a lagging replica
+        self.session.info["primary"] = True
+        existing = await find_duplicates(self.session, events_data, self.dedup)
+        fresh = []
+        # per input: position in fresh, and whether it repeats an earlier event
+        positions = []
+        first_index = {}
+        for data in events_data:
+            uuid = data.get("event_uuid")
+            if uuid in existing:
+                positions.append((None, True))
+            elif uuid is not None and uuid in first_index:
+                positions.append((first_index[uuid], True))
+            else:
+                if uuid is not None:
+                    first_index[uuid] = len(fresh)
+                positions.append((len(fresh), False))
+                fresh.append(data)
+        if len(fresh) < len(events_data):
+            DEDUP_DUPLICATES.inc(amount=len(events_data) - len(fresh))
+        if not fresh:
+            # still commit whatever the caller added to the transaction
+            await self.session.commit()
+            return [{**existing[data["event_uuid"]], "duplicate": True} for data in events_data]
+
+        now = datetime.utcnow()
+        rows = [
+            {
+                "event_name": data["event_name"],
+                "user_id": data.get("user_id"),
+                "session_id": data.get("session_id"),
+                "project_id": data.get("project_id"),
+                "event_uuid": data.get("event_uuid"),
+                "properties": data.get("properties") or {},
+                "user_properties": data.get("user_properties") or {},
+                "timestamp": data.get("timestamp") or now,
+                "ip_address": data.get("ip_address", ip_address),
+                "user_agent": data.get("user_agent", user_agent),
+                "created_at": now,
+            }
+            for data in fresh
+        ]
+
+        pending = await intern_lookups(self.session, rows)
+
+        # sort_by_parameter_order would make SQLite fall back to one INSERT per
+        # row. Ids are handed out in VALUES order, so sorting the returned rows
+        # by id lines them up with the input instead.
+        # Rows whose event_uuid and timestamp a concurrent request committed
+        # first are left out by the unique index and come back as duplicates.
+        insert = insert_for(self.session)
+        query = insert(Event).on_conflict_do_nothing().returning(Event.id, Event.timestamp, Event.event_uuid)
+        result = await self.session.execute(query, rows)
+        returned = iter(sorted(result.all(), key=lambda row: row.id))
+        inserted = next(returned, None)
+        created = []
+        conflicts = []
+        for row in rows:
+            if inserted is not None and inserted.event_uuid == row["event_uuid"]:
+                row["id"] = inserted.id
+                created.append({"id": inserted.id, "timestamp": inserted.timestamp})
+                inserted = next(returned, None)
+            else:
+                conflicts.append(row)
+                created.append(None)
+        if conflicts:
+            DEDUP_DUPLICATES.inc(amount=len(conflicts))
+            result = await self.session.execute(
+                select(Event.event_uuid, Event.id, Event.timestamp).where(
+                    Event.event_uuid.in_({row["event_uuid"] for row in conflicts}),
+                    Event.timestamp.in_({row["timestamp"] for row in conflicts}),
+                )
+            )
+            for row in result.all():
+                existing.setdefault(row.event_uuid, {"id": row.id, "timestamp": row.timestamp})
+            positions = [
+                (None, True) if position is not None and created[position] is None else (position, duplicate)
+                for position, duplicate in positions
+            ]
+            rows = [row for row in rows if "id" in row]
+        if rows:
+            await self._apply_aggregates(rows)
+        await self.session.commit()
+        remember_lookups(pending)
+        if rows:
+            notify_ingest_listeners(rows)
+        if len(fresh) == len(events_data) and not conflicts:
+            return created
+        return [
+            {**(created[position] if position is not None else existing[data["event_uuid"]]), "duplicate": True}
+            if duplicate else created[position]
+            for data, (position, duplicate) in zip(events_data, positions)
+        ]
     
-    async def get_events(self, limit: int = 100, offset: int = 0) -> list[Event]:
-        """Get events from the database with pagination"""
-        from sqlalchemy import select , desc
+    async def get_events(self, limit: int = 100, offset: int = 0,
+                         cursor: Optional[str] = None,
+                         event_name: Optional[str] = None,
+                         user_id: Optional[str] = None,
+                         session_id: Optional[str] = None,
+                         property_filters: Optional[dict[str, str]] = None) -> list[Event]:
+        """
+        Get events from the database with pagination, newest first.
 
-        query = select(Event).order_by(desc(Event.timestamp)).offset(offset).limit(limit)
-        result = await self.session.execute(query)
+        With a cursor the page starts right after the row it encodes
+        (keyset pagination on the (timestamp, id) index) and offset is ignored.
+        event_name/user_id/session_id use their (column, timestamp) indexes;
+        property_filters match properties[key] == value.
+        """
+        from sqlalchemy import select , desc, tuple_
+
+        query = select(Event).order_by(desc(Event.timestamp), desc(Event.id)).where(
+            *await self._listing_filters(event_name, user_id, session_id, property_filters)
+        )
+        if cursor is not None:
+            timestamp, event_id = decode_cursor(cursor)
+            query = query.where(tuple_(Event.timestamp, Event.id) < (timestamp, event_id))
+        elif offset:
+            query = query.offset(offset)
+
+        result = await self.session.execute(query.limit(limit))
         return result.scalars().all()
     
-    async def get_event_count(self) -> int:
-        """Get total event count"""
+    async def _listing_filters(self, event_name: Optional[str] = None,
+                               user_id: Optional[str] = None,
+                               session_id: Optional[str] = None,
+                               property_filters: Optional[dict[str, str]] = None) -> list:
+        """WHERE clauses of the event listing filters, shared by the page and its count"""
+        filters = []
+        if event_name is not None:
+            filters.append(Event.event_name == event_name)
+        if user_id is not None:
+            filters.append(Event.user_id == user_id)
+        if session_id is not None:
+            filters.append(Event.session_id == session_id)
+        if property_filters:
+            promoted = await get_promoted_properties(self.session)
+            filters.extend(property_filter_clauses(
+                self.session.get_bind().dialect.name, property_filters, promoted
+            ))
+        return filters
+
+    async def get_event_count(self, event_name: Optional[str] = None,
+                              user_id: Optional[str] = None,
+                              session_id: Optional[str] = None,
+                              property_filters: Optional[dict[str, str]] = None) -> int:
+        """Get total event count, of the events matching the listing filters when given"""
         from sqlalchemy import select, func
 
-        query = select(func.count(Event.id))
+        query = select(func.count(Event.id)).where(
+            *await self._listing_filters(event_name, user_id, session_id, property_filters)
+        )
         result = await self.session.execute(query)
         return result.scalar_one_or_none()
+
+    async def get_event_count_estimate(self) -> int:
+        """
+        Get an approximate count of all events without scanning the table.
+
+        PostgreSQL reports the planner's reltuples statistic, summed over the
+        partitions; other databases add up the day rollups, which lose the
+        days retention removes along with their events. Falls back to an
+        exact count when no estimate is available yet.
+        """
+        from sqlalchemy import select, func, text
+
+        if self.session.get_bind().dialect.name == "postgresql":
+            query = text(
+                "SELECT sum(greatest(reltuples, 0))::bigint, max(reltuples) FROM pg_class "
+                "WHERE oid = 'events'::regclass "
+                "OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'events'::regclass)"
+            )
+            result = await self.session.execute(query)
+            estimate, analyzed = result.first()
+            if analyzed is not None and analyzed >= 0:
+                return estimate
+            return await self.get_event_count() or 0
+
+        rollup = ROLLUP_MODELS["day"]
+        result = await self.session.execute(select(func.sum(rollup.count)))
+        return result.scalar_one_or_none() or 0
     
     async def get_unique_users_count(self) -> int:
         """Get count of unique users"""
@@ -98,19 +457,91 @@ class DatabaseOperation:
         result = await self.session.execute(query)
         return result.scalar_one_or_none() or 0
     
-    async def get_unique_sessions_count(self) -> int:
-        """Get count of unique users"""
+    async def get_unique_sessions_count(self, start_date: Optional[datetime] = None,
+                                        end_date: Optional[datetime] = None,
+                                        project_id: Optional[int] = None) -> int:
+        """
+        Get count of unique sessions: distinct client session ids, plus the
+        sessions the sessionizer built from events sent without one
+        """
         from sqlalchemy import select, func
 
-        query = select(func.count(func.distinct(Event.session_id))).where (Event.session_id.is_not(None))
+        query = select(func.count(func.distinct(Event.session_id))).where(
+            *self._event_filters(start_date, end_date, project_id), Event.session_id.is_not(None)
+        )
         result = await self.session.execute(query)
+        client_sessions = result.scalar_one_or_none() or 0
+        return client_sessions + await self.get_sessionized_count(start_date, end_date, project_id)
+
+    async def get_sessionized_count(self, start_date: Optional[datetime] = None,
+                                    end_date: Optional[datetime] = None,
+                                    project_id: Optional[int] = None) -> int:
+        """
+        Closed sessions in the sessions table whose events carried no
+        session_id, which distinct session ids cannot count
+        """
+        from sqlalchemy import select, func
+
+        filters = [UserSession.client_session_id.is_(None)]
+        if start_date is not None:
+            filters.append(UserSession.started_at >= start_date)
+        if end_date is not None:
+            filters.append(UserSession.started_at <= end_date)
+        if project_id is not None:
+            filters.append(UserSession.project_id == project_id)
+        result = await self.session.execute(select(func.count(UserSession.id)).where(*filters))
         return result.scalar_one_or_none() or 0
+
+    async def get_session_metrics(self, start_date: Optional[datetime] = None,
+                                  end_date: Optional[datetime] = None,
+                                  project_id: Optional[int] = None,
+                                  top: int = 5) -> dict:
+        """Session counts, duration, depth, bounces and entry/exit events from the sessions table"""
+        from sqlalchemy import select, func, case
+
+        filters = []
+        if start_date is not None:
+            filters.append(UserSession.started_at >= start_date)
+        if end_date is not None:
+            filters.append(UserSession.started_at <= end_date)
+        if project_id is not None:
+            filters.append(UserSession.project_id == project_id)
+
+        result = await self.session.execute(select(
+            func.count(UserSession.id),
+            func.avg(UserSession.duration_seconds),
+            func.avg(UserSession.event_count),
+            func.sum(case((UserSession.event_count == 1, 1), else_=0))
+        ).where(*filters))
+        total, avg_duration, avg_events, bounces = result.first()
+
+        async def most_common(column):
+            query = select(column, func.count(UserSession.id)).where(*filters).group_by(column).order_by(
+                func.count(UserSession.id).desc()).limit(top)
+            return dict((await self.session.execute(query)).all())
+
+        return {
+            "total_sessions": total or 0,
+            "avg_duration_seconds": round(avg_duration or 0, 3),
+            "avg_events_per_session": round(avg_events or 0, 3),
+            "bounce_rate": round(bounces / total, 4) if total else 0.0,
+            "top_entry_events": await most_common(UserSession.entry_event),
+            "top_exit_events": await most_common(UserSession.exit_event),
+        }
     
-    async def get_events_by_type(self) -> dict[str,int]:
+    async def get_events_by_type(self, start_date: Optional[datetime] = None,
+                                 end_date: Optional[datetime] = None,
+                                 project_id: Optional[int] = None) -> dict[str,int]:
         """Get count of events by type"""
         from sqlalchemy import select, func
 
-        query = select(Event.event_name, func.count(Event.id)).group_by(Event.event_name)
+        scan = await self._scan_events(start_date, end_date, project_id)
+        if scan is not None:
+            return dict(scan.by_event)
+
+        query = select(Event.event_name, func.count(Event.id)).where(
+            *self._event_filters(start_date, end_date, project_id)
+        ).group_by(Event.event_name)
         result = await self.session.execute(query)
         return {row[0]: row[1] for row in result.all()}
     
@@ -126,9 +557,163 @@ class DatabaseOperation:
             "end_date": max_date
         }
     
+    @staticmethod
+    def _event_filters(start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                       project_id: Optional[int] = None) -> list:
+        """WHERE clauses scoping events by time range and project"""
+        filters = []
+        if start_date is not None:
+            filters.append(Event.timestamp >= start_date)
+        if end_date is not None:
+            filters.append(Event.timestamp <= end_date)
+        if project_id is not None:
+            filters.append(Event.project_id == project_id)
+        return filters
+
+    def _sibling_session(self) -> AsyncSession:
+        """A new session on the same engine(s) as self.session, routing included"""
+        return AsyncSession(getattr(self.session, "bind", None),
+                            sync_session_class=type(self.session.sync_session), expire_on_commit=False)
+
+    async def _fan_out(self, *calls):
+        """
+        Run calls concurrently, each with a DatabaseOperation on its own
+        session (and so its own pooled connection) from the same engine(s).
+        """
+        async def run(call):
+            async with self._sibling_session() as session:
+                return await call(DatabaseOperation(session, self.segments))
+
+        return await asyncio.gather(*(run(call) for call in calls))
+
+    async def _scan_events(self, start_date: Optional[datetime] = None,
+                           end_date: Optional[datetime] = None,
+                           project_id: Optional[int] = None,
+                           users_by_event: bool = False) -> Optional[EventScan]:
+        """
+        Exact aggregates over a range from the columnar segments of the days
+        they cover, plus SQL for the hot tail (days without a segment and
+        late rows). None when no segment covers any of the range.
+        """
+        from sqlalchemy import select, func
+
+        if self.segments is None:
+            return None
+        covered = self.segments.covering(start_date, end_date)
+        if not covered:
+            return None
+
+        scan = EventScan(users_by_event=users_by_event)
+        for segment in covered:
+            scan.add_segment(segment, start_date, end_date, project_id)
+
+        query = select(
+            Event.event_name, Event.user_id, Event.session_id,
+            func.count(Event.id), func.min(Event.timestamp), func.max(Event.timestamp)
+        ).where(
+            *self._event_filters(start_date, end_date, project_id),
+            self.segments.tail_clause(covered)
+        ).group_by(Event.event_name, Event.user_id, Event.session_id)
+        result = await self.session.execute(query)
+        scan.add_rows(result.all())
+        return scan
+
+    async def get_summary(self, start_date: Optional[datetime] = None,
+                          end_date: Optional[datetime] = None,
+                          project_id: Optional[int] = None,
+                          exact: bool = False) -> dict:
+        """
+        Get everything the analytics summary shows in as few scans as possible.
+
+        exact=True reads closed days from columnar segments when there are
+        any; otherwise it runs one aggregate query for the counts and date
+        range and the per-type GROUP BY concurrently on separate connections. Otherwise
+        counts come from the day/hour/minute rollups (raw events for
+        sub-minute edges), distinct counts from daily sketches plus the
+        partial days' values, and the date range from the timestamp indexes.
+        Sessions are distinct client session ids plus the sessionizer's
+        sessions of events sent without one, in every mode.
+        """
+        from sqlalchemy import select, func
+
+        filters = self._event_filters(start_date, end_date, project_id)
+        scan = await self._scan_events(start_date, end_date, project_id) if exact else None
+        if scan is not None:
+            events_type = dict(scan.by_event)
+            total_events, unique_users, unique_sessions = scan.total, len(scan.users), len(scan.sessions)
+            min_date, max_date = scan.min_timestamp, scan.max_timestamp
+        elif exact:
+            async def aggregates(db_ops):
+                query = select(
+                    func.count(Event.id),
+                    func.count(func.distinct(Event.user_id)),
+                    func.count(func.distinct(Event.session_id)),
+                    func.min(Event.timestamp),
+                    func.max(Event.timestamp)
+                ).where(*filters)
+                result = await db_ops.session.execute(query)
+                return result.first()
+
+            async def events_by_type(db_ops):
+                return await db_ops.get_events_by_type(start_date, end_date, project_id)
+
+            row, events_type = await self._fan_out(aggregates, events_by_type)
+            total_events, unique_users, unique_sessions, min_date, max_date = row
+        else:
+            counts = self._range_counts(start_date, end_date, project_id)
+            events_type = {}
+            if counts is not None:
+                query = select(counts.c.event_name, func.sum(counts.c.count)).group_by(counts.c.event_name)
+                result = await self.session.execute(query)
+                events_type = {event_name: count for event_name, count in result.all()}
+            total_events = sum(events_type.values())
+
+            unique_users = await self.get_unique_count_estimate("user", start_date, end_date, project_id)
+            unique_sessions = await self.get_unique_count_estimate("session", start_date, end_date, project_id)
+
+            # separate subqueries: SQLite only answers a lone min()/max() from an index
+            result = await self.session.execute(select(
+                select(func.min(Event.timestamp)).where(*filters).scalar_subquery(),
+                select(func.max(Event.timestamp)).where(*filters).scalar_subquery()
+            ))
+            min_date, max_date = result.first()
+
+        unique_sessions = (unique_sessions or 0) + await self.get_sessionized_count(start_date, end_date, project_id)
+        return {
+            "total_events": total_events or 0,
+            "unique_users": unique_users or 0,
+            "unique_sessions": unique_sessions,
+            "events_type": events_type,
+            "data_range": {"start_date": min_date, "end_date": max_date},
+        }
+
+    async def promote_property(self, key: str):
+        """Back properties[key] filters with an indexed generated column"""
+        return await promote_property(self.session, key)
+
+    async def get_promoted_properties(self) -> dict[str, str]:
+        """Promoted property keys and their generated column names"""
+        return await get_promoted_properties(self.session)
+
+    async def ensure_partitions(self, days_ahead: int = 3) -> list[str]:
+        """Make sure daily events partitions exist from today to days_ahead"""
+        today = datetime.utcnow()
+        return await ensure_partitions(self.session, today, today + timedelta(days=days_ahead))
+
+    async def apply_retention(self, now: Optional[datetime] = None) -> dict:
+        """Drop or delete events past their project's retention"""
+        return await apply_retention(self.session, now)
+
+    async def compact_segments(self, now: Optional[datetime] = None) -> list[str]:
+        """Write columnar segments for closed days that do not have one yet"""
+        if self.segments is None:
+            return []
+        return await self.segments.compact(self.session, now)
+
     async def get_events_by_data_range(self,start_date,end_date,limit:int = 1000)-> list[Event]: 
     
-        """Get events within a specific date range"""
+        """Get events within a specific date range.
+        The timestamp bounds let PostgreSQL prune to the matching partitions."""
         from sqlalchemy import select
 
         query = select(Event).where(
@@ -139,13 +724,141 @@ class DatabaseOperation:
         result = await self.session.execute(query)
         return result.scalars().all()
     
-    async def get_top_events(self,limit:int=10) -> list[dict]:
-        """Get top events by count"""
+    async def stream_events(self, start_date: Optional[datetime] = None,
+                            end_date: Optional[datetime] = None,
+                            project_id: Optional[int] = None,
+                            event_name: Optional[str] = None,
+                            chunk_size: int = 5000) -> AsyncGenerator[list[tuple], None]:
+        """
+        Yield events in (timestamp, id) order as lists of plain row tuples
+        (columns of export.EXPORT_COLUMNS), chunk_size rows at a time.
+
+        Rows come from a server-side cursor on a session of its own, so the
+        export outlives the request's session and memory stays bounded by
+        one chunk whatever the range.
+        """
+        from sqlalchemy import select
+        from export import EXPORT_COLUMNS
+
+        filters = self._event_filters(start_date, end_date, project_id)
+        if event_name is not None:
+            filters.append(Event.event_name == event_name)
+        events = Event.__table__
+        columns = [
+            LOOKUPS[name].model.value.label(name) if name in LOOKUPS else events.c[name]
+            for name in EXPORT_COLUMNS
+        ]
+        # one join per lookup table instead of a subquery per row
+        source = events
+        for name, cache in LOOKUPS.items():
+            source = source.outerjoin(cache.model, cache.model.id == events.c[f"{name}_id"])
+        query = select(*columns).select_from(source).where(
+            *filters
+        ).order_by(Event.timestamp, Event.id).execution_options(yield_per=chunk_size)
+
+        async with self._sibling_session() as session:
+            result = await session.stream(query)
+            async for partition in result.partitions():
+                yield [tuple(row) for row in partition]
+
+    async def run_query(self, query: AnalyticsQuery) -> list[dict]:
+        """
+        Run a declarative analytics query on the vectorized engine: closed
+        days come from the columnar segments, the rest is streamed from SQL
+        column-wise in chunks.
+        """
+        from sqlalchemy import select
+        from query_engine import QueryEngine
+
+        engine = QueryEngine(query)
+        covered = self.segments.covering(query.start_date, query.end_date) if self.segments is not None else []
+        for segment in covered:
+            engine.add_segment(segment)
+
+        filters = self._event_filters(query.start_date, query.end_date, query.project_id)
+        for name, values in query.filters.items():
+            filters.append(getattr(Event, name).in_(values))
+        if covered:
+            filters.append(self.segments.tail_clause(covered))
+        statement = select(
+            Event.timestamp, Event.project_id, Event.event_name, Event.user_id, Event.session_id
+        ).where(*filters).execution_options(yield_per=50000)
+
+        result = await self.session.stream(statement)
+        async for partition in result.partitions():
+            engine.add_rows(partition)
+        return engine.result()
+
+    async def get_retention(self, period: str, start_date: datetime, end_date: datetime,
+                            project_id: Optional[int] = None, max_periods: int = 8) -> list[dict]:
+        """Cohort retention matrix from the per-day active-user bitmaps"""
+        return await get_retention_matrix(self.session, period, start_date, end_date, project_id, max_periods)
+
+    async def get_funnel(self, steps: list[str], window_seconds: float,
+                         start_date: Optional[datetime] = None,
+                         end_date: Optional[datetime] = None,
+                         project_id: Optional[int] = None,
+                         chunk_size: int = 10000) -> list[dict]:
+        """
+        Conversion through steps (event names, in order) within window_seconds
+        of the first step.
+
+        One pass over the matching events ordered by (user_id, timestamp)
+        through a server-side cursor; the database serves the order from the
+        (user_id, timestamp) index or sorts the filtered rows. The step names
+        and time window are filtered in SQL, and only the current user's
+        state is kept in memory.
+        """
+        from sqlalchemy import select
+        from funnels import FunnelCounter
+
+        counter = FunnelCounter(steps, window_seconds, start_date, end_date)
+        # later steps may happen up to a window after the last entry
+        last = end_date + timedelta(seconds=window_seconds) if end_date is not None else None
+        query = select(Event.user_id, Event.event_name, Event.timestamp).where(
+            Event.user_id.is_not(None),
+            Event.event_name.in_(set(steps)),
+            *self._event_filters(start_date, last, project_id)
+        ).order_by(Event.user_id, Event.timestamp).execution_options(yield_per=chunk_size)
+
+        async with self._sibling_session() as session:
+            result = await session.stream(query)
+            async for partition in result.partitions():
+                counter.add(partition)
+        return counter.result()
+
+    async def get_top_events(self,limit:int=10, exact: bool = False,
+                             start_date: Optional[datetime] = None,
+                             end_date: Optional[datetime] = None,
+                             project_id: Optional[int] = None) -> list[dict]:
+        """
+        Get top events by count, optionally scoped to a time range and project.
+
+        By default counts come from the daily rollups and unique users from
+        merged HyperLogLog sketches; exact=True scans the events table, or
+        the columnar segments for closed days.
+        """
         from sqlalchemy import select, func
 
+        if not exact:
+            return await self._get_top_events_approx(limit, start_date, end_date, project_id)
+
+        scan = await self._scan_events(start_date, end_date, project_id, users_by_event=True)
+        if scan is not None:
+            return [
+                {
+                    "event_name": event_name,
+                    "count": count,
+                    "unique_users": len(scan.users_by_event.get(event_name, ())),
+                    "percentage": round(count / scan.total * 100, 0)
+                } for event_name, count in scan.by_event.most_common(limit)
+            ]
+
+        filters = self._event_filters(start_date, end_date, project_id)
+
           # Get total event count for percentage calculation
 
-        total_query = select(func.count(Event.id))
+        total_query = select(func.count(Event.id)).where(*filters)
         total_result = await self.session.execute(total_query)  
         total_events = total_result.scalar()
 
@@ -154,7 +867,7 @@ class DatabaseOperation:
             Event.event_name,
                 func.count(Event.id).label("count"),
                 func.count(func.distinct(Event.user_id)).label("unique_user")
-            ).group_by(Event.event_name).order_by(func.count(Event.id).desc()).limit(limit)
+            ).where(*filters).group_by(Event.event_name).order_by(func.count(Event.id).desc()).limit(limit)
 
         result = await self.session.execute(query)
 
@@ -165,8 +878,143 @@ class DatabaseOperation:
             top_events.append({
                 "event_name": event_name,
                 "count": count,
-                "unique_user": unique_user or 0,
+                "unique_users": unique_user or 0,
                 "percentage": round(percentage,0)
             })
 
-        return top_events
\ No newline at end of file
+        return top_events
+
+    @staticmethod
+    def _half_open(start_date: Optional[datetime] = None,
+                   end_date: Optional[datetime] = None) -> tuple[Optional[datetime], Optional[datetime]]:
+        """The inclusive [start_date, end_date] of _event_filters as a naive UTC [start, end)"""
+        start = to_utc_naive(start_date) if start_date is not None else None
+        end = to_utc_naive(end_date) + timedelta(microseconds=1) if end_date is not None else None
+        return start, end
+
+    def _range_counts(self, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                      project_id: Optional[int] = None):
+        """
+        Subquery of (event_name, count) rows adding up to the events in the
+        range: whole days, hours and minutes from the rollups, the sub-minute
+        edges from events. None for an empty range.
+        """
+        from sqlalchemy import select, func, union_all
+
+        parts = []
+        for grain, lo, hi in split_range(*self._half_open(start_date, end_date)):
+            if grain is None:
+                query = select(Event.event_name.label("event_name"), func.count(Event.id).label("count")).where(
+                    Event.timestamp >= lo, Event.timestamp < hi
+                )
+                if project_id is not None:
+                    query = query.where(Event.project_id == project_id)
+                parts.append(query.group_by(Event.event_name))
+                continue
+            model = ROLLUP_MODELS[grain]
+            query = select(model.event_name.label("event_name"), func.sum(model.count).label("count"))
+            if lo is not None:
+                query = query.where(model.bucket >= lo)
+            if hi is not None:
+                query = query.where(model.bucket < hi)
+            if project_id is not None:
+                query = query.where(model.project_id == project_id)
+            parts.append(query.group_by(model.event_name))
+        if not parts:
+            return None
+        return (parts[0] if len(parts) == 1 else union_all(*parts)).subquery()
+
+    async def _merge_sketches(self, kind: str, start_date: Optional[datetime] = None,
+                              end_date: Optional[datetime] = None,
+                              event_names: Optional[list[str]] = None,
+                              project_id: Optional[int] = None) -> dict[str, HyperLogLog]:
+        """
+        merge_sketches over the whole days of the range, with the distinct
+        values of partial first and last days added from events
+        """
+        from sqlalchemy import select, literal
+
+        pieces = split_range(*self._half_open(start_date, end_date), grains=("day",))
+        merged = {}
+        for grain, lo, hi in pieces:
+            if grain == "day":
+                merged = await merge_sketches(self.session, kind, start_date=lo,
+                                              end_date=hi - timedelta(days=1) if hi is not None else None,
+                                              event_names=event_names, project_id=project_id)
+
+        column = getattr(Event, SKETCH_COLUMNS[kind])
+        for grain, lo, hi in pieces:
+            if grain is not None:
+                continue
+            query = select(Event.event_name if event_names else literal(ALL_EVENTS), column).where(
+                column.is_not(None), Event.timestamp >= lo, Event.timestamp < hi
+            ).distinct()
+            if event_names:
+                query = query.where(Event.event_name.in_(event_names))
+            if project_id is not None:
+                query = query.where(Event.project_id == project_id)
+            result = await self.session.execute(query)
+            for event_name, value in result.all():
+                if event_name not in merged:
+                    merged[event_name] = HyperLogLog(HLL_PRECISION)
+                merged[event_name].add(value)
+        return merged
+
+    async def _get_top_events_approx(self, limit: int, start_date: Optional[datetime] = None,
+                                     end_date: Optional[datetime] = None,
+                                     project_id: Optional[int] = None) -> list[dict]:
+        from sqlalchemy import select, func
+
+        counts = self._range_counts(start_date, end_date, project_id)
+        if counts is None:
+            return []
+        total_result = await self.session.execute(select(func.sum(counts.c.count)))
+        total_events = total_result.scalar() or 0
+
+        query = select(counts.c.event_name, func.sum(counts.c.count).label("count")).group_by(
+            counts.c.event_name).order_by(func.sum(counts.c.count).desc()).limit(limit)
+        result = await self.session.execute(query)
+        rows = result.all()
+
+        sketches = await self._merge_sketches("user", start_date, end_date,
+                                              event_names=[name for name, _ in rows], project_id=project_id)
+        top_events = []
+        for event_name, count in rows:
+            percentage = (count / total_events * 100) if total_events else 0
+            top_events.append({
+                "event_name": event_name,
+                "count": count,
+                "unique_users": sketches[event_name].count() if event_name in sketches else 0,
+                "percentage": round(percentage,0)
+            })
+
+        return top_events
+
+    async def get_unique_count_estimate(self, kind: str,
+                                        start_date: Optional[datetime] = None,
+                                        end_date: Optional[datetime] = None,
+                                        project_id: Optional[int] = None) -> int:
+        """Approximate distinct users (kind="user") or sessions (kind="session") from sketches"""
+        sketches = await self._merge_sketches(kind, start_date, end_date, project_id=project_id)
+        sketch = sketches.get(ALL_EVENTS)
+        return sketch.count() if sketch is not None else 0
+
+    async def get_event_timeseries(self, period: str, start_date: datetime, end_date: datetime,
+                                   event_name: Optional[str] = None,
+                                   project_id: Optional[int] = None) -> list[dict]:
+        """Get event counts per bucket from the rollup tables, never the raw events"""
+        from sqlalchemy import select, func
+
+        model = ROLLUP_MODELS[period]
+        query = select(model.bucket, func.sum(model.count)).where(
+            model.bucket >= truncate(start_date, period),
+            model.bucket <= to_utc_naive(end_date)
+        )
+        if event_name is not None:
+            query = query.where(model.event_name == event_name)
+        if project_id is not None:
+            query = query.where(model.project_id == project_id)
+        query = query.group_by(model.bucket).order_by(model.bucket)
+
+        result = await self.session.execute(query)
+        return [{"date": bucket, "count": count} for bucket, count in result.all()]
@@ -0,0 +1,162 @@
+"""
+Duplicate detection for client-supplied event_uuid values
+
+Every uuid goes through a time-windowed Bloom filter first. Most events are
+new and the filter says so without touching the database; only uuids it
+may have seen are looked up through the (event_uuid, timestamp) index,
+within the filter's window, which also weeds out its false positives.
+"""
+
+import hashlib
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional
+
+from metrics import Counter, Gauge, registry
+from models import Event
+from rollups import to_utc_naive
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+# how long a uuid is remembered; retries arriving later are stored again
+DEDUP_WINDOW_SECONDS = int(os.getenv("DEDUP_WINDOW_SECONDS", "86400"))
+# the window is covered by this many filters, the oldest dropped as a new one starts
+DEDUP_GENERATIONS = int(os.getenv("DEDUP_GENERATIONS", "4"))
+# uuids per filter before it is retired early, and its false positive rate at that size
+DEDUP_CAPACITY = int(os.getenv("DEDUP_CAPACITY", "1000000"))
+DEDUP_ERROR_RATE = float(os.getenv("DEDUP_ERROR_RATE", "0.001"))
+
+DEDUP_CHECKED = registry.register(Counter(
+    "dedup_events_checked_total", "Events with an event_uuid checked for duplicates"))
+DEDUP_DUPLICATES = registry.register(Counter(
+    "dedup_duplicates_total", "Events dropped as duplicates"))
+DEDUP_FALSE_POSITIVES = registry.register(Counter(
+    "dedup_false_positives_total", "Filter hits the database showed to be new events"))
+DEDUP_FILTER_BYTES = registry.register(Gauge(
+    "dedup_filter_bytes", "Memory held by the duplicate filters"))
+
+
+class BloomFilter:
+    """Bit array with k probes per item, derived from one blake2b digest by double hashing"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item: str) -> list[int]:
+        """Bit positions of item; equal for filters of the same capacity and error rate"""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str, positions: Optional[list[int]] = None):
+        bits = self.bits
+        for position in positions or self.positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def contains(self, item: str, positions: Optional[list[int]] = None) -> bool:
+        bits = self.bits
+        for position in positions or self.positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __contains__(self, item: str) -> bool:
+        return self.contains(item)
+
+
+class DuplicateFilter:
+    """
+    generations Bloom filters, each taking new uuids for window / generations
+    seconds (or until capacity), so a uuid is remembered for between
+    window * (generations - 1) / generations and window seconds.
+    """
+
+    def __init__(self, window: float = DEDUP_WINDOW_SECONDS,
+                 generations: int = DEDUP_GENERATIONS,
+                 capacity: int = DEDUP_CAPACITY,
+                 error_rate: float = DEDUP_ERROR_RATE):
+        self.window = window
+        self.span = window / generations
+        self.generations = generations
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters: deque[tuple[float, BloomFilter]] = deque()
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(len(bloom.bits) for _, bloom in self.filters)
+
+    def _current(self, now: float) -> BloomFilter:
+        if not self.filters or now - self.filters[-1][0] >= self.span or self.filters[-1][1].count >= self.capacity:
+            self.filters.append((now, BloomFilter(self.capacity, self.error_rate)))
+            while len(self.filters) > self.generations:
+                self.filters.popleft()
+            DEDUP_FILTER_BYTES.set(value=self.memory_bytes)
+        return self.filters[-1][1]
+
+    def check_and_add(self, uuid: str, now: Optional[float] = None) -> bool:
+        """True if uuid may have been added before; it is remembered either way"""
+        current = self._current(time.monotonic() if now is None else now)
+        positions = current.positions(uuid)
+        if any(bloom.contains(uuid, positions) for _, bloom in self.filters):
+            return True
+        current.add(uuid, positions)
+        return False
+
+
+duplicate_filter: Optional[DuplicateFilter] = DuplicateFilter() if DEDUP_ENABLED else None
+
+
+async def find_duplicates(session, events: list[dict],
+                          dedup: Optional[DuplicateFilter] = duplicate_filter) -> dict[str, dict]:
+    """
+    {uuid: {"id", "timestamp"}} of the event_uuids of events already
+    stored, among those the filter flags; events without a uuid are skipped.
+
+    A uuid the filter remembers was first seen within its window, so the
+    lookup only reads events timestamped since then (a few recent
+    partitions), plus the exact timestamps of suspects that carry an older
+    one, which a retry repeats.
+    """
+    from sqlalchemy import or_, select
+
+    if dedup is None:
+        return {}
+    suspects = set()
+    checked = 0
+    for uuid in dict.fromkeys(data.get("event_uuid") for data in events):
+        if uuid is None:
+            continue
+        checked += 1
+        if dedup.check_and_add(uuid):
+            suspects.add(uuid)
+    if checked:
+        DEDUP_CHECKED.inc(amount=checked)
+    if not suspects:
+        return {}
+
+    since = datetime.utcnow() - timedelta(seconds=dedup.window)
+    older = {
+        to_utc_naive(data["timestamp"]) for data in events
+        if data.get("event_uuid") in suspects and data.get("timestamp") is not None
+    }
+    older = {timestamp for timestamp in older if timestamp < since}
+    window = Event.timestamp >= since
+    if older:
+        window = or_(window, Event.timestamp.in_(older))
+    result = await session.execute(
+        select(Event.event_uuid, Event.id, Event.timestamp).where(Event.event_uuid.in_(suspects), window)
+    )
+    existing = {}
+    for row in result.all():
+        existing.setdefault(row.event_uuid, {"id": row.id, "timestamp": row.timestamp})
+    if len(suspects) > len(existing):
+        DEDUP_FALSE_POSITIVES.inc(amount=len(suspects) - len(existing))
+    return existing
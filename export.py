@@ -0,0 +1,58 @@
+"""
+Encoders for streaming bulk exports of events
+"""
+
+import csv
+import io
+import json
+from typing import AsyncIterator, Sequence
+
+# columns selected for an export, in output order
+EXPORT_COLUMNS = (
+    "id", "project_id", "event_name", "user_id", "session_id", "timestamp",
+    "properties", "user_properties", "ip_address", "user_agent",
+)
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _jsonable(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def encode_ndjson(rows: Sequence[tuple]) -> str:
+    """One JSON object per row and line"""
+    return "".join(
+        json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=_jsonable, separators=(",", ":")) + "\n"
+        for row in rows
+    )
+
+
+def encode_csv(rows: Sequence[tuple]) -> str:
+    """CSV lines; JSON columns are written as JSON text"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            json.dumps(value, separators=(",", ":")) if isinstance(value, (dict, list))
+            else _jsonable(value) if value is not None else ""
+            for value in row
+        ])
+    return buffer.getvalue()
+
+
+async def encode_export(partitions: AsyncIterator[Sequence[tuple]], fmt: str) -> AsyncIterator[bytes]:
+    """
+    Encode row partitions one at a time, so only one partition is ever held
+    in memory; every partition becomes one chunk of the response.
+    """
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue().encode()
+    encode = encode_csv if fmt == "csv" else encode_ndjson
+    async for rows in partitions:
+        yield encode(rows).encode()
@@ -0,0 +1,113 @@
+"""
+Conversion funnels computed in one pass over events ordered by user and time
+"""
+
+import math
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+from rollups import to_utc_naive
+
+
+class DurationHistogram:
+    """
+    Log-scale histogram of durations in seconds. Memory depends on the
+    spread of the values, not their number; medians are within
+    (ratio - 1) / 2 of the true value.
+    """
+
+    def __init__(self, ratio: float = 1.01):
+        self.log_ratio = math.log(ratio)
+        self.buckets: Counter = Counter()
+        self.count = 0
+
+    def add(self, seconds: float):
+        # everything under a millisecond shares bucket None
+        self.buckets[math.floor(math.log(seconds) / self.log_ratio) if seconds >= 0.001 else None] += 1
+        self.count += 1
+
+    def median(self) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = (self.count - 1) // 2
+        seen = self.buckets.get(None, 0)
+        if rank < seen:
+            return 0.0
+        for bucket in sorted(key for key in self.buckets if key is not None):
+            seen += self.buckets[bucket]
+            if rank < seen:
+                # geometric middle of the bucket
+                return math.exp((bucket + 0.5) * self.log_ratio)
+        return None
+
+
+class FunnelCounter:
+    """
+    Per-user state machine fed with (user_id, event_name, timestamp) rows
+    ordered by user and time; only the current user's state is kept.
+
+    For each step it remembers the latest-starting chain that reached it,
+    so a later step is matched against the chain with the most window left.
+    A user counts for every step up to the furthest one reached within
+    window_seconds of entering the funnel, and entering needs the first
+    step between start_date and end_date.
+    """
+
+    def __init__(self, steps: list[str], window_seconds: float,
+                 start_date: Optional[datetime] = None, end_date: Optional[datetime] = None):
+        self.steps = steps
+        self.window = window_seconds
+        self.start_date = to_utc_naive(start_date) if start_date is not None else None
+        self.end_date = to_utc_naive(end_date) if end_date is not None else None
+        self.step_indexes: dict[str, list[int]] = {}
+        for index, name in enumerate(steps):
+            # later steps first, so one event never advances two steps at once
+            self.step_indexes.setdefault(name, []).insert(0, index)
+        self.reached = [0] * len(steps)
+        self.durations = [DurationHistogram() for _ in steps]
+        self._user = None
+        self._chains: list[Optional[tuple[datetime, ...]]] = [None] * len(steps)
+
+    def add(self, rows):
+        for user_id, event_name, timestamp in rows:
+            if user_id != self._user:
+                self._finish_user()
+                self._user = user_id
+            timestamp = to_utc_naive(timestamp)
+            for index in self.step_indexes.get(event_name, ()):
+                if index == 0:
+                    if (self.start_date is None or timestamp >= self.start_date) and \
+                            (self.end_date is None or timestamp <= self.end_date):
+                        self._chains[0] = (timestamp,)
+                    continue
+                chain = self._chains[index - 1]
+                if chain is not None and (timestamp - chain[0]).total_seconds() <= self.window:
+                    self._chains[index] = chain + (timestamp,)
+
+    def _finish_user(self):
+        for chain in reversed(self._chains):
+            if chain is not None:
+                for index in range(len(chain)):
+                    self.reached[index] += 1
+                    if index:
+                        self.durations[index].add((chain[index] - chain[index - 1]).total_seconds())
+                break
+        self._chains = [None] * len(self.steps)
+
+    def result(self) -> list[dict]:
+        """Per-step users, conversion from the previous and first step, and median seconds from the previous step"""
+        self._finish_user()
+        self._user = None
+        first = self.reached[0]
+        return [
+            {
+                "event_name": name,
+                "count": count,
+                "conversion_rate": round(count / self.reached[index - 1], 4) if index and self.reached[index - 1]
+                else (1.0 if count else 0.0),
+                "overall_conversion": round(count / first, 4) if first else 0.0,
+                "median_seconds_from_previous": self.durations[index].median() if index else None,
+            }
+            for index, (name, count) in enumerate(zip(self.steps, self.reached))
+        ]
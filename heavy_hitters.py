@@ -0,0 +1,167 @@
+"""
+Streaming top-K of event names per project over sliding windows
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timezone
+from typing import Optional
+
+from rollups import to_utc_naive
+
+# counters kept per summary; a reported count exceeds the true one by at most
+# (events in the window) / TOPK_CAPACITY
+TOPK_CAPACITY = int(os.getenv("TOPK_CAPACITY", "50"))
+# projects tracked at once, least recently updated are dropped first; each
+# holds up to 46 slots x TOPK_CAPACITY counters (about 0.5 MB at the defaults)
+TOPK_MAX_PROJECTS = int(os.getenv("TOPK_MAX_PROJECTS", "100"))
+
+# window name -> (span in seconds, number of slots)
+WINDOWS = {
+    "5m": (300, 10),
+    "1h": (3600, 12),
+    "24h": (86400, 24),
+}
+
+
+class SpaceSaving:
+    """
+    Space-Saving summary holding at most capacity counters.
+
+    Each counter is [count, error]: count overestimates the true frequency
+    by at most error, and error never exceeds total / capacity. Unique users
+    are not tracked: a sketch per counter and slot would dwarf the counters.
+    """
+
+    def __init__(self, capacity: int = TOPK_CAPACITY):
+        self.capacity = capacity
+        self.counters: dict[str, list] = {}
+        self.total = 0
+
+    @property
+    def min_count(self) -> int:
+        """Largest count an untracked key could have; 0 while there is free space"""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def add(self, key: str, count: int = 1):
+        self.total += count
+        counter = self.counters.get(key)
+        if counter is None:
+            if len(self.counters) < self.capacity:
+                counter = self.counters[key] = [0, 0]
+            else:
+                # replace the smallest counter; the newcomer inherits its count as error
+                victim = min(self.counters, key=lambda name: self.counters[name][0])
+                victim_count = self.counters.pop(victim)[0]
+                counter = self.counters[key] = [victim_count, victim_count]
+        counter[0] += count
+
+
+class SlidingTopK:
+    """Space-Saving summaries per time slot, merged over the last span seconds"""
+
+    def __init__(self, span: int, slots: int, capacity: int = TOPK_CAPACITY):
+        self.slot_seconds = span // slots
+        self.slot_count = slots
+        self.capacity = capacity
+        self.slots: dict[int, SpaceSaving] = {}
+
+    def _expire(self, current: int):
+        for slot in [slot for slot in self.slots if slot <= current - self.slot_count]:
+            del self.slots[slot]
+
+    def add(self, key: str, epoch: float, now: float):
+        current = int(now // self.slot_seconds)
+        # clients with a fast clock count towards the current slot
+        slot = min(int(epoch // self.slot_seconds), current)
+        if slot <= current - self.slot_count:
+            return
+        self._expire(current)
+        summary = self.slots.get(slot)
+        if summary is None:
+            summary = self.slots[slot] = SpaceSaving(self.capacity)
+        summary.add(key)
+
+    def top(self, limit: int, now: float) -> tuple[list[dict], int]:
+        """Merged top keys and the number of events in the window"""
+        self._expire(int(now // self.slot_seconds))
+        merged: dict[str, list] = {}
+        total = 0
+        for summary in self.slots.values():
+            total += summary.total
+            for key, (count, error) in summary.counters.items():
+                entry = merged.get(key)
+                if entry is None:
+                    merged[key] = [count, error]
+                else:
+                    entry[0] += count
+                    entry[1] += error
+
+        # a key missing from a full slot may still have had up to its min count there
+        for summary in self.slots.values():
+            floor = summary.min_count
+            if floor:
+                for key, entry in merged.items():
+                    if key not in summary.counters:
+                        entry[1] += floor
+
+        ranked = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        return [
+            {"event_name": key, "count": count, "max_error": error, "unique_users": None}
+            for key, (count, error) in ranked
+        ], total
+
+
+class HeavyHitters:
+    """Sliding-window top-K trackers for every project plus one across all projects"""
+
+    def __init__(self, capacity: int = TOPK_CAPACITY, max_projects: int = TOPK_MAX_PROJECTS):
+        self.capacity = capacity
+        self.max_projects = max_projects
+        self.projects: OrderedDict[Optional[int], dict[str, SlidingTopK]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _windows_for(self, project_id: Optional[int]) -> dict[str, SlidingTopK]:
+        windows = self.projects.get(project_id)
+        if windows is None:
+            windows = self.projects[project_id] = {
+                name: SlidingTopK(span, slots, self.capacity) for name, (span, slots) in WINDOWS.items()
+            }
+            if len(self.projects) > self.max_projects + 1:
+                for candidate in self.projects:
+                    if candidate is not None:
+                        del self.projects[candidate]
+                        break
+        else:
+            self.projects.move_to_end(project_id)
+        return windows
+
+    def record(self, rows: list[dict]):
+        """Ingest listener: count committed rows"""
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                epoch = to_utc_naive(row["timestamp"]).replace(tzinfo=timezone.utc).timestamp()
+                project_id = row.get("project_id")
+                for scope in (None, project_id) if project_id is not None else (None,):
+                    for window in self._windows_for(scope).values():
+                        window.add(row["event_name"], epoch, now)
+
+    def top(self, window: str, limit: int = 10, project_id: Optional[int] = None) -> list[dict]:
+        """Top events of a window, shaped like DatabaseOperation.get_top_events"""
+        with self._lock:
+            windows = self.projects.get(project_id)
+            if windows is None:
+                return []
+            top_events, total = windows[window].top(limit, time.time())
+        for event in top_events:
+            event["percentage"] = round(event["count"] / total * 100, 0) if total else 0
+        return top_events
+
+
+# process-wide tracker fed from the ingestion path
+heavy_hitters = HeavyHitters()
@@ -0,0 +1,134 @@
+"""
+HyperLogLog cardinality sketch
+"""
+
+import hashlib
+import math
+import os
+from typing import Iterable, Optional
+
+# number of index bits; 2**precision one-byte registers, error ~1.04/sqrt(2**precision)
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+
+_INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+_HIGH_BITS = {}
+
+
+def _high_bits(size: int) -> int:
+    """Integer with the top bit of each of size bytes set"""
+    if size not in _HIGH_BITS:
+        _HIGH_BITS[size] = int.from_bytes(b"\x80" * size, "little")
+    return _HIGH_BITS[size]
+
+
+def _alpha(m: int) -> float:
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog:
+    """
+    Mergeable approximate distinct counter.
+
+    Values are hashed with a 64-bit blake2b digest so sketches built in
+    different processes agree. Sketches of different precision can be
+    merged; the result takes the lower precision.
+    """
+
+    def __init__(self, precision: int = HLL_PRECISION, registers: Optional[bytes] = None):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16")
+        self.precision = precision
+        self.m = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.m)
+        elif len(registers) != self.m:
+            raise ValueError(f"Expected {self.m} registers, got {len(registers)}")
+        else:
+            self.registers = bytearray(registers)
+
+    @property
+    def relative_error(self) -> float:
+        """Standard error of count() as a fraction of the true cardinality"""
+        return 1.04 / math.sqrt(self.m)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def add(self, value: str):
+        """Add one value to the sketch"""
+        x = self._hash(value)
+        remaining_bits = 64 - self.precision
+        index = x >> remaining_bits
+        rank = remaining_bits - (x & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values: Iterable[str]):
+        """Add many values to the sketch"""
+        for value in values:
+            self.add(value)
+
+    def reduce(self, precision: int) -> "HyperLogLog":
+        """Return an equivalent sketch with fewer registers"""
+        if precision > self.precision:
+            raise ValueError("Cannot increase HyperLogLog precision")
+        if precision == self.precision:
+            return HyperLogLog(self.precision, self.registers)
+
+        shift = self.precision - precision
+        low_mask = (1 << shift) - 1
+        registers = bytearray(1 << precision)
+        for index, rank in enumerate(self.registers):
+            if not rank:
+                continue
+            # the dropped index bits become the leading bits of the hash remainder
+            dropped = index & low_mask
+            new_rank = shift - dropped.bit_length() + 1 if dropped else shift + rank
+            new_index = index >> shift
+            if new_rank > registers[new_index]:
+                registers[new_index] = new_rank
+        return HyperLogLog(precision, registers)
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """Merge other into this sketch in place and return it"""
+        if other.precision < self.precision:
+            reduced = self.reduce(other.precision)
+            self.precision, self.m, self.registers = reduced.precision, reduced.m, reduced.registers
+        elif other.precision > self.precision:
+            other = other.reduce(self.precision)
+        # byte-wise max over whole register arrays as big integers: ranks are
+        # at most 61, so each byte's top bit is free to hold "a >= b"
+        size = len(self.registers)
+        a = int.from_bytes(self.registers, "little")
+        b = int.from_bytes(other.registers, "little")
+        high = _high_bits(size)
+        a_wins = (((a | high) - b) & high) >> 7
+        mask = a_wins * 0xFF
+        self.registers = bytearray(((a & mask) | (b & ~mask)).to_bytes(size, "little"))
+        return self
+
+    def count(self) -> int:
+        """Estimated number of distinct values added"""
+        m = self.m
+        histogram = [self.registers.count(rank) for rank in range(max(self.registers) + 1)]
+        estimate = _alpha(m) * m * m / sum(n * _INVERSE_POWERS[rank] for rank, n in enumerate(histogram))
+        zeros = histogram[0]
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, precision: int, data: bytes) -> "HyperLogLog":
+        return cls(precision, data)
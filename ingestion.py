@@ -0,0 +1,207 @@
+"""
+In-process ingestion buffer that turns single events into group commits
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+from database import async_session_maker, DatabaseOperation
+
+logger = logging.getLogger(__name__)
+
+# buffer settings from the environment
+INGEST_BUFFER_ENABLED = os.getenv("INGEST_BUFFER_ENABLED", "true").lower() == "true"
+INGEST_BUFFER_SIZE = int(os.getenv("INGEST_BUFFER_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", "50"))
+INGEST_BLOCK_WHEN_FULL = os.getenv("INGEST_BLOCK_WHEN_FULL", "false").lower() == "true"
+# acknowledged events that could not be stored, one JSON object per line
+INGEST_DEAD_LETTER_PATH = os.getenv("INGEST_DEAD_LETTER_PATH", "ingest-dead-letter.jsonl")
+
+_STOP = object()
+
+
+class BufferFullError(Exception):
+    """ Raised when the buffer is full and backpressure is set to reject """
+
+
+async def write_events(events_data: list[dict]) -> list[dict]:
+    """ Default writer: store one flushed batch in its own transaction """
+    async with async_session_maker() as session:
+        db_ops = DatabaseOperation(session)
+        return await db_ops.create_events(events_data)
+
+
+class IngestionBuffer:
+    """
+    Bounded queue of pending events flushed by a background task.
+
+    A flush happens when batch_size events are waiting or max_delay seconds
+    after the first event of a batch arrived, whichever comes first. A batch
+    that fails is retried in halves down to single events, so one bad row
+    does not take the others with it; events that still fail are appended
+    to the dead-letter file, since their callers may have been answered.
+    """
+
+    def __init__(self,
+                 writer: Callable[[list[dict]], Awaitable[list[dict]]] = write_events,
+                 max_size: int = INGEST_BUFFER_SIZE,
+                 batch_size: int = INGEST_BATCH_SIZE,
+                 max_delay: float = INGEST_FLUSH_INTERVAL_MS / 1000,
+                 block_when_full: bool = INGEST_BLOCK_WHEN_FULL,
+                 dead_letter_path: str = INGEST_DEAD_LETTER_PATH):
+        self.writer = writer
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.block_when_full = block_when_full
+        self.dead_letter_path = dead_letter_path
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        # counters
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_events = 0
+        self.dead_letters = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done() and not self._closing
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        """ Start the background flush task """
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._batch_ready = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ Stop accepting events and flush everything still queued """
+        if self._task is None:
+            return
+        self._closing = True
+        # wake the flusher so a full queue has room for the stop marker
+        self._batch_ready.set()
+        await self._queue.put(_STOP)
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, event_data: dict, wait: bool = False) -> Optional[dict]:
+        """
+        Queue one event.
+
+        With wait=True the call returns the stored row's id and timestamp
+        once its batch is committed; otherwise it returns None right away.
+        """
+        if not self.running:
+            raise RuntimeError("Ingestion buffer is not running")
+
+        future = asyncio.get_running_loop().create_future() if wait else None
+        item = (event_data, future)
+        if self.block_when_full:
+            await self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                raise BufferFullError(f"Ingestion buffer is full ({self.max_size} events pending)")
+
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+        if future is not None:
+            return await future
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is _STOP:
+                break
+
+            batch = [first]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                stopping = self._drain_into(batch)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            await self._flush(batch)
+
+        # anything queued behind the stop marker by a blocked producer
+        while True:
+            leftover = []
+            self._drain_into(leftover)
+            if not leftover:
+                break
+            await self._flush(leftover)
+
+    def _drain_into(self, batch: list) -> bool:
+        """ Move queued items into batch without waiting; True if the stop marker was seen """
+        stopping = False
+        while len(batch) < self.batch_size and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is _STOP:
+                stopping = True
+                continue
+            batch.append(item)
+        return stopping
+
+    async def _flush(self, batch: list):
+        events_data = [event_data for event_data, _ in batch]
+        try:
+            created = await self.writer(events_data)
+        except Exception as e:
+            if len(batch) > 1:
+                logger.warning("Failed to flush %d buffered events, retrying in halves", len(batch), exc_info=True)
+                middle = len(batch) // 2
+                await self._flush(batch[:middle])
+                await self._flush(batch[middle:])
+                return
+            self.failed_events += 1
+            logger.exception("Buffered event cannot be stored")
+            self._dead_letter(events_data[0])
+            _, future = batch[0]
+            if future is not None and not future.done():
+                future.set_exception(e)
+            return
+
+        self.flushes += 1
+        self.flushed_events += len(batch)
+        for (_, future), row in zip(batch, created):
+            if future is not None and not future.done():
+                future.set_result(row)
+
+    def _dead_letter(self, event_data: dict):
+        try:
+            with open(self.dead_letter_path, "a") as file:
+                file.write(json.dumps(event_data, default=lambda value: value.isoformat()) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception:
+            logger.exception("Failed to dead-letter a buffered event: %r", event_data)
+            return
+        self.dead_letters += 1
+        logger.error("Dead-lettered a buffered event to %s", self.dead_letter_path)
@@ -1,9 +1,29 @@
+"""
+Create the database tables and optionally seed synthetic events
+
+Usage:
+    python init_db.py
+    python init_db.py --seed-events 100000
+"""
+
+import argparse
 import asyncio
-import os
-import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from database import create_db_and_tables, get_session, DatabaseOperations
-from models import EventCreate
-from datetime import datetime, timedelta
-import random
+import json
+
+from database import create_db_and_tables, engine
+from benchmarks.generator import EventGenerator, bulk_load
+
+
+async def main(seed_events: int, seed: int):
+    await create_db_and_tables()
+    if seed_events:
+        print(json.dumps(await bulk_load(seed_events, EventGenerator(seed=seed))))
+    await engine.dispose()
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seed-events", type=int, default=0, help="Synthetic events to load")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    args = parser.parse_args()
+    asyncio.run(main(args.seed_events, args.seed))
@@ -0,0 +1,167 @@
+"""
+Live dashboard feed: ingest-time counters pushed to subscribers at a fixed interval
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Optional
+
+from heavy_hitters import HeavyHitters, heavy_hitters
+
+logger = logging.getLogger(__name__)
+
+LIVE_ENABLED = os.getenv("LIVE_ENABLED", "true").lower() == "true"
+LIVE_INTERVAL_SECONDS = float(os.getenv("LIVE_INTERVAL_SECONDS", "1"))
+# span of the events-per-second average
+LIVE_RATE_WINDOW_SECONDS = float(os.getenv("LIVE_RATE_WINDOW_SECONDS", "10"))
+# messages buffered per subscriber; a slow one loses the oldest first
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "16"))
+LIVE_TOP_EVENTS = int(os.getenv("LIVE_TOP_EVENTS", "10"))
+# projects tracked at once, least recently active are dropped first
+LIVE_MAX_PROJECTS = int(os.getenv("LIVE_MAX_PROJECTS", "1000"))
+
+
+class LiveCounters:
+    """Running totals of one project (or of all projects) and the delta since the last tick"""
+
+    __slots__ = ("total", "pending", "history")
+
+    def __init__(self, rate_intervals: int):
+        self.total = 0
+        self.pending: Counter = Counter()
+        # events per tick, newest last
+        self.history: deque = deque(maxlen=rate_intervals)
+
+
+class LiveFeed:
+    """
+    Broadcast per-project live counters to WebSocket subscribers.
+
+    record() folds committed rows into in-memory counters. Every interval
+    one message per subscribed scope is built and serialised once, then
+    put on every subscriber's queue, so the cost of a tick does not grow
+    with subscribers beyond a queue put each and never touches the database.
+    Messages carry absolute totals next to the delta, so a subscriber that
+    drops messages catches up with the next one it receives.
+    """
+
+    def __init__(self, interval: float = LIVE_INTERVAL_SECONDS,
+                 rate_window: float = LIVE_RATE_WINDOW_SECONDS,
+                 queue_size: int = LIVE_QUEUE_SIZE,
+                 top_events: int = LIVE_TOP_EVENTS,
+                 max_projects: int = LIVE_MAX_PROJECTS,
+                 tracker: HeavyHitters = heavy_hitters):
+        self.interval = interval
+        self.rate_intervals = max(1, round(rate_window / interval))
+        self.queue_size = queue_size
+        self.top_events = top_events
+        self.max_projects = max_projects
+        self.tracker = tracker
+        # project id -> counters, None for all projects
+        self.scopes: OrderedDict[Optional[int], LiveCounters] = OrderedDict()
+        self.subscribers: dict[Optional[int], set[asyncio.Queue]] = {}
+        # last message of each scope, sent to new subscribers right away
+        self.latest: dict[Optional[int], str] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _counters(self, scope: Optional[int]) -> LiveCounters:
+        counters = self.scopes.get(scope)
+        if counters is None:
+            counters = self.scopes[scope] = LiveCounters(self.rate_intervals)
+            if len(self.scopes) > self.max_projects + 1:
+                for candidate in self.scopes:
+                    if candidate is not None and candidate not in self.subscribers:
+                        del self.scopes[candidate]
+                        self.latest.pop(candidate, None)
+                        break
+        else:
+            self.scopes.move_to_end(scope)
+        return counters
+
+    def record(self, rows: list[dict]):
+        """Ingest listener: count committed rows per project and event name"""
+        with self._lock:
+            for row in rows:
+                project_id = row.get("project_id")
+                for scope in (None, project_id) if project_id is not None else (None,):
+                    counters = self._counters(scope)
+                    counters.total += 1
+                    counters.pending[row["event_name"]] += 1
+
+    def subscribe(self, project_id: Optional[int] = None) -> asyncio.Queue:
+        """Queue receiving the JSON messages of a project, or of all projects with None"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(project_id, set()).add(queue)
+        if project_id in self.latest:
+            queue.put_nowait(self.latest[project_id])
+        return queue
+
+    def unsubscribe(self, project_id: Optional[int], queue: asyncio.Queue):
+        queues = self.subscribers.get(project_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[project_id]
+
+    def _message(self, scope: Optional[int], counters: LiveCounters, delta: Counter, now: float) -> str:
+        history = counters.history
+        return json.dumps({
+            "project_id": scope,
+            "timestamp": round(now, 3),
+            "interval_seconds": self.interval,
+            "total_events": counters.total,
+            "events": history[-1],
+            "events_per_second": round(sum(history) / (len(history) * self.interval), 3),
+            "event_counts": dict(delta),
+            "top_events": self.tracker.top("5m", self.top_events, scope) if self.tracker is not None else [],
+        }, separators=(",", ":"))
+
+    def run_once(self, now: Optional[float] = None) -> int:
+        """Close the current interval and fan its messages out; returns how many were queued"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            deltas = {}
+            for scope, counters in self.scopes.items():
+                delta, counters.pending = counters.pending, Counter()
+                counters.history.append(sum(delta.values()))
+                deltas[scope] = delta
+
+        delivered = 0
+        for scope, queues in list(self.subscribers.items()):
+            counters = self.scopes.get(scope)
+            if counters is None:
+                counters = self._counters(scope)
+                counters.history.append(0)
+            message = self.latest[scope] = self._message(scope, counters, deltas.get(scope, Counter()), now)
+            for queue in list(queues):
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(message)
+                delivered += 1
+        return delivered
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Live feed tick failed")
@@ -0,0 +1,141 @@
+"""
+Interned lookup tables for the repetitive strings of events
+
+Events store the integer ids of their user agent and IP address; the
+strings live once in user_agents / ip_addresses. Ids are resolved on ingest
+through a per-worker LRU cache, so a known value costs no round trip.
+"""
+
+import os
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import IpAddress, UserAgent
+from rollups import insert_for
+
+# distinct values per lookup table kept in memory by each worker
+LOOKUP_CACHE_SIZE = int(os.getenv("LOOKUP_CACHE_SIZE", "10000"))
+
+# first match wins, so more specific products come before the ones they imitate
+BROWSERS = (
+    ("Edge", re.compile(r"Edg(?:e|A|iOS)?/")),
+    ("Opera", re.compile(r"OPR/|Opera")),
+    ("Samsung Internet", re.compile(r"SamsungBrowser/")),
+    ("Chrome", re.compile(r"Chrome/|CriOS/")),
+    ("Firefox", re.compile(r"Firefox/|FxiOS/")),
+    ("Safari", re.compile(r"Version/.*Safari/")),
+    ("Internet Explorer", re.compile(r"MSIE |Trident/")),
+)
+OPERATING_SYSTEMS = (
+    ("iOS", re.compile(r"iPhone|iPad|iPod")),
+    ("Android", re.compile(r"Android")),
+    ("Windows", re.compile(r"Windows")),
+    ("ChromeOS", re.compile(r"CrOS")),
+    ("macOS", re.compile(r"Mac OS X|Macintosh")),
+    ("Linux", re.compile(r"Linux")),
+)
+BOT = re.compile(r"bot|crawl|spider|slurp|curl|wget|python-requests|httpx", re.IGNORECASE)
+TABLET = re.compile(r"iPad|Tablet")
+MOBILE = re.compile(r"Mobi|iPhone|iPod")
+
+
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def parse_user_agent(user_agent: str) -> tuple[Optional[str], Optional[str], Optional[str]]:
+    """(browser, os, device) of a User-Agent header; None where it is not recognised"""
+    browser = next((name for name, pattern in BROWSERS if pattern.search(user_agent)), None)
+    system = next((name for name, pattern in OPERATING_SYSTEMS if pattern.search(user_agent)), None)
+    if BOT.search(user_agent):
+        device = "bot"
+    elif TABLET.search(user_agent) or (system == "Android" and "Mobile" not in user_agent):
+        device = "tablet"
+    elif MOBILE.search(user_agent):
+        device = "mobile"
+    else:
+        device = "desktop" if system is not None else None
+    return browser, system, device
+
+
+class LookupCache:
+    """
+    LRU map from the values of a lookup table to their ids.
+
+    Only committed ids may be cached: resolve() leaves the ids it had to
+    look up or insert to the caller, who remember()s them after commit.
+    """
+
+    def __init__(self, model, max_size: int = LOOKUP_CACHE_SIZE):
+        self.model = model
+        self.max_size = max_size
+        self.ids: OrderedDict[str, int] = OrderedDict()
+
+    def _row(self, value: str) -> dict:
+        if self.model is UserAgent:
+            browser, system, device = parse_user_agent(value)
+            return {"value": value, "browser": browser, "os": system, "device": device}
+        return {"value": value}
+
+    async def resolve(self, session: AsyncSession, values: set[str]) -> tuple[dict[str, int], dict[str, int]]:
+        """Ids of values, interning new ones in the caller's transaction; returns (ids, looked up)"""
+        from sqlalchemy import select
+
+        ids = {}
+        for value in values:
+            if value in self.ids:
+                self.ids.move_to_end(value)
+                ids[value] = self.ids[value]
+        missing = values - ids.keys()
+        if not missing:
+            return ids, {}
+
+        query = select(self.model.value, self.model.id).where(self.model.value.in_(missing))
+        found = dict((await session.execute(query)).all())
+        new = sorted(missing - found.keys())
+        if new:
+            insert = insert_for(session)
+            await session.execute(
+                insert(self.model).on_conflict_do_nothing(index_elements=["value"]),
+                [self._row(value) for value in new]
+            )
+            query = select(self.model.value, self.model.id).where(self.model.value.in_(new))
+            found.update((await session.execute(query)).all())
+        ids.update(found)
+        return ids, found
+
+    def remember(self, ids: dict[str, int]):
+        for value, value_id in ids.items():
+            self.ids[value] = value_id
+            self.ids.move_to_end(value)
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+
+# event column -> cache of its lookup table; rows store <column>_id
+LOOKUPS = {
+    "user_agent": LookupCache(UserAgent),
+    "ip_address": LookupCache(IpAddress),
+}
+
+
+async def intern_lookups(session: AsyncSession, rows: list[dict]) -> list[tuple[LookupCache, dict]]:
+    """
+    Replace the user_agent / ip_address of rows with their ids in place.
+    Returns the (cache, ids) pairs to remember once the transaction commits.
+    """
+    pending = []
+    for column, cache in LOOKUPS.items():
+        values = {row[column] for row in rows if row.get(column) is not None}
+        ids, found = await cache.resolve(session, values) if values else ({}, {})
+        for row in rows:
+            value = row.pop(column, None)
+            row[f"{column}_id"] = ids.get(value) if value is not None else None
+        if found:
+            pending.append((cache, found))
+    return pending
+
+
+def remember_lookups(pending: list[tuple[LookupCache, dict]]):
+    for cache, ids in pending:
+        cache.remember(ids)
@@ -1,6 +1,9 @@
-from fastapi import FastAPI ,Depends, Request
-from pydantic import BaseModel
-from typing import Dict,Any
+from fastapi import FastAPI ,Depends, Request, Response, HTTPException, Body, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, ValidationError
+from typing import Dict,Any, Optional, Literal
+from datetime import datetime, timedelta
+import asyncio
 import uvicorn
 import os
 from contextlib import asynccontextmanager
@@ -11,12 +14,65 @@ from sqlalchemy.ext.asyncio import AsyncSession
 #import database model and functions
 from models import (
     EventCreate, EventResponse , AnalyticsSummary,
-    TopEventsResponse,Project, ProjectCreate , ProjectResponse
+    TopEventsResponse,Project, ProjectCreate , ProjectResponse,
+    EventBatchResponse, EventBatchItemResult,
+    AnalyticsTimeSeriesResponse, EventCountByDate,
+    AnalyticsQuery, AnalyticsQueryResponse, FunnelRequest, FunnelResponse, FunnelStepResult,
+    RetentionResponse, RetentionCohort, SessionMetrics
 )
 
 from database import (
-    get_session,  create_db_and_tables, DatabaseOperation
+    get_session,  create_db_and_tables, DatabaseOperation, encode_cursor,
+    register_ingest_listener
     )
+from heavy_hitters import heavy_hitters
+from property_index import parse_where_params, validate_property_key
+from export import encode_export, EXPORT_MEDIA_TYPES
+from retention import RetentionScheduler, RETENTION_ENABLED
+from ingestion import IngestionBuffer, BufferFullError, INGEST_BUFFER_ENABLED
+from sessionizer import Sessionizer, SESSIONIZER_ENABLED
+from quotas import QuotaManager, QuotaExceededError, QUOTA_ENABLED
+from live import LiveFeed, LIVE_ENABLED
+from metrics import MetricsMiddleware, METRICS_ENABLED, registry
+from spool import IngestionSpool, SPOOL_ENABLED
+from result_cache import result_cache
+
+# upper bound on events accepted by a single batch request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+
+# group-commit buffer behind POST /events/
+ingestion_buffer = IngestionBuffer()
+
+# durable on-disk spool in front of the database, loaded by consumer tasks
+ingestion_spool = IngestionSpool()
+
+# partition maintenance and Project.event_retention_days enforcement
+retention_scheduler = RetentionScheduler()
+
+# inactivity-gap sessions, written to the sessions table once closed
+sessionizer = Sessionizer()
+
+# Project.monthly_event_limit, checked in memory against leased quota
+quota_manager = QuotaManager()
+
+# counters pushed to /ws/live subscribers every LIVE_INTERVAL_SECONDS
+live_feed = LiveFeed()
+
+
+def register_ingest_listeners():
+    """
+    Feed every event this process commits to the in-memory aggregates;
+    called here and by standalone spool consumers (python spool.py)
+    """
+    register_ingest_listener(heavy_hitters.record)
+    register_ingest_listener(result_cache.record)
+    if SESSIONIZER_ENABLED:
+        register_ingest_listener(sessionizer.record)
+    if LIVE_ENABLED:
+        register_ingest_listener(live_feed.record)
+
+
+register_ingest_listeners()
 
 
 @asynccontextmanager
@@ -25,11 +81,33 @@ async def lifespan(app: FastAPI):
     #create database tables
     print("Starting analytical platform application...")
     await create_db_and_tables()
+    if INGEST_BUFFER_ENABLED:
+        await ingestion_buffer.start()
+    if SPOOL_ENABLED:
+        await ingestion_spool.start()
+    if RETENTION_ENABLED:
+        await retention_scheduler.start()
+    if SESSIONIZER_ENABLED:
+        await sessionizer.start()
+    if QUOTA_ENABLED:
+        await quota_manager.start()
+    if LIVE_ENABLED:
+        await live_feed.start()
 
     #yield control to the application
     yield
 
     #cleanup actions if any
+    await live_feed.stop()
+    await retention_scheduler.stop()
+    #flush events still waiting in the buffer
+    await ingestion_buffer.stop()
+    #fsync the spool; events not loaded yet are loaded on the next start
+    await ingestion_spool.stop()
+    #write sessions still open, including those of the flushed events
+    await sessionizer.stop()
+    #save quota usage and hand unspent leases back to other workers
+    await quota_manager.stop()
     print("Application shutdown complete.")
 
 
@@ -41,35 +119,113 @@ app = FastAPI(
     version = "1.0.0",
     lifespan = lifespan,
 )
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
     
 
 @app.get("/")
 async def read_root():
     """ Health Check Endpoint
     """
-    return {"message": "Welcome to the FastAPI Event Analytics Platform! ",
-            "version" : "1.0.0",
+    return {"message": f"Welcome to the FastAPI Event Analytics Platform! version {app.version}",
+            "version" : app.version,
             "database": "Connected" if os.getenv("DATABASE_URL") else "Not Connected"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """ Statement, pool and route metrics in the Prometheus text format """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/events/" , response_model = dict)
 async def create_event(
     event: EventCreate,
     request : Request,
+    response: Response,
+    wait: bool = False,
     session:AsyncSession = Depends(get_session)):
     """
-      Creating a new event with database persistence
+      Creating a new event with database persistence.
+      While the ingestion buffer is running the event is group-committed
+      with others: the call returns 202 as soon as it is queued, or waits
+      for the commit and returns the event id when wait=true.
+      While the spool is running, calls without wait=true return 202 once
+      the event is fsynced to the spool, whether or not the database is up.
+      Events over the project's monthly limit are rejected with 429.
     """
+    headers = {}
+    if QUOTA_ENABLED:
+        try:
+            warning = quota_manager.check(event.project_id)
+        except QuotaExceededError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        if warning is not None:
+            headers["X-Quota-Warning"] = f"{warning:.0%} of monthly event limit used"
+            response.headers.update(headers)
+
+    #get client metadata
+    ip_address = request.client.host
+    user_agent = request.headers.get("User-Agent", "Unknown")
+
+    if ingestion_spool.running and not wait:
+        event_data = event.model_dump()
+        event_data["ip_address"] = ip_address
+        event_data["user_agent"] = user_agent
+        try:
+            await ingestion_spool.append(event_data)
+        except BufferFullError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error spooling event: {str(e)}"
+            )
+        return JSONResponse(
+            status_code=202,
+            content={
+                "status": "accepted",
+                "message": "Event spooled for ingestion",
+            },
+            headers=headers
+        )
+
+    if ingestion_buffer.running:
+        event_data = event.model_dump()
+        event_data["ip_address"] = ip_address
+        event_data["user_agent"] = user_agent
+        try:
+            created = await ingestion_buffer.submit(event_data, wait=wait)
+        except BufferFullError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error creating event: {str(e)}"
+            )
+
+        if created is None:
+            return JSONResponse(
+                status_code=202,
+                content={
+                    "status": "accepted",
+                    "message": "Event queued for ingestion",
+                },
+                headers=headers
+            )
+        return {
+               "status": "success",
+                "message": "Event created successfully",
+                "event_id": created["id"],
+                "timestamp": created["timestamp"].isoformat(),
+        }
+
     try:
         db_ops = DatabaseOperation(session)
-
-        #get client metadata
-        ip_address = request.client.host
-        user_agent = request.headers.get("User-Agent", "Unknown")
    
         #create event in the database
         event_response = await db_ops.create_event(
-            event_data=event_data,
+            event_data=event.model_dump(),
             ip_address=ip_address,
             user_agent=user_agent
         )
@@ -88,26 +244,131 @@ async def create_event(
         )
 
 
+@app.post("/events/batch", response_model=EventBatchResponse)
+async def create_events_batch(
+    request: Request,
+    events: list[Dict[str, Any]] = Body(...),
+    session: AsyncSession = Depends(get_session)):
+    """
+      Ingest a batch of events in a single transaction.
+      Each item is validated on its own; invalid items are rejected
+      without failing the rest of the batch, as are events over
+      their project's monthly limit. Items whose event_uuid is already
+      stored are reported as duplicates with the stored event's id.
+    """
+    if len(events) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large: {len(events)} events (max {MAX_BATCH_SIZE})"
+        )
+
+    results = [None] * len(events)
+    valid_indexes = []
+    valid_events = []
+    for index, payload in enumerate(events):
+        try:
+            event = EventCreate.model_validate(payload)
+            if QUOTA_ENABLED:
+                quota_manager.check(event.project_id)
+            valid_events.append(event.model_dump())
+            valid_indexes.append(index)
+        except QuotaExceededError as e:
+            results[index] = EventBatchItemResult(index=index, status="rejected", error=str(e))
+        except ValidationError as e:
+            results[index] = EventBatchItemResult(
+                index=index,
+                status="rejected",
+                error="; ".join(
+                    f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+                )
+            )
+
+    try:
+        db_ops = DatabaseOperation(session)
+        created = await db_ops.create_events(
+            events_data=valid_events,
+            ip_address=request.client.host,
+            user_agent=request.headers.get("User-Agent", "Unknown")
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error creating events: {str(e)}"
+        )
+
+    duplicates = 0
+    for index, row in zip(valid_indexes, created):
+        status = "duplicate" if row.get("duplicate") else "accepted"
+        duplicates += status == "duplicate"
+        results[index] = EventBatchItemResult(index=index, status=status, event_id=row["id"])
+
+    return EventBatchResponse(
+        accepted=len(created) - duplicates,
+        rejected=len(events) - len(created),
+        duplicates=duplicates,
+        results=results,
+    )
+
+
 
 
 
 @app.get("/events/",response_model=dict)
 async def get_events(
+    request: Request,
     limit:int =10,
     offset:int = 0,
+    cursor: Optional[str] = None,
+    total: Literal["exact", "estimate", "none"] = "estimate",
+    event_name: Optional[str] = None,
+    user_id: Optional[str] = None,
+    session_id: Optional[str] = None,
     session: AsyncSession = Depends(get_session)
 ):
-    """ Get recent event with pagination
+    """ Get recent event with pagination.
+        Pass the returned next_cursor back as cursor to fetch the next page;
+        total selects an exact count, a cheap estimate or no count at all;
+        with filters the estimate is null, since it counts every event.
+        Filter on properties with where[properties.<key>]=<value>.
     """
     try:
         db_ops = DatabaseOperation(session)
-        events = await db_ops.get_events(limit=limit, offset=offset)
-        total_count = await db_ops.get_total_events_count()
+        filters = {
+            "event_name": event_name,
+            "user_id": user_id,
+            "session_id": session_id,
+            "property_filters": parse_where_params(request.query_params),
+        }
+        try:
+            events = await db_ops.get_events(
+                limit=limit + 1,
+                offset=offset,
+                cursor=cursor,
+                **filters
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        next_cursor = None
+        if len(events) > limit:
+            events = events[:limit]
+            next_cursor = encode_cursor(events[-1].timestamp, events[-1].id)
+
+        # the estimate only covers the whole table, so filtered listings get no total from it
+        filtered = any(filters.values())
+        if total == "exact":
+            total_count = await db_ops.get_event_count(**filters)
+        elif total == "estimate" and not filtered:
+            total_count = await db_ops.get_event_count_estimate()
+        else:
+            total_count = None
 
         return {
-            "totalevents": total_count,
+            "total_events": total_count,
+            "total_type": total,
             "limit": limit,
             "offset": offset,
+            "next_cursor": next_cursor,
             "events": [
                 {
                     "id": event.id,
@@ -122,6 +383,8 @@ async def get_events(
                 } for event in events
             ]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -130,25 +393,86 @@ async def get_events(
    
 
 
+@app.get("/events/export")
+async def export_events(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    project_id: Optional[int] = None,
+    event_name: Optional[str] = None,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Stream events as NDJSON or CSV in timestamp order.
+        Rows are read through a server-side cursor and sent as chunks,
+        so memory use does not grow with the size of the range.
+    """
+    db_ops = DatabaseOperation(session)
+    partitions = db_ops.stream_events(
+        start_date=start_date,
+        end_date=end_date,
+        project_id=project_id,
+        event_name=event_name
+    )
+    return StreamingResponse(
+        encode_export(partitions, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="events.{format}"'}
+    )
+
+
+@app.post("/events/properties/{key}/promote", response_model=dict)
+async def promote_event_property(
+    key: str,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Index an event property for where[properties.<key>] filters
+        by copying it into a generated column
+    """
+    try:
+        validate_property_key(key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        db_ops = DatabaseOperation(session)
+        promoted = await db_ops.promote_property(key)
+        return {"key": promoted.key, "column_name": promoted.column_name}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error promoting property: {str(e)}"
+        )
+
+
 @app.get("/analytics/summary/" , response_model=AnalyticsSummary)
 async def get_analytics_summary(
+    request: Request,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    project_id: Optional[int] = None,
+    exact: bool = False,
     session: AsyncSession = Depends(get_session),
 ):
-    """ Get analytics summary
+    """ Get analytics summary, optionally scoped to a time range and project.
+        Served from rollups and HyperLogLog estimates unless exact=true.
+        Cached until the next ingestion; supports If-None-Match.
     """
-    try:
+    async def compute():
         db_ops = DatabaseOperation(session)
-        total_events = await db_ops.get_event_count()
-        unique_users = await db_ops.get_unique_users_count()
-        unique_sessions = await db_ops.get_unique_sessions_count()
-        data_range = await db_ops.get_data_range()
+        summary = await db_ops.get_summary(
+            start_date=start_date,
+            end_date=end_date,
+            project_id=project_id,
+            exact=exact
+        )
+        return AnalyticsSummary(**summary)
 
-        return {
-        "total_events": "Analytics summary",
-        "unique_users": len(events_store),
-        "unique_sessions": unique_users,
-        "data_range": events_type
-    }
+    try:
+        return await result_cache.respond(
+            request, session, "summary",
+            {"start_date": start_date, "end_date": end_date, "project_id": project_id, "exact": exact},
+            end_date, compute
+        )
 
     except Exception as ex:
         raise HTTPException(
@@ -157,26 +481,233 @@ async def get_analytics_summary(
         )
     
 
+@app.get("/analytics/timeseries", response_model=AnalyticsTimeSeriesResponse)
+async def get_analytics_timeseries(
+    request: Request,
+    period: Literal["minute", "hour", "day"] = "day",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    event_name: Optional[str] = None,
+    project_id: Optional[int] = None,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Get event counts per time bucket, read from the rollup tables.
+        Defaults to the last 30 days. Cached until the next ingestion;
+        supports If-None-Match.
+    """
+    async def compute():
+        end = end_date or datetime.utcnow()
+        start = start_date or end - timedelta(days=30)
+
+        db_ops = DatabaseOperation(session)
+        points = await db_ops.get_event_timeseries(
+            period=period,
+            start_date=start,
+            end_date=end,
+            event_name=event_name,
+            project_id=project_id
+        )
+
+        return AnalyticsTimeSeriesResponse(
+            period=period,
+            data=[EventCountByDate(**point) for point in points],
+            total_events=sum(point["count"] for point in points)
+        )
+
+    try:
+        # keyed on the dates as given: defaulted ones are open and expire with the cache TTL
+        return await result_cache.respond(
+            request, session, "timeseries",
+            {"period": period, "start_date": start_date, "end_date": end_date,
+             "event_name": event_name, "project_id": project_id},
+            end_date, compute
+        )
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error fetching time series: {str(e)}"
+        )
+
+
+@app.post("/analytics/query", response_model=AnalyticsQueryResponse)
+async def run_analytics_query(
+    query: AnalyticsQuery,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Run an ad-hoc analytics query: filters, group-by columns, metrics
+        and an optional time grain, evaluated with vectorized array operations.
+    """
+    try:
+        db_ops = DatabaseOperation(session)
+        rows = await db_ops.run_query(query)
+        return AnalyticsQueryResponse(rows=rows)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error running analytics query: {str(e)}"
+        )
+
+
+@app.post("/analytics/funnel", response_model=FunnelResponse)
+async def get_funnel(
+    funnel: FunnelRequest,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Conversion funnel: how many users performed each step in order,
+        within window_seconds of the first, and the median time between steps.
+    """
+    try:
+        db_ops = DatabaseOperation(session)
+        steps = await db_ops.get_funnel(
+            steps=funnel.steps,
+            window_seconds=funnel.window_seconds,
+            start_date=funnel.start_date,
+            end_date=funnel.end_date,
+            project_id=funnel.project_id
+        )
+        return FunnelResponse(
+            window_seconds=funnel.window_seconds,
+            steps=[FunnelStepResult(**step) for step in steps]
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error computing funnel: {str(e)}"
+        )
+
+
+@app.get("/analytics/retention", response_model=RetentionResponse)
+async def get_retention(
+    period: Literal["day", "week"] = "week",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    project_id: Optional[int] = None,
+    max_periods: int = 8,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Cohort retention: users first seen in each period and how many of
+        them came back N periods later, from per-day active-user bitmaps.
+        Defaults to the cohorts of the last 8 periods.
+    """
+    try:
+        end_date = end_date or datetime.utcnow()
+        start_date = start_date or end_date - (timedelta(weeks=7) if period == "week" else timedelta(days=7))
+
+        db_ops = DatabaseOperation(session)
+        cohorts = await db_ops.get_retention(
+            period=period,
+            start_date=start_date,
+            end_date=end_date,
+            project_id=project_id,
+            max_periods=max_periods
+        )
+        return RetentionResponse(period=period, cohorts=[RetentionCohort(**cohort) for cohort in cohorts])
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error computing retention: {str(e)}"
+        )
+
+
+@app.get("/analytics/sessions", response_model=SessionMetrics)
+async def get_session_metrics(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    project_id: Optional[int] = None,
+    session: AsyncSession = Depends(get_session)
+):
+    """ Session metrics from the sessions table: count, average duration
+        and depth, bounce rate and the most common entry and exit events.
+        Only closed sessions are included.
+    """
+    try:
+        db_ops = DatabaseOperation(session)
+        metrics = await db_ops.get_session_metrics(
+            start_date=start_date,
+            end_date=end_date,
+            project_id=project_id
+        )
+        return SessionMetrics(**metrics)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error fetching session metrics: {str(e)}"
+        )
+
+
 @app.get("/events/top/", response_model= list[TopEventsResponse])
 async def get_top_events(
+    request: Request,
     limit: int = 10,
+    window: Optional[Literal["5m", "1h", "24h"]] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    project_id: Optional[int] = None,
+    exact: bool = False,
     session: AsyncSession = Depends(get_session)
 ):
-    """ Get top events by count
+    """ Get top events by count.
+        With window the answer comes from the in-memory sliding-window
+        trackers (counts overstated by at most max_error). Otherwise it is
+        computed in the database for the given range; unique users are
+        HyperLogLog estimates unless exact=true. Database answers are cached
+        until the next ingestion and support If-None-Match.
     """
-    try:
+    async def compute():
         db_ops = DatabaseOperation(session)
-        top_events = await db_ops.get_top_events(limit=limit)
-        
+        top_events = await db_ops.get_top_events(
+            limit=limit,
+            exact=exact,
+            start_date=start_date,
+            end_date=end_date,
+            project_id=project_id
+        )
         return [TopEventsResponse(**event) for event in top_events]
-        
+
+    try:
+        if window is not None:
+            top_events = heavy_hitters.top(window, limit=limit, project_id=project_id)
+            return [TopEventsResponse(**event) for event in top_events]
+
+        return await result_cache.respond(
+            request, session, "top_events",
+            {"limit": limit, "start_date": start_date, "end_date": end_date,
+             "project_id": project_id, "exact": exact},
+            end_date, compute
+        )
+
 
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Error fetching top events: {str(e)}"
         )
-    
+
+
+@app.websocket("/ws/live")
+async def live_updates(websocket: WebSocket, project_id: Optional[int] = None):
+    """ Push live counters, events per second and top events of a project
+        (all projects without project_id) every LIVE_INTERVAL_SECONDS.
+        Messages are shared by all subscribers and built from in-memory
+        aggregates only.
+    """
+    await websocket.accept()
+    queue = live_feed.subscribe(project_id)
+
+    async def forward():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    sender = asyncio.create_task(forward())
+    try:
+        # nothing is expected from the client; this only watches for the disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        sender.cancel()
+        live_feed.unsubscribe(project_id, queue)
+
 # Error handlers
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
@@ -0,0 +1,245 @@
+"""
+Prometheus-text metrics for SQL statements, the connection pool and HTTP routes
+"""
+
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+
+slow_query_logger = logging.getLogger("sql.slow")
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# statements slower than this are logged and counted; 0 turns the log off
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+# upper bounds in seconds, from sub-millisecond point lookups to multi-second scans
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """A named metric with one series per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for values, value in sorted(self.series.items()):
+                lines.extend(self._render_series(values, value))
+        return lines
+
+    def _render_series(self, values: tuple, value) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, values)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def dec(self, *values, amount: float = 1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, *values, value: float):
+        with self._lock:
+            self.series[values] = value
+
+
+class Histogram(Metric):
+    """Bucketed observations; each series is [count per bucket (+Inf last), sum]"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *values, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def _render_series(self, values: tuple, value) -> list[str]:
+        counts, total = value
+        names = self.labelnames + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(names, values + (bound,))} {cumulative}")
+        labels = _labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+SQL_DURATION = registry.register(Histogram(
+    "db_statement_duration_seconds", "SQL statement execution time", ("operation",)))
+SQL_SLOW = registry.register(Counter(
+    "db_slow_statements_total", "SQL statements slower than SLOW_QUERY_MS", ("operation",)))
+SQL_ERRORS = registry.register(Counter(
+    "db_statement_errors_total", "SQL statements that raised", ("operation",)))
+POOL_WAIT = registry.register(Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection", ("pool",)))
+POOL_CHECKED_OUT = registry.register(Gauge(
+    "db_pool_connections_checked_out", "Connections currently checked out of the pool", ("pool",)))
+POOL_CAPACITY = registry.register(Gauge(
+    "db_pool_connections_max", "Connections the pool may open, overflow included", ("pool",)))
+POOL_TIMEOUTS = registry.register(Counter(
+    "db_pool_timeouts_total", "Checkouts that gave up after the pool timeout", ("pool",)))
+HTTP_DURATION = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request handling time by route template", ("method", "route", "status")))
+HTTP_IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", ("method",)))
+
+OPERATION = re.compile(r"\s*(?:WITH\b.*?\)\s*)?(\w+)", re.DOTALL)
+
+
+def statement_operation(statement: str) -> str:
+    """SELECT, INSERT, UPDATE, ... of a statement, lower-cased"""
+    match = OPERATION.match(statement)
+    return match.group(1).lower() if match else "other"
+
+
+def instrument_engine(engine, pool: str = "primary"):
+    """
+    Time every statement and pool checkout of an (async) engine; pool
+    metrics are labelled with pool. Listeners are only attached here, so
+    nothing runs when metrics are off.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+    sync_engine = getattr(engine, "sync_engine", engine)
+    max_overflow = getattr(sync_engine.pool, "_max_overflow", -1)
+    if max_overflow >= 0:
+        # checked out / max is the pool's saturation; unbounded pools have no max
+        POOL_CAPACITY.set(pool, value=sync_engine.pool.size() + max_overflow)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+        operation = statement_operation(statement)
+        SQL_DURATION.observe(operation, value=elapsed)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            SQL_SLOW.inc(operation)
+            slow_query_logger.warning(
+                "Slow %s statement (%.1f ms%s): %s", operation, elapsed * 1000,
+                ", executemany" if executemany else "", " ".join(statement.split())[:2000]
+            )
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("statement_started") if context.connection is not None else None
+        if started:
+            started.pop()
+        if context.statement is not None:
+            SQL_ERRORS.inc(statement_operation(context.statement))
+
+    # pool events registered on the engine follow it across dispose()
+    @event.listens_for(sync_engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKED_OUT.inc(pool)
+
+    @event.listens_for(sync_engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        POOL_CHECKED_OUT.dec(pool)
+
+    # pools have no event before a checkout starts waiting, so time the call itself
+    raw_connection = sync_engine.raw_connection
+
+    def timed_raw_connection():
+        started = time.perf_counter()
+        try:
+            return raw_connection()
+        except PoolTimeoutError:
+            POOL_TIMEOUTS.inc(pool)
+            raise
+        finally:
+            POOL_WAIT.observe(pool, value=time.perf_counter() - started)
+
+    sync_engine.raw_connection = timed_raw_connection
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording per-route latency and in-flight requests.
+    Routes are labelled by their path template, so ids in paths do not
+    create new series; unmatched paths share one label.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec(method)
+            route = scope.get("route")
+            HTTP_DURATION.observe(method, getattr(route, "path", "unmatched"), str(status),
+                                  value=time.perf_counter() - started)
@@ -0,0 +1,58 @@
+"""secondary indexes on events and JSONB properties
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+EVENT_INDEXES = {
+    "ix_events_timestamp_id": ["timestamp", "id"],
+    "ix_events_project_timestamp": ["project_id", "timestamp"],
+    "ix_events_event_name_timestamp": ["event_name", "timestamp"],
+    "ix_events_user_id_timestamp": ["user_id", "timestamp"],
+    "ix_events_session_id_timestamp": ["session_id", "timestamp"],
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    columns = {column["name"] for column in sa.inspect(bind).get_columns("events")}
+    if "project_id" not in columns:
+        op.add_column("events", sa.Column("project_id", sa.Integer(), nullable=True))
+
+    for name, index_columns in EVENT_INDEXES.items():
+        op.create_index(name, "events", index_columns, if_not_exists=True)
+
+    if bind.dialect.name == "postgresql":
+        for column in ("properties", "user_properties"):
+            op.execute(f"ALTER TABLE events ALTER COLUMN {column} TYPE jsonb USING {column}::jsonb")
+        op.create_index(
+            "ix_events_properties_gin", "events", ["properties"],
+            postgresql_using="gin", postgresql_ops={"properties": "jsonb_path_ops"},
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        op.drop_index("ix_events_properties_gin", table_name="events", if_exists=True)
+        for column in ("properties", "user_properties"):
+            op.execute(f"ALTER TABLE events ALTER COLUMN {column} TYPE json USING {column}::json")
+
+    for name in EVENT_INDEXES:
+        op.drop_index(name, table_name="events", if_exists=True)
@@ -0,0 +1,86 @@
+"""intern events.user_agent and events.ip_address in lookup tables
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from lookups import parse_user_agent
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# events column -> (lookup table, length of the value)
+LOOKUP_COLUMNS = {
+    "user_agent": ("user_agents", 512),
+    "ip_address": ("ip_addresses", 45),
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = set(inspector.get_table_names())
+    if "user_agents" not in tables:
+        op.create_table(
+            "user_agents",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("value", sa.String(512), nullable=False, unique=True),
+            sa.Column("browser", sa.String(64), nullable=True),
+            sa.Column("os", sa.String(64), nullable=True),
+            sa.Column("device", sa.String(16), nullable=True),
+        )
+    if "ip_addresses" not in tables:
+        op.create_table(
+            "ip_addresses",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("value", sa.String(45), nullable=False, unique=True),
+        )
+
+    columns = {column["name"] for column in inspector.get_columns("events")}
+    for column, (table, _) in LOOKUP_COLUMNS.items():
+        if f"{column}_id" not in columns:
+            op.add_column("events", sa.Column(f"{column}_id", sa.Integer(), nullable=True))
+        if column not in columns:
+            continue
+        op.execute(
+            f"INSERT INTO {table} (value) SELECT DISTINCT {column} FROM events "
+            f"WHERE {column} IS NOT NULL AND {column} NOT IN (SELECT value FROM {table})"
+        )
+        op.execute(
+            f"UPDATE events SET {column}_id = (SELECT id FROM {table} WHERE value = events.{column}) "
+            f"WHERE {column} IS NOT NULL"
+        )
+        op.drop_column("events", column)
+
+    user_agents = sa.table(
+        "user_agents", sa.column("id"), sa.column("value"),
+        sa.column("browser"), sa.column("os"), sa.column("device"),
+    )
+    for row in bind.execute(sa.select(user_agents.c.id, user_agents.c.value).where(user_agents.c.device.is_(None))):
+        browser, system, device = parse_user_agent(row.value)
+        bind.execute(user_agents.update().where(user_agents.c.id == row.id).values(
+            browser=browser, os=system, device=device
+        ))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for column, (table, length) in LOOKUP_COLUMNS.items():
+        op.add_column("events", sa.Column(column, sa.String(length), nullable=True))
+        op.execute(
+            f"UPDATE events SET {column} = (SELECT value FROM {table} WHERE id = events.{column}_id) "
+            f"WHERE {column}_id IS NOT NULL"
+        )
+        op.drop_column("events", f"{column}_id")
+        op.drop_table(table)
@@ -0,0 +1,37 @@
+"""client-supplied events.event_uuid for duplicate detection
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    columns = {column["name"] for column in sa.inspect(bind).get_columns("events")}
+    if "event_uuid" not in columns:
+        op.add_column("events", sa.Column("event_uuid", sa.String(64), nullable=True))
+    op.create_index(
+        "ix_events_event_uuid", "events", ["event_uuid", "timestamp"], unique=True,
+        postgresql_where=sa.text("event_uuid IS NOT NULL"), sqlite_where=sa.text("event_uuid IS NOT NULL"),
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_events_event_uuid", table_name="events", if_exists=True)
+    op.drop_column("events", "event_uuid")
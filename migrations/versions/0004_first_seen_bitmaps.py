@@ -0,0 +1,82 @@
+"""first-seen days and bitmaps of users for cohort retention
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 00:00:00
+
+"""
+from collections import defaultdict
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from cohorts import ALL_PROJECTS
+from roaring import RoaringBitmap
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    tables = set(sa.inspect(bind).get_table_names())
+    if "user_first_seen" not in tables:
+        op.create_table(
+            "user_first_seen",
+            sa.Column("project_id", sa.Integer(), primary_key=True),
+            sa.Column("user_index", sa.Integer(), primary_key=True),
+            sa.Column("day", sa.DateTime(), nullable=False),
+        )
+    if "first_seen_bitmaps" not in tables:
+        op.create_table(
+            "first_seen_bitmaps",
+            sa.Column("project_id", sa.Integer(), primary_key=True),
+            sa.Column("day", sa.DateTime(), primary_key=True, index=True),
+            sa.Column("bitmap", sa.LargeBinary(), nullable=False),
+        )
+    if "active_user_bitmaps" not in tables:
+        return
+
+    # replay the active-user bitmaps oldest first; whoever was not seen before is new that day
+    active = sa.table("active_user_bitmaps", sa.column("project_id"), sa.column("day"), sa.column("bitmap"))
+    first_seen = sa.table("user_first_seen", sa.column("project_id"), sa.column("user_index"), sa.column("day"))
+    bitmaps = sa.table("first_seen_bitmaps", sa.column("project_id"), sa.column("day"), sa.column("bitmap"))
+    seen = defaultdict(RoaringBitmap)
+    for day, rows in _by_day(bind.execute(sa.select(active).order_by(active.c.day, active.c.project_id))):
+        new_users = {}
+        for project_id, bitmap in rows:
+            for scope in (project_id, ALL_PROJECTS):
+                users = bitmap - seen[scope] - new_users.get(scope, RoaringBitmap())
+                if len(users):
+                    new_users[scope] = new_users[scope] | users if scope in new_users else users
+        for scope, users in new_users.items():
+            seen[scope] = seen[scope] | users
+            bind.execute(bitmaps.insert().values(project_id=scope, day=day, bitmap=users.to_bytes()))
+            bind.execute(first_seen.insert(), [
+                {"project_id": scope, "user_index": user, "day": day} for user in users
+            ])
+
+
+def _by_day(rows):
+    """Group (project_id, day, bitmap) rows ordered by day into (day, [(project_id, bitmap)])"""
+    current, group = None, []
+    for project_id, day, data in rows:
+        if group and day != current:
+            yield current, group
+            group = []
+        current = day
+        group.append((project_id, RoaringBitmap.from_bytes(data)))
+    if group:
+        yield current, group
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("first_seen_bitmaps")
+    op.drop_table("user_first_seen")
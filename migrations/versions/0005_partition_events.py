@@ -0,0 +1,81 @@
+"""convert an unpartitioned events table to daily range partitions, event_uuid unique per timestamp
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from models import Event
+from partitions import PARTITIONED_QUERY, create_partitioned_events_table
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+OLD_TABLE = "events_unpartitioned"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql" or bind.execute(PARTITIONED_QUERY).scalar():
+        _widen_event_uuid_index(bind)
+        return
+
+    # move the old table, its key, indexes and id sequence out of the way
+    op.rename_table("events", OLD_TABLE)
+    inspector = sa.inspect(bind)
+    primary_key = inspector.get_pk_constraint(OLD_TABLE)["name"]
+    if primary_key:
+        op.execute(f"ALTER TABLE {OLD_TABLE} RENAME CONSTRAINT {primary_key} TO {OLD_TABLE}_pkey")
+    for index in inspector.get_indexes(OLD_TABLE):
+        op.execute(f'ALTER INDEX "{index["name"]}" RENAME TO "{index["name"]}_unpartitioned"')
+    sequence = bind.execute(sa.text(f"SELECT pg_get_serial_sequence('{OLD_TABLE}', 'id')")).scalar()
+    if sequence:
+        op.execute(f"ALTER SEQUENCE {sequence} RENAME TO {OLD_TABLE}_id_seq")
+
+    # the partitioned parent with its default partition, then the promoted property columns
+    create_partitioned_events_table(bind)
+    promoted = bind.execute(sa.text("SELECT key, column_name FROM promoted_properties")).all()
+    for key, name in promoted:
+        op.execute(
+            f"ALTER TABLE events ADD COLUMN IF NOT EXISTS {name} text "
+            f"GENERATED ALWAYS AS (properties ->> '{key}') STORED"
+        )
+        op.execute(f'CREATE INDEX IF NOT EXISTS ix_events_{name} ON events ({name}, "timestamp")')
+
+    # everything lands in the default partition; the retention scheduler
+    # creates the daily partitions and moves their rows out of it
+    columns = ", ".join(f'"{column.name}"' for column in Event.__table__.columns)
+    op.execute(f"INSERT INTO events ({columns}) SELECT {columns} FROM {OLD_TABLE}")
+    op.execute(
+        "SELECT setval(pg_get_serial_sequence('events', 'id'), "
+        "COALESCE((SELECT max(id) FROM events), 0) + 1, false)"
+    )
+    op.execute("DELETE FROM event_partitions")
+    op.drop_table(OLD_TABLE)
+
+
+def _widen_event_uuid_index(bind):
+    """Databases upgraded through an earlier 0003 have event_uuid unique on its own"""
+    for index in sa.inspect(bind).get_indexes("events"):
+        if index["name"] == "ix_events_event_uuid" and index["column_names"] == ["event_uuid"]:
+            op.drop_index("ix_events_event_uuid", table_name="events")
+            op.create_index(
+                "ix_events_event_uuid", "events", ["event_uuid", "timestamp"], unique=True,
+                postgresql_where=sa.text("event_uuid IS NOT NULL"), sqlite_where=sa.text("event_uuid IS NOT NULL"),
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # the partitioned table keeps working for older revisions; nothing to undo
+    pass
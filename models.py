@@ -3,9 +3,14 @@ Database models based on SQLModel
 """
 
 from datetime import datetime
-from typing import Dict , Optional, Any
+from typing import Dict , Optional, Any, Literal
 from sqlmodel import Field, SQLModel, Column , JSON
-from sqlalchemy import func , DateTime
+from sqlalchemy import func , DateTime, Index, LargeBinary, select, text
+from sqlalchemy.orm import column_property
+from sqlalchemy.dialects.postgresql import JSONB
+
+# JSONB on PostgreSQL so properties can be GIN-indexed and queried with @>
+JSONType = JSON().with_variant(JSONB(), "postgresql")
 
 class EventBase(SQLModel):
     """ Base model for API request/response """
@@ -13,14 +18,38 @@ class EventBase(SQLModel):
     event_name: str = Field(max_length=255, description="Name of the event")
     user_id: Optional[str] = Field(default=None, max_length=255, description="User Identifier")
     session_id : Optional[str] = Field(default=None, max_length=255, description="Session Identifier")
-    properties: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON) , description="Event properties ")
-    user_properties: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON) , description="User properties")
+    project_id: Optional[int] = Field(default=None, description="Project the event belongs to")
+    event_uuid: Optional[str] = Field(default=None, max_length=64,
+                                      description="Client-generated id; retries with the same id are stored once")
+    properties: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSONType) , description="Event properties ")
+    user_properties: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSONType) , description="User properties")
 
 
 
 class Event(EventBase, table=True):
     """ Event  table model """
     __tablename__ = "events"
+    __table_args__ = (
+        # matches the ORDER BY of keyset pagination in get_events
+        Index("ix_events_timestamp_id", "timestamp", "id"),
+        # lets per-project summaries scope by time without scanning other projects
+        Index("ix_events_project_timestamp", "project_id", "timestamp"),
+        # filters on a column combined with a time range or newest-first order
+        Index("ix_events_event_name_timestamp", "event_name", "timestamp"),
+        Index("ix_events_user_id_timestamp", "user_id", "timestamp"),
+        Index("ix_events_session_id_timestamp", "session_id", "timestamp"),
+        # confirms suspected duplicates and rejects concurrent retries; events without a uuid stay out of it.
+        # The timestamp is part of it because a partitioned table can only enforce keys holding the partition key
+        Index(
+            "ix_events_event_uuid", "event_uuid", "timestamp", unique=True,
+            postgresql_where=text("event_uuid IS NOT NULL"), sqlite_where=text("event_uuid IS NOT NULL")
+        ),
+        # containment queries on properties (PostgreSQL only)
+        Index(
+            "ix_events_properties_gin", "properties",
+            postgresql_using="gin", postgresql_ops={"properties": "jsonb_path_ops"}
+        ).ddl_if(dialect="postgresql"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     timestamp : datetime = Field(
@@ -28,9 +57,9 @@ class Event(EventBase, table=True):
         sa_column=Column(DateTime(timezone=True),server_default=func.now()),
         description="Event timestamp")
     
-    #Meta data fields
-    ip_address: Optional[str] = Field(default=None, max_length=45, description="IP Address of the user")
-    user_agent: Optional[str] = Field(default=None, max_length=512, description="User Agent of the user")
+    #Meta data fields, interned in lookup tables; read back as ip_address and user_agent
+    ip_address_id: Optional[int] = Field(default=None, description="IpAddress id of the user's address")
+    user_agent_id: Optional[int] = Field(default=None, description="UserAgent id of the user's agent")
 
     # processing metadata
     created_at: datetime = Field(
@@ -38,11 +67,56 @@ class Event(EventBase, table=True):
         sa_column=Column(DateTime(timezone=True), server_default=func.now())
     )
 
+
+class UserAgent(SQLModel, table=True):
+    """ Distinct User-Agent header with its parsed browser, OS and device """
+    __tablename__ = "user_agents"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    value: str = Field(max_length=512, unique=True, description="User-Agent header")
+    browser: Optional[str] = Field(default=None, max_length=64, description="Browser family")
+    os: Optional[str] = Field(default=None, max_length=64, description="Operating system family")
+    device: Optional[str] = Field(default=None, max_length=16, description="desktop, mobile, tablet or bot")
+
+
+class IpAddress(SQLModel, table=True):
+    """ Distinct client IP address """
+    __tablename__ = "ip_addresses"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    value: str = Field(max_length=45, unique=True, description="IPv4 or IPv6 address")
+
+
+# the interned strings load with every Event, so ORM reads are unchanged
+Event.__mapper__.add_property("ip_address", column_property(
+    select(IpAddress.value).where(IpAddress.id == Event.ip_address_id).correlate_except(IpAddress).scalar_subquery()
+))
+Event.__mapper__.add_property("user_agent", column_property(
+    select(UserAgent.value).where(UserAgent.id == Event.user_agent_id).correlate_except(UserAgent).scalar_subquery()
+))
+
+
 class EventCreate(EventBase):
     """ Event creation model for API request """
     timestamp: Optional[datetime] = None
 
 
+class EventBatchItemResult(SQLModel):
+    """ Per-item result of a batch ingestion request """
+    index: int = Field(description="Position of the event in the submitted batch")
+    status: str = Field(description="accepted, duplicate or rejected")
+    event_id: Optional[int] = Field(default=None, description="Id assigned to an accepted event, or of the stored duplicate")
+    error: Optional[str] = Field(default=None, description="Reason a rejected event was not stored")
+
+
+class EventBatchResponse(SQLModel):
+    """ Batch ingestion response model """
+    accepted: int = Field(description="Number of events stored")
+    rejected: int = Field(description="Number of events that failed validation or were over quota")
+    duplicates: int = Field(default=0, description="Number of events already stored under their event_uuid")
+    results: list[EventBatchItemResult] = Field(default_factory=list, description="Per-item results in request order")
+
+
 class EventResponse(EventBase):
     """ Event response model for API response """
     user_id : int
@@ -51,6 +125,134 @@ class EventResponse(EventBase):
     ip_address: Optional[str] = None
 
 
+class EventRollupBase(SQLModel):
+    """ Base model for pre-aggregated event counts per time bucket """
+    project_id: int = Field(default=0, primary_key=True, description="Project id, 0 for events without a project")
+    event_name: str = Field(primary_key=True, max_length=255, description="Name of the event")
+    bucket: datetime = Field(primary_key=True, index=True, description="Start of the time bucket (UTC)")
+    count: int = Field(default=0, description="Number of events in the bucket")
+
+
+class EventRollupMinute(EventRollupBase, table=True):
+    """ Per-minute event counts """
+    __tablename__ = "event_rollups_minute"
+
+
+class EventRollupHour(EventRollupBase, table=True):
+    """ Per-hour event counts """
+    __tablename__ = "event_rollups_hour"
+
+
+class EventRollupDay(EventRollupBase, table=True):
+    """ Per-day event counts """
+    __tablename__ = "event_rollups_day"
+
+
+class EventSketch(SQLModel, table=True):
+    """ HyperLogLog sketch of distinct users or sessions per day and event name """
+    __tablename__ = "event_sketches"
+
+    project_id: int = Field(default=0, primary_key=True, description="Project id, 0 for events without a project")
+    event_name: str = Field(primary_key=True, max_length=255, description="Name of the event, * for all events")
+    bucket: datetime = Field(primary_key=True, index=True, description="Start of the day (UTC)")
+    kind: str = Field(primary_key=True, max_length=16, description="What is counted: user or session")
+    precision: int = Field(description="HyperLogLog precision of the registers")
+    registers: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+
+
+class EventPartition(SQLModel, table=True):
+    """ Catalog of daily events partitions """
+    __tablename__ = "event_partitions"
+
+    name: str = Field(primary_key=True, max_length=64, description="Partition table name")
+    range_start: datetime = Field(index=True, description="Inclusive lower bound (UTC)")
+    range_end: datetime = Field(description="Exclusive upper bound (UTC)")
+
+
+class PromotedProperty(SQLModel, table=True):
+    """ Event property keys copied into indexed generated columns """
+    __tablename__ = "promoted_properties"
+
+    key: str = Field(primary_key=True, max_length=48, description="Key inside Event.properties")
+    column_name: str = Field(max_length=64, description="Generated column on events")
+    created_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+    )
+
+
+class UserIndex(SQLModel, table=True):
+    """ Dense integer index of every user_id, the positions in active-user bitmaps """
+    __tablename__ = "user_indexes"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: str = Field(max_length=255, unique=True, description="User id as sent with events")
+
+
+class ActiveUserBitmap(SQLModel, table=True):
+    """ Roaring bitmap of the UserIndex ids active on a day """
+    __tablename__ = "active_user_bitmaps"
+
+    project_id: int = Field(default=0, primary_key=True, description="Project id, 0 for events without a project")
+    day: datetime = Field(primary_key=True, index=True, description="Start of the day (UTC)")
+    bitmap: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+
+
+class UserFirstSeen(SQLModel, table=True):
+    """ Day a user was first active in a project, or in any project """
+    __tablename__ = "user_first_seen"
+
+    project_id: int = Field(primary_key=True, description="Project id, 0 for events without a project, -1 for any project")
+    user_index: int = Field(primary_key=True, description="UserIndex id of the user")
+    day: datetime = Field(description="Start of the day (UTC)")
+
+
+class FirstSeenBitmap(SQLModel, table=True):
+    """ Roaring bitmap of the UserIndex ids first active on a day, the cohorts of retention matrices """
+    __tablename__ = "first_seen_bitmaps"
+
+    project_id: int = Field(default=0, primary_key=True,
+                            description="Project id, 0 for events without a project, -1 for any project")
+    day: datetime = Field(primary_key=True, index=True, description="Start of the day (UTC)")
+    bitmap: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+
+
+class UserSession(SQLModel, table=True):
+    """ Closed inactivity-gap session of one user """
+    __tablename__ = "sessions"
+    __table_args__ = (
+        Index("ix_sessions_project_started", "project_id", "started_at"),
+        Index("ix_sessions_user_started", "user_id", "started_at"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    project_id: Optional[int] = Field(default=None, description="Project id")
+    user_id: Optional[str] = Field(default=None, max_length=255, description="User id, if the events had one")
+    client_session_id: Optional[str] = Field(default=None, max_length=255, description="Session id sent by the SDK, if any")
+    started_at: datetime = Field(description="Timestamp of the first event")
+    ended_at: datetime = Field(description="Timestamp of the last event")
+    duration_seconds: float = Field(description="Time from the first to the last event")
+    event_count: int = Field(description="Number of events in the session")
+    entry_event: str = Field(max_length=255, description="Name of the first event")
+    exit_event: str = Field(max_length=255, description="Name of the last event")
+
+
+class SpoolOffset(SQLModel, table=True):
+    """ Bytes of a spool segment already loaded, committed with the events they hold """
+    __tablename__ = "spool_offsets"
+
+    segment: str = Field(primary_key=True, max_length=255, description="<spool name>/<segment file>")
+    position: int = Field(default=0, description="Offset of the first record not loaded yet")
+
+
+class DataVersion(SQLModel, table=True):
+    """ Counter bumped whenever data of already closed time ranges changes """
+    __tablename__ = "data_versions"
+
+    name: str = Field(primary_key=True, max_length=64)
+    version: int = Field(default=0, description="Number of changes so far")
+
+
 class ProjectBase(SQLModel):
     """ Base model for Project """
     name: str = Field(max_length=255, description="Project name")
@@ -76,6 +278,16 @@ class Project(ProjectBase, table=True):
     event_retention_days: int = Field(default=90, description="Number of days to retain events")
     monthly_event_limit: int = Field(default=10000, description="Monthly event limit")
 
+
+class ProjectUsage(SQLModel, table=True):
+    """ Events a project has used, and quota leased to workers, in a month """
+    __tablename__ = "project_usage"
+
+    project_id: int = Field(primary_key=True, description="Project id")
+    month: datetime = Field(primary_key=True, description="Start of the month (UTC)")
+    used: int = Field(default=0, description="Events accepted, as of the last checkpoints")
+    allocated: int = Field(default=0, description="Quota leased to workers, never above the limit")
+
 class ProjectCreate(ProjectBase):
     """ Project creation model for API request """
     pass
@@ -94,23 +306,93 @@ class AnalyticsSummary(SQLModel):
     unique_users: int = Field(description="Number of unique users")
     unique_sessions: int = Field(description="Number of unique sessions")
     events_type: Dict[str, int] = Field(default_factory=dict, description="Events count by type")
-    data_range: Dict[str, datetime] = Field(description="Date range of the events")
+    data_range: Dict[str, Optional[datetime]] = Field(description="Date range of the events")
 
-class EventCountByDate:
+class EventCountByDate(SQLModel):
     date: datetime = Field(description="Date of the event")
     count: int = Field(description="Number of events on that date")
 
 
-class AnalyticsTimeSeriesResponse:
+class AnalyticsTimeSeriesResponse(SQLModel):
     """ Analytics time series response model """
-    period: str = Field(description="Time period for the data ( day , hour)")
+    period: str = Field(description="Time period for the data ( minute, hour, day )")
     data:list[EventCountByDate] = Field(description="Time Series DataPoints")
     total_events: int = Field(description="Total number of events in the time series")
 
-class TopEventsResponse:
+class TopEventsResponse(SQLModel):
     """ Top events response model """
     event_name: str = Field(description="Name of the event")
     count :int = Field(description="Count of the event")
-    unique_users: int = Field(description="Number of unique users")
+    unique_users: Optional[int] = Field(default=None, description="Number of unique users (database ranges only)")
     percentage: float = Field(description="Time range of the top events")
-    
\ No newline at end of file
+    max_error: Optional[int] = Field(default=None, description="Upper bound on how much count overstates the true count (streaming windows only)")
+    
+
+QueryColumn = Literal["event_name", "user_id", "session_id"]
+
+
+class AnalyticsQuery(SQLModel):
+    """ Declarative analytics query run by the vectorized query engine """
+    start_date: Optional[datetime] = Field(default=None, description="Inclusive start of the time range")
+    end_date: Optional[datetime] = Field(default=None, description="Inclusive end of the time range")
+    project_id: Optional[int] = Field(default=None, description="Restrict to one project")
+    filters: Dict[QueryColumn, list[str]] = Field(default_factory=dict, description="Accepted values per column")
+    group_by: list[Literal["event_name", "user_id", "session_id", "project_id"]] = Field(
+        default_factory=list, description="Columns to group by")
+    metrics: list[Literal["count", "unique_users", "unique_sessions"]] = Field(
+        default_factory=lambda: ["count"], min_length=1, description="Aggregates per group, ordered by the first")
+    grain: Optional[Literal["minute", "hour", "day"]] = Field(default=None, description="Time bucket to group by")
+    limit: int = Field(default=1000, gt=0, description="Maximum number of rows returned")
+
+
+class AnalyticsQueryResponse(SQLModel):
+    """ Rows of an analytics query: bucket and group columns followed by the metrics """
+    rows: list[Dict[str, Any]] = Field(description="Result rows")
+
+
+class FunnelRequest(SQLModel):
+    """ Funnel definition: event names in the order users must perform them """
+    steps: list[str] = Field(min_length=2, description="Event names of the funnel steps, in order")
+    window_seconds: int = Field(default=7 * 86400, gt=0, description="Time allowed from the first to the last step")
+    start_date: Optional[datetime] = Field(default=None, description="Earliest first step")
+    end_date: Optional[datetime] = Field(default=None, description="Latest first step")
+    project_id: Optional[int] = Field(default=None, description="Restrict to one project")
+
+
+class FunnelStepResult(SQLModel):
+    """ Users reaching one funnel step """
+    event_name: str = Field(description="Event name of the step")
+    count: int = Field(description="Users who reached the step")
+    conversion_rate: float = Field(description="Share of the previous step's users")
+    overall_conversion: float = Field(description="Share of the first step's users")
+    median_seconds_from_previous: Optional[float] = Field(default=None, description="Median time since the previous step")
+
+
+class FunnelResponse(SQLModel):
+    """ Funnel analysis response model """
+    window_seconds: int = Field(description="Time allowed from the first to the last step")
+    steps: list[FunnelStepResult] = Field(description="Per-step results")
+
+
+class RetentionCohort(SQLModel):
+    """ One cohort row of a retention matrix """
+    cohort_start: datetime = Field(description="Start of the period in which the cohort's users were first seen")
+    users: int = Field(description="Users in the cohort")
+    retained: list[int] = Field(description="Cohort users active N periods later, from N = 0")
+    retention: list[float] = Field(description="retained as a share of the cohort")
+
+
+class RetentionResponse(SQLModel):
+    """ Cohort retention matrix response model """
+    period: str = Field(description="Cohort and retention period ( day, week )")
+    cohorts: list[RetentionCohort] = Field(description="Cohorts, oldest first")
+
+
+class SessionMetrics(SQLModel):
+    """ Session metrics response model """
+    total_sessions: int = Field(description="Closed sessions started in the range")
+    avg_duration_seconds: float = Field(description="Average session duration")
+    avg_events_per_session: float = Field(description="Average number of events per session")
+    bounce_rate: float = Field(description="Share of sessions with a single event")
+    top_entry_events: Dict[str, int] = Field(default_factory=dict, description="Most common first events")
+    top_exit_events: Dict[str, int] = Field(default_factory=dict, description="Most common last events")
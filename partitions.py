@@ -0,0 +1,221 @@
+"""
+Daily time partitions of the events table and partition-drop retention
+
+On PostgreSQL events is a declaratively partitioned table (RANGE on
+timestamp) with one partition per UTC day and a default partition for
+anything outside them. On SQLite the same catalog is kept in
+event_partitions and dropping a partition deletes its time range through
+the timestamp index, so the retention logic runs unchanged in tests.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import MetaData, PrimaryKeyConstraint, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from cohorts import ALL_PROJECTS
+from models import ActiveUserBitmap, Event, EventPartition, EventSketch, FirstSeenBitmap, Project
+from result_cache import bump_closed_version
+from rollups import GRAIN_PERIODS, ROLLUP_MODELS, to_utc_naive, truncate
+
+logger = logging.getLogger(__name__)
+
+# retention for events without a (known) project
+DEFAULT_RETENTION_DAYS = int(os.getenv("DEFAULT_RETENTION_DAYS", "90"))
+
+DEFAULT_PARTITION = "events_default"
+
+# (model, bucket column, bucket length) of the tables aggregated from events
+AGGREGATES = [(model, model.bucket, GRAIN_PERIODS[grain]) for grain, model in ROLLUP_MODELS.items()] + [
+    (EventSketch, EventSketch.bucket, timedelta(days=1)),
+    (ActiveUserBitmap, ActiveUserBitmap.day, timedelta(days=1)),
+    (FirstSeenBitmap, FirstSeenBitmap.day, timedelta(days=1)),
+]
+
+
+def partition_name(day: datetime) -> str:
+    return f"events_p{day:%Y%m%d}"
+
+
+# false when events is an ordinary table, e.g. one created before partitioning
+PARTITIONED_QUERY = text(
+    "SELECT to_regclass('events') IS NULL "
+    "OR EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('events'))"
+)
+UNPARTITIONED_WARNING = "events is not a partitioned table; run `alembic upgrade head` to convert it"
+
+
+def create_partitioned_events_table(connection):
+    """
+    Create events as a partitioned table on PostgreSQL (run through run_sync).
+
+    PostgreSQL requires the partition key in the primary key, so this table
+    is a copy of the model's with a (id, timestamp) key; the ORM keeps
+    mapping id alone, which stays unique through its sequence. An existing
+    unpartitioned events is left alone; migration 0005 converts it.
+    """
+    if not connection.execute(PARTITIONED_QUERY).scalar():
+        logger.warning(UNPARTITIONED_WARNING)
+        return
+    table = Event.__table__.to_metadata(MetaData())
+    table.c.id.autoincrement = True
+    table.c.timestamp.primary_key = True
+    table.append_constraint(PrimaryKeyConstraint(table.c.id, table.c.timestamp))
+    table.dialect_options["postgresql"]["partition_by"] = 'RANGE ("timestamp")'
+    table.create(connection, checkfirst=True)
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF events DEFAULT"))
+
+
+async def ensure_partitions(session: AsyncSession, start_day: datetime, end_day: datetime) -> list[str]:
+    """Create the daily partitions from start_day to end_day (inclusive); returns the new ones"""
+    from sqlalchemy import select
+
+    start_day, end_day = truncate(start_day, "day"), truncate(end_day, "day")
+    postgres = session.get_bind().dialect.name == "postgresql"
+    if postgres and not (await session.execute(PARTITIONED_QUERY)).scalar():
+        logger.warning(UNPARTITIONED_WARNING)
+        return []
+    if postgres:
+        # one worker at a time; released at commit
+        await session.execute(text("SELECT pg_advisory_xact_lock(hashtext('event_partitions'))"))
+    result = await session.execute(select(EventPartition.name))
+    existing = set(result.scalars().all())
+
+    created = []
+    day = start_day
+    while day <= end_day:
+        name = partition_name(day)
+        if name not in existing:
+            if postgres:
+                await _create_pg_partition(session, name, day, day + timedelta(days=1))
+            session.add(EventPartition(name=name, range_start=day, range_end=day + timedelta(days=1)))
+            created.append(name)
+        day += timedelta(days=1)
+
+    await session.commit()
+    return created
+
+
+async def _create_pg_partition(session: AsyncSession, name: str, start: datetime, end: datetime):
+    # build it detached, move rows the default partition already holds for
+    # the range, then attach; a plain PARTITION OF would fail on those rows
+    # columns are listed so promoted (generated) property columns are left to the database
+    bounds = {"start": start, "end": end}
+    columns = ", ".join(f'"{column.name}"' for column in Event.__table__.columns)
+    await session.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} (LIKE events INCLUDING DEFAULTS INCLUDING GENERATED)"
+    ))
+    await session.execute(text(
+        f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} '
+        f'WHERE "timestamp" >= :start AND "timestamp" < :end RETURNING {columns}) '
+        f'INSERT INTO {name} ({columns}) SELECT {columns} FROM moved'
+    ), bounds)
+    await session.execute(text(
+        f"ALTER TABLE events ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{start.isoformat()}+00') TO ('{end.isoformat()}+00')"
+    ))
+
+
+async def drop_partition(session: AsyncSession, partition: EventPartition):
+    """Remove one partition and everything in it"""
+    from sqlalchemy import delete
+
+    if session.get_bind().dialect.name == "postgresql":
+        await session.execute(text(f"DROP TABLE IF EXISTS {partition.name}"))
+    else:
+        await session.execute(delete(Event).where(
+            Event.timestamp >= partition.range_start,
+            Event.timestamp < partition.range_end
+        ))
+    await session.delete(partition)
+
+
+async def purge_aggregates(session: AsyncSession, cutoff: datetime, scope=None) -> int:
+    """
+    Delete rollup, sketch and active-user buckets that end at or before
+    cutoff; scope(project_id column) narrows it to some projects. Buckets
+    straddling the cutoff are kept until a later pass.
+    """
+    from sqlalchemy import delete
+
+    purged = 0
+    for model, bucket, period in AGGREGATES:
+        filters = [bucket <= cutoff - period]
+        if scope is not None:
+            filters.append(scope(model.project_id))
+        result = await session.execute(delete(model).where(*filters))
+        purged += result.rowcount or 0
+    return purged
+
+
+async def apply_retention(session: AsyncSession, now: Optional[datetime] = None) -> dict:
+    """
+    Enforce Project.event_retention_days.
+
+    A partition is dropped once it is older than the longest retention of
+    any project. Projects with a shorter retention have their older rows
+    deleted, which partition pruning limits to the few partitions still
+    kept for the others. Aggregates of the expired time go in the same
+    transaction.
+    """
+    from sqlalchemy import select, delete, or_
+
+    now = to_utc_naive(now or datetime.utcnow())
+    result = await session.execute(select(Project.id, Project.event_retention_days))
+    retention = dict(result.all())
+
+    # events without a known project keep the default retention, if there are any
+    unowned = Event.project_id.is_(None)
+    if retention:
+        unowned = or_(unowned, Event.project_id.not_in(list(retention)))
+    result = await session.execute(select(select(Event.id).where(unowned).exists()))
+    has_unowned = result.scalar()
+
+    retention_days = list(retention.values())
+    if has_unowned or not retention_days:
+        retention_days.append(DEFAULT_RETENTION_DAYS)
+    longest = max(retention_days)
+    cutoff = now - timedelta(days=longest)
+
+    result = await session.execute(select(EventPartition).where(EventPartition.range_end <= cutoff))
+    dropped = []
+    for partition in result.scalars().all():
+        await drop_partition(session, partition)
+        dropped.append(partition.name)
+
+    # rows outside any dropped partition, e.g. late events in the default partition
+    result = await session.execute(delete(Event).where(Event.timestamp < cutoff))
+    deleted = result.rowcount or 0
+    purged = await purge_aggregates(session, cutoff)
+
+    for project_id, days in retention.items():
+        if days < longest:
+            result = await session.execute(delete(Event).where(
+                Event.project_id == project_id,
+                Event.timestamp < now - timedelta(days=days)
+            ))
+            deleted += result.rowcount or 0
+            purged += await purge_aggregates(
+                session, now - timedelta(days=days), lambda column, project_id=project_id: column == project_id
+            )
+
+    if has_unowned and DEFAULT_RETENTION_DAYS < longest:
+        result = await session.execute(delete(Event).where(
+            unowned,
+            Event.timestamp < now - timedelta(days=DEFAULT_RETENTION_DAYS)
+        ))
+        deleted += result.rowcount or 0
+        # aggregates keep events without a project under project 0; the
+        # all-project first-seen bitmaps keep the longest retention
+        purged += await purge_aggregates(
+            session, now - timedelta(days=DEFAULT_RETENTION_DAYS),
+            lambda column: or_(column == 0, column.not_in([*retention, ALL_PROJECTS])) if retention else column == 0
+        )
+
+    if dropped or deleted or purged:
+        await bump_closed_version(session)
+    await session.commit()
+    cutoffs = sorted({now - timedelta(days=days) for days in retention_days})
+    return {"dropped_partitions": dropped, "deleted_events": deleted, "purged_buckets": purged, "cutoffs": cutoffs}
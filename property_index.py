@@ -0,0 +1,118 @@
+"""
+Filtering events on properties, through promoted generated columns when available
+"""
+
+import json
+import re
+
+from sqlalchemy import String, and_, column, func, cast, or_, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Event, PromotedProperty
+
+PROPERTY_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,48}$")
+
+# query parameters of the form where[properties.<key>]=<value>
+WHERE_PARAM_PATTERN = re.compile(r"^where\[properties\.([^\]]+)\]$")
+
+
+def validate_property_key(key: str) -> str:
+    """Only plain identifiers can become column names; raises ValueError otherwise"""
+    if not PROPERTY_KEY_PATTERN.match(key):
+        raise ValueError(f"Invalid property key: {key!r}")
+    return key
+
+
+def parse_where_params(query_params) -> dict[str, str]:
+    """Collect where[properties.<key>] filters from request query parameters"""
+    filters = {}
+    for name, value in query_params.items():
+        match = WHERE_PARAM_PATTERN.match(name)
+        if match:
+            filters[validate_property_key(match.group(1))] = value
+    return filters
+
+
+def promoted_column_name(key: str) -> str:
+    return f"prop_{key}"
+
+
+async def get_promoted_properties(session: AsyncSession) -> dict[str, str]:
+    """Map of promoted property key to generated column name"""
+    from sqlalchemy import select
+
+    result = await session.execute(select(PromotedProperty.key, PromotedProperty.column_name))
+    return dict(result.all())
+
+
+async def promote_property(session: AsyncSession, key: str) -> PromotedProperty:
+    """
+    Add an indexed generated column holding properties[key] as text.
+
+    PostgreSQL stores the column, which rewrites the events table once;
+    SQLite can only add a virtual generated column, which the index
+    materialises.
+    """
+    key = validate_property_key(key)
+    existing = await session.get(PromotedProperty, key)
+    if existing is not None:
+        return existing
+
+    name = promoted_column_name(key)
+    if session.get_bind().dialect.name == "postgresql":
+        await session.execute(text(
+            f"ALTER TABLE events ADD COLUMN IF NOT EXISTS {name} text "
+            f"GENERATED ALWAYS AS (properties ->> '{key}') STORED"
+        ))
+    else:
+        await session.execute(text(
+            f"ALTER TABLE events ADD COLUMN {name} TEXT "
+            f"GENERATED ALWAYS AS (json_extract(properties, '$.{key}')) VIRTUAL"
+        ))
+    await session.execute(text(f'CREATE INDEX IF NOT EXISTS ix_events_{name} ON events ({name}, "timestamp")'))
+
+    promoted = PromotedProperty(key=key, column_name=name)
+    session.add(promoted)
+    await session.commit()
+    return promoted
+
+
+def _json_scalar(value: str):
+    """value as a JSON number or boolean whose text form is value itself, else None"""
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return None
+    if isinstance(parsed, (bool, int, float)) and json.dumps(parsed) == value:
+        return parsed
+    return None
+
+
+def property_filter_clauses(dialect: str, filters: dict[str, str], promoted: dict[str, str]) -> list:
+    """
+    WHERE clauses for property equality filters.
+
+    Every key compares the property's text form, as the generated column
+    of a promoted key holds it, so promotion never changes which events
+    match. Promoted keys compare their generated column (B-tree index).
+    On PostgreSQL other keys are first narrowed by JSONB containment (GIN
+    index) to the string and scalar values that could match, and SQLite
+    casts json_extract to text.
+    """
+    clauses = []
+    for key, value in filters.items():
+        key = validate_property_key(key)
+        if key in promoted:
+            clauses.append(column(promoted[key]) == value)
+        elif dialect == "postgresql":
+            candidates = [value]
+            typed = _json_scalar(value)
+            if typed is not None:
+                candidates.append(typed)
+            clauses.append(and_(
+                or_(*[Event.properties.op("@>")(cast(json.dumps({key: candidate}), JSONB)) for candidate in candidates]),
+                Event.properties.op("->>", return_type=String)(key) == value,
+            ))
+        else:
+            clauses.append(cast(func.json_extract(Event.properties, f"$.{key}"), String) == value)
+    return clauses
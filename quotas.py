@@ -0,0 +1,253 @@
+"""
+In-memory enforcement of Project.monthly_event_limit with leased quota chunks
+
+Each worker leases chunks of a project's monthly quota from project_usage
+(allocated grows by the chunk, never past the limit) and spends them
+locally, so checking an event is a dictionary lookup. Leases are topped up
+in the background before they run out, usage is checkpointed periodically
+and unused quota is handed back on shutdown.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Optional
+
+from database import async_session_maker
+from models import Project, ProjectUsage
+from rollups import insert_for
+
+logger = logging.getLogger(__name__)
+
+QUOTA_ENABLED = os.getenv("QUOTA_ENABLED", "true").lower() == "true"
+QUOTA_CHUNK_SIZE = int(os.getenv("QUOTA_CHUNK_SIZE", "1000"))
+QUOTA_CHECKPOINT_SECONDS = int(os.getenv("QUOTA_CHECKPOINT_SECONDS", "10"))
+# usage shares that log a warning and are reported to clients
+QUOTA_WARNING_THRESHOLDS = tuple(
+    float(value) for value in os.getenv("QUOTA_WARNING_THRESHOLDS", "0.8,0.9").split(",") if value
+)
+
+
+def month_start(now: Optional[datetime] = None) -> datetime:
+    return (now or datetime.utcnow()).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+class QuotaExceededError(Exception):
+    """ Raised when a project has used its monthly event limit """
+
+
+class ProjectQuota:
+    """One worker's view of a project's quota for the current month"""
+
+    def __init__(self, month: datetime):
+        self.month = month
+        self.limit: Optional[int] = None
+        # quota leased to this worker and not spent yet; negative while overdrawn
+        self.remaining = 0
+        # quota leased by all workers as of the last lease
+        self.allocated = 0
+        # events accepted since the last checkpoint
+        self.unsaved = 0
+        self.loaded = False
+        self.unlimited = False
+        # the whole limit is leased out, so refills are pointless until some is returned
+        self.exhausted = False
+        self.refilling = False
+        self.warned = 0.0
+
+    @property
+    def usage(self) -> float:
+        """Share of the limit used, counting other workers' leases as spent"""
+        if not self.limit:
+            return 0.0
+        return (self.allocated - self.remaining) / self.limit
+
+
+class QuotaManager:
+    """
+    Per-project monthly quotas checked without touching the database.
+
+    check() never awaits: a project seen for the first time, or whose lease
+    is running out, is refilled by a background task. Until then events are
+    accepted on overdraft of up to one chunk, which the next lease pays back.
+    """
+
+    def __init__(self, chunk_size: int = QUOTA_CHUNK_SIZE,
+                 interval: float = QUOTA_CHECKPOINT_SECONDS,
+                 thresholds: tuple = QUOTA_WARNING_THRESHOLDS,
+                 session_factory=async_session_maker):
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.thresholds = sorted(thresholds)
+        self.session_factory = session_factory
+        self.projects: dict[int, ProjectQuota] = {}
+        # previous months' quotas with usage still to checkpoint
+        self.retired: list[tuple[int, ProjectQuota]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._refills: set[asyncio.Task] = set()
+
+    def _quota(self, project_id: int) -> ProjectQuota:
+        month = month_start()
+        quota = self.projects.get(project_id)
+        if quota is None or quota.month != month:
+            if quota is not None:
+                # the month rolled over: save last month's usage and return its lease
+                self.retired.append((project_id, quota))
+            quota = self.projects[project_id] = ProjectQuota(month)
+        return quota
+
+    def check(self, project_id: Optional[int], count: int = 1) -> Optional[float]:
+        """
+        Spend count events of a project's quota. Raises QuotaExceededError
+        when the limit is reached; returns the warning threshold crossed,
+        if any, for the caller to report.
+        """
+        if project_id is None:
+            return None
+        quota = self._quota(project_id)
+        if quota.unlimited:
+            return None
+        if quota.remaining < count and (quota.exhausted or quota.remaining - count < -self.chunk_size):
+            raise QuotaExceededError(f"Project {project_id} has reached its monthly event limit")
+
+        quota.remaining -= count
+        quota.unsaved += count
+        if quota.remaining < self.chunk_size // 2 and not quota.exhausted:
+            self._schedule_refill(project_id, quota)
+
+        crossed = None
+        for threshold in self.thresholds:
+            if quota.usage >= threshold:
+                crossed = threshold
+        if crossed is not None and crossed > quota.warned:
+            quota.warned = crossed
+            logger.warning("Project %s has used %d%% of its monthly event limit", project_id, crossed * 100)
+        return crossed
+
+    def _schedule_refill(self, project_id: int, quota: ProjectQuota):
+        if quota.refilling:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        quota.refilling = True
+        task = loop.create_task(self.refill(project_id, quota))
+        self._refills.add(task)
+        task.add_done_callback(self._refills.discard)
+
+    async def refill(self, project_id: int, quota: ProjectQuota):
+        """Lease another chunk of the project's quota for this worker"""
+        from sqlalchemy import select, update
+
+        try:
+            async with self.session_factory() as session:
+                if not quota.loaded:
+                    project = await session.get(Project, project_id)
+                    quota.loaded = True
+                    if project is None:
+                        quota.unlimited = True
+                        return
+                    quota.limit = project.monthly_event_limit
+
+                insert = insert_for(session)
+                await session.execute(
+                    insert(ProjectUsage).on_conflict_do_nothing(),
+                    [{"project_id": project_id, "month": quota.month, "used": 0, "allocated": 0}]
+                )
+                result = await session.execute(
+                    select(ProjectUsage.allocated).where(
+                        ProjectUsage.project_id == project_id, ProjectUsage.month == quota.month
+                    ).with_for_update()
+                )
+                allocated = result.scalar_one()
+                grant = max(0, min(self.chunk_size, quota.limit - allocated))
+                if grant:
+                    await session.execute(
+                        update(ProjectUsage).where(
+                            ProjectUsage.project_id == project_id, ProjectUsage.month == quota.month
+                        ).values(allocated=ProjectUsage.allocated + grant)
+                    )
+                await session.commit()
+
+            quota.allocated = allocated + grant
+            quota.remaining += grant
+            quota.exhausted = quota.allocated >= quota.limit
+        except Exception:
+            logger.exception("Leasing quota for project %s failed", project_id)
+        finally:
+            quota.refilling = False
+
+    async def checkpoint(self, release: bool = False) -> int:
+        """
+        Add the usage accepted since the last checkpoint to project_usage;
+        with release, also hand back the unspent part of every lease.
+        Returns the number of events saved.
+        """
+        from sqlalchemy import update, bindparam
+
+        retired, self.retired = self.retired, []
+        rows = []
+        for project_id, quota, returning in [(pid, quota, True) for pid, quota in retired] + \
+                [(pid, quota, release) for pid, quota in self.projects.items()]:
+            returned = max(quota.remaining, 0) if returning else 0
+            if quota.unsaved or returned:
+                rows.append({"k_project_id": project_id, "k_month": quota.month,
+                             "used": quota.unsaved, "returned": returned})
+                quota.unsaved = 0
+                quota.remaining -= returned
+        # leases given back by other workers may have made room again
+        for project_id, quota in self.projects.items():
+            if quota.exhausted and not release:
+                self._schedule_refill(project_id, quota)
+        if not rows:
+            return 0
+
+        table = ProjectUsage.__table__
+        try:
+            async with self.session_factory() as session:
+                await session.execute(
+                    update(table).where(
+                        table.c.project_id == bindparam("k_project_id"),
+                        table.c.month == bindparam("k_month"),
+                    ).values(
+                        used=table.c.used + bindparam("used"),
+                        allocated=table.c.allocated - bindparam("returned"),
+                    ),
+                    rows
+                )
+                await session.commit()
+        except Exception:
+            quotas = {(pid, quota.month): quota for pid, quota in retired + list(self.projects.items())}
+            for row in rows:
+                quota = quotas[(row["k_project_id"], row["k_month"])]
+                quota.unsaved += row["used"]
+                quota.remaining += row["returned"]
+            self.retired[:0] = [(pid, quota) for pid, quota in retired if quota.unsaved]
+            raise
+        return sum(row["used"] for row in rows)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop checkpointing, then save usage and release unspent leases"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._refills:
+            await asyncio.gather(*self._refills, return_exceptions=True)
+        await self.checkpoint(release=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.checkpoint()
+            except Exception:
+                logger.exception("Quota checkpoint failed")
@@ -0,0 +1,181 @@
+"""
+Watermark-keyed cache of analytics responses, with ETags for conditional GETs
+
+A response is keyed by its endpoint and normalized query parameters plus
+versions kept in data_versions, so changes invalidate entries instead of
+expiry. Every ingest transaction bumps the version of each project it
+writes to (its watermark), which a plain max(id) cannot stand in for:
+ids are handed out before commit, so a transaction committing late can
+add rows below an id already seen. Ranges that ended before the close
+cutoff only change through late events and retention, which bump the
+closed version every worker reads along with the project versions.
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from metrics import Counter, registry
+from models import DataVersion
+from rollups import insert_for, to_utc_naive
+from segments import SEGMENT_CLOSE_AFTER_HOURS
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+# open ranges also expire, since defaults such as "the last 30 days" slide with time
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "60"))
+# closed ranges expire too, as a backstop for changes made outside the application
+RESULT_CACHE_CLOSED_TTL_SECONDS = float(os.getenv("RESULT_CACHE_CLOSED_TTL_SECONDS", "3600"))
+# how stale the versions may be when other workers ingest; local commits refresh them at once
+RESULT_CACHE_WATERMARK_REFRESH_MS = int(os.getenv("RESULT_CACHE_WATERMARK_REFRESH_MS", "250"))
+
+CACHE_REQUESTS = registry.register(Counter(
+    "result_cache_requests_total", "Cached analytics requests by outcome", ("endpoint", "result")))
+
+CLOSED_VERSION = "closed"
+# prefix of the per-project versions; events without a project count as project 0
+PROJECT_VERSION = "project:"
+CLOSE_AFTER = timedelta(hours=SEGMENT_CLOSE_AFTER_HOURS)
+
+
+async def bump_closed_version(session: AsyncSession):
+    """Invalidate every worker's closed ranges once the caller's transaction commits"""
+    insert = insert_for(session)
+    table = DataVersion.__table__
+    query = insert(table).values(name=CLOSED_VERSION, version=1)
+    await session.execute(query.on_conflict_do_update(
+        index_elements=["name"], set_={"version": table.c.version + 1}
+    ))
+
+
+async def record_ingested_rows(session: AsyncSession, rows: list[dict], close_after: timedelta = CLOSE_AFTER):
+    """
+    In the ingesting transaction, bump the version of every project the
+    rows belong to, and the closed version if any row is older than the
+    close cutoff. Versions are bumped in name order so concurrent ingests
+    lock them in the same order.
+    """
+    if not rows:
+        return
+    insert = insert_for(session)
+    table = DataVersion.__table__
+    names = sorted({f"{PROJECT_VERSION}{row.get('project_id') or 0}" for row in rows})
+    query = insert(table).values([{"name": name, "version": 1} for name in names])
+    await session.execute(query.on_conflict_do_update(
+        index_elements=["name"], set_={"version": table.c.version + 1}
+    ))
+    cutoff = datetime.utcnow() - close_after
+    if any(row.get("timestamp") is not None and to_utc_naive(row["timestamp"]) < cutoff for row in rows):
+        await bump_closed_version(session)
+
+
+@dataclass
+class CachedResult:
+    body: bytes
+    etag: str
+    expires: Optional[float]
+
+
+class ResultCache:
+    """
+    LRU of serialized responses. A range is closed once its end_date is
+    more than close_after old; closed entries ignore the project versions
+    and last closed_ttl, and are keyed by the closed version like open ones.
+    Open entries are keyed by their project's version, or by the sum of all
+    project versions when they span every project.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+                 ttl: float = RESULT_CACHE_TTL_SECONDS,
+                 closed_ttl: float = RESULT_CACHE_CLOSED_TTL_SECONDS,
+                 refresh_interval: float = RESULT_CACHE_WATERMARK_REFRESH_MS / 1000,
+                 close_after: timedelta = CLOSE_AFTER,
+                 enabled: bool = RESULT_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.closed_ttl = closed_ttl
+        self.refresh_interval = refresh_interval
+        self.close_after = close_after
+        self.enabled = enabled
+        self.entries: OrderedDict[tuple, CachedResult] = OrderedDict()
+        self.versions: Optional[dict[str, int]] = None
+        self._fetched_at = 0.0
+
+    def record(self, rows: list[dict]):
+        """Ingest listener: rows committed by this worker make the next request re-read the versions"""
+        self.versions = None
+
+    async def current_versions(self, session: AsyncSession, project_id: Optional[int] = None) -> tuple[int, int]:
+        """(project version, closed version), re-read at most every refresh_interval"""
+        from sqlalchemy import select
+
+        now = time.monotonic()
+        if self.versions is None or now - self._fetched_at >= self.refresh_interval:
+            self._fetched_at = now
+            result = await session.execute(select(DataVersion.name, DataVersion.version))
+            self.versions = dict(result.all())
+        closed_version = self.versions.get(CLOSED_VERSION, 0)
+        if project_id is not None:
+            return self.versions.get(f"{PROJECT_VERSION}{project_id}", 0), closed_version
+        projects = sum(version for name, version in self.versions.items() if name.startswith(PROJECT_VERSION))
+        return projects, closed_version
+
+    def is_closed(self, end_date: Optional[datetime]) -> bool:
+        return end_date is not None and to_utc_naive(end_date) < datetime.utcnow() - self.close_after
+
+    def get(self, key: tuple) -> Optional[CachedResult]:
+        cached = self.entries.get(key)
+        if cached is None:
+            return None
+        if cached.expires is not None and cached.expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return cached
+
+    def put(self, key: tuple, cached: CachedResult):
+        self.entries[key] = cached
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def respond(self, request: Request, session: AsyncSession, endpoint: str, params: dict,
+                      end_date: Optional[datetime], compute: Callable[[], Awaitable[Any]]) -> Response:
+        """
+        The response of compute() for these parameters, from the cache when
+        the versions have not moved, or 304 when it matches If-None-Match
+        """
+        key = None
+        cached = None
+        if self.enabled:
+            closed = self.is_closed(end_date)
+            project_version, closed_version = await self.current_versions(session, params.get("project_id"))
+            version = (closed_version,) if closed else (closed_version, project_version)
+            key = (endpoint, tuple(sorted(jsonable_encoder(params).items())), version)
+            cached = self.get(key)
+            CACHE_REQUESTS.inc(endpoint, "hit" if cached is not None else "miss")
+
+        if cached is None:
+            body = JSONResponse(content=jsonable_encoder(await compute())).body
+            cached = CachedResult(body, f'"{hashlib.sha1(body).hexdigest()}"', None)
+            if key is not None:
+                cached.expires = time.monotonic() + (self.closed_ttl if closed else self.ttl)
+                self.put(key, cached)
+
+        headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if cached.etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=cached.body, media_type="application/json", headers=headers)
+
+
+result_cache = ResultCache()
@@ -0,0 +1,65 @@
+"""
+Background scheduler for events partitions, retention and segment compaction
+"""
+
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from database import async_session_maker, DatabaseOperation
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "true").lower() == "true"
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+PARTITION_PRECREATE_DAYS = int(os.getenv("PARTITION_PRECREATE_DAYS", "3"))
+
+
+class RetentionScheduler:
+    """Periodically create upcoming partitions and drop expired ones"""
+
+    def __init__(self, interval: float = RETENTION_INTERVAL_SECONDS,
+                 days_ahead: int = PARTITION_PRECREATE_DAYS,
+                 session_factory=async_session_maker):
+        self.interval = interval
+        self.days_ahead = days_ahead
+        self.session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> dict:
+        """One maintenance pass: partitions, retention, then segment compaction"""
+        async with self.session_factory() as session:
+            db_ops = DatabaseOperation(session)
+            created = await db_ops.ensure_partitions(days_ahead=self.days_ahead)
+            result = await db_ops.apply_retention()
+            if db_ops.segments is not None and (result["deleted_events"] or result["dropped_partitions"]):
+                # any day before the latest cutoff may have lost rows, not just those
+                # reached since the last pass: passes may have been missed, and shorter
+                # project retentions delete from days the others still keep
+                db_ops.segments.expire(max(result["cutoffs"]))
+            result["compacted_segments"] = await db_ops.compact_segments()
+        result["created_partitions"] = created
+        return result
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                result = await self.run_once()
+                logger.info("Retention pass: %s", result)
+            except Exception:
+                logger.exception("Retention pass failed")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,178 @@
+"""
+Roaring-style compressed bitmap of non-negative 32-bit integers
+
+Values are split by their high 16 bits into containers. A container holding
+at most ARRAY_LIMIT values is a sorted array of the low 16 bits; a denser
+one is a 65536-bit bitset kept as a Python int, so unions, intersections
+and popcounts of dense containers run as single big-int operations.
+"""
+
+import struct
+from array import array
+from typing import Iterable, Iterator, Union
+
+ARRAY_LIMIT = 4096
+BITSET_BYTES = 65536 // 8
+
+Container = Union[array, int]
+
+
+def _bitset(container: Container) -> int:
+    if isinstance(container, int):
+        return container
+    bits = bytearray(BITSET_BYTES)
+    for value in container:
+        bits[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _members(bitset: int) -> array:
+    result = array("H")
+    for index, byte in enumerate(bitset.to_bytes(BITSET_BYTES, "little")):
+        if byte:
+            base = index << 3
+            result.extend(base + bit for bit in range(8) if byte >> bit & 1)
+    return result
+
+
+def _normalize(container: Container) -> Container:
+    """Keep the cheaper representation: an array up to ARRAY_LIMIT values, a bitset above"""
+    if isinstance(container, int):
+        return _members(container) if container.bit_count() <= ARRAY_LIMIT else container
+    return _bitset(container) if len(container) > ARRAY_LIMIT else container
+
+
+def _filter(values: array, bitset: int, keep: bool) -> array:
+    bits = bitset.to_bytes(BITSET_BYTES, "little")
+    return array("H", (value for value in values if bool(bits[value >> 3] >> (value & 7) & 1) == keep))
+
+
+def _cardinality(container: Container) -> int:
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+class RoaringBitmap:
+    """Set of integers in [0, 2**32) with compact storage and fast set algebra"""
+
+    def __init__(self, containers: dict[int, Container] = None):
+        self.containers: dict[int, Container] = containers if containers is not None else {}
+
+    @classmethod
+    def from_values(cls, values: Iterable[int]) -> "RoaringBitmap":
+        bitmap = cls()
+        bitmap.update(values)
+        return bitmap
+
+    def update(self, values: Iterable[int]):
+        groups: dict[int, set] = {}
+        for value in values:
+            groups.setdefault(value >> 16, set()).add(value & 0xFFFF)
+        for key, lows in groups.items():
+            current = self.containers.get(key)
+            if current is None:
+                merged = array("H", sorted(lows))
+            elif isinstance(current, int):
+                merged = current | _bitset(array("H", lows))
+            else:
+                merged = array("H", sorted(lows.union(current)))
+            self.containers[key] = _normalize(merged)
+
+    def __len__(self) -> int:
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __iter__(self) -> Iterator[int]:
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            high = key << 16
+            for low in (_members(container) if isinstance(container, int) else container):
+                yield high | low
+
+    def __contains__(self, value: int) -> bool:
+        container = self.containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        return low in container
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, RoaringBitmap) and self.containers == other.containers
+
+    def __or__(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        containers = dict(self.containers)
+        for key, container in other.containers.items():
+            mine = containers.get(key)
+            if mine is None:
+                containers[key] = container
+            elif isinstance(mine, int) or isinstance(container, int):
+                containers[key] = _bitset(mine) | _bitset(container)
+            else:
+                containers[key] = _normalize(array("H", sorted(set(mine).union(container))))
+        return RoaringBitmap(containers)
+
+    def __and__(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        containers = {}
+        for key in self.containers.keys() & other.containers.keys():
+            mine, theirs = self.containers[key], other.containers[key]
+            if isinstance(mine, int) and isinstance(theirs, int):
+                result = _normalize(mine & theirs)
+            elif isinstance(mine, int):
+                result = _filter(theirs, mine, keep=True)
+            elif isinstance(theirs, int):
+                result = _filter(mine, theirs, keep=True)
+            else:
+                result = array("H", sorted(set(mine).intersection(theirs)))
+            if _cardinality(result):
+                containers[key] = result
+        return RoaringBitmap(containers)
+
+    def __sub__(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        containers = {}
+        for key, mine in self.containers.items():
+            theirs = other.containers.get(key)
+            if theirs is None:
+                result = mine
+            elif isinstance(mine, int):
+                result = _normalize(mine & ~_bitset(theirs))
+            elif isinstance(theirs, int):
+                result = _filter(mine, theirs, keep=False)
+            else:
+                result = array("H", sorted(set(mine).difference(theirs)))
+            if _cardinality(result):
+                containers[key] = result
+        return RoaringBitmap(containers)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialise as: uint32 container count, then per container its uint16
+        key, uint8 kind (0 array, 1 bitset), uint32 cardinality and payload
+        """
+        parts = [struct.pack("<I", len(self.containers))]
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            if isinstance(container, int):
+                parts.append(struct.pack("<HBI", key, 1, container.bit_count()))
+                parts.append(container.to_bytes(BITSET_BYTES, "little"))
+            else:
+                parts.append(struct.pack("<HBI", key, 0, len(container)))
+                parts.append(container.tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "RoaringBitmap":
+        (count,) = struct.unpack_from("<I", data)
+        offset = 4
+        containers = {}
+        for _ in range(count):
+            key, kind, cardinality = struct.unpack_from("<HBI", data, offset)
+            offset += 7
+            if kind == 1:
+                containers[key] = int.from_bytes(data[offset:offset + BITSET_BYTES], "little")
+                offset += BITSET_BYTES
+            else:
+                values = array("H")
+                values.frombytes(data[offset:offset + 2 * cardinality])
+                containers[key] = values
+                offset += 2 * cardinality
+        return cls(containers)
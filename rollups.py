@@ -0,0 +1,118 @@
+"""
+Time-bucket rollups maintained alongside event ingestion
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import EventRollupMinute, EventRollupHour, EventRollupDay
+
+ROLLUP_MODELS = {
+    "minute": EventRollupMinute,
+    "hour": EventRollupHour,
+    "day": EventRollupDay,
+}
+
+GRAIN_PERIODS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+
+def to_utc_naive(timestamp: datetime) -> datetime:
+    """Normalise a timestamp to naive UTC, the form buckets are stored in"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def truncate(timestamp: datetime, grain: str) -> datetime:
+    """Start of the minute/hour/day bucket containing timestamp"""
+    timestamp = to_utc_naive(timestamp)
+    if grain == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if grain == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if grain == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown rollup grain: {grain}")
+
+
+def split_range(start: Optional[datetime], end: Optional[datetime],
+                grains: tuple = ("day", "hour", "minute")) -> list[tuple]:
+    """
+    Cover [start, end) (naive UTC, None for open) with (grain, lo, hi)
+    pieces of whole buckets, coarsest grain first, plus (None, lo, hi)
+    edges shorter than the finest grain that only raw events can answer.
+    """
+    if start is not None and end is not None and start >= end:
+        return []
+    if not grains:
+        return [(None, start, end)]
+    grain = grains[0]
+    first = last = None
+    if start is not None:
+        first = truncate(start, grain)
+        if first < start:
+            first += GRAIN_PERIODS[grain]
+    if end is not None:
+        last = truncate(end, grain)
+    if first is not None and last is not None and first >= last:
+        return split_range(start, end, grains[1:])
+
+    pieces = [(grain, first, last)]
+    if first is not None and start < first:
+        pieces = split_range(start, first, grains[1:]) + pieces
+    if last is not None and last < end:
+        pieces += split_range(last, end, grains[1:])
+    return pieces
+
+
+def aggregate(rows: list[dict]) -> dict[str, Counter]:
+    """Count rows per (project_id, event_name, bucket) for every grain"""
+    counts = {grain: Counter() for grain in ROLLUP_MODELS}
+    for row in rows:
+        project_id = row.get("project_id") or 0
+        for grain, counter in counts.items():
+            counter[(project_id, row["event_name"], truncate(row["timestamp"], grain))] += 1
+    return counts
+
+
+def insert_for(session: AsyncSession):
+    """The dialect's insert(), which has on_conflict_do_nothing/do_update, for session's database"""
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not supported on {dialect}")
+    return insert
+
+
+async def apply_rollups(session: AsyncSession, rows: list[dict]):
+    """
+    Add rows to the rollup tables inside the caller's transaction.
+
+    Each bucket is incremented with INSERT ... ON CONFLICT DO UPDATE, so
+    late events with an old client timestamp are merged into the bucket
+    they belong to. Keys are written in sorted order so concurrent batches
+    lock rows in the same order.
+    """
+    insert = insert_for(session)
+    for grain, counter in aggregate(rows).items():
+        table = ROLLUP_MODELS[grain].__table__
+        values = [
+            {"project_id": project_id, "event_name": event_name, "bucket": bucket, "count": count}
+            for (project_id, event_name, bucket), count in sorted(counter.items())
+        ]
+        query = insert(table)
+        query = query.on_conflict_do_update(
+            index_elements=["project_id", "event_name", "bucket"],
+            set_={"count": table.c.count + query.excluded.count},
+        )
+        # one cached statement, executed for all rows as an executemany
+        await session.execute(query, values)
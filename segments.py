@@ -0,0 +1,402 @@
+"""
+Immutable columnar segments of closed days of events, read through mmap
+
+One segment file holds one UTC day of events. Rows are grouped by project
+and sorted by timestamp within each project. Columns:
+- int64: id, timestamp (microseconds since the epoch) and project_id
+  (-1 for none);
+- int32: codes into per-segment dictionaries for event_name, user_id and
+  session_id. Code 0 is reserved for a missing value.
+
+A JSON footer records where each column starts, each project's row range,
+the time bounds and the events.id watermark: the highest id among the rows
+the segment holds. Rows of the day above the watermark are read from SQL.
+A row can still commit late with an id below it, because ids are handed
+out before commit. So for a settle period after it is written, a segment is
+re-counted against SQL and rewritten if they differ.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Event
+from rollups import to_utc_naive, truncate
+
+SEGMENTS_ENABLED = os.getenv("SEGMENTS_ENABLED", "true").lower() == "true"
+SEGMENT_DIR = os.getenv("SEGMENT_DIR", "segments")
+# a day is compacted once it has been over for this long
+SEGMENT_CLOSE_AFTER_HOURS = int(os.getenv("SEGMENT_CLOSE_AFTER_HOURS", "2"))
+# how long a new segment is re-checked for rows committed late with ids below its watermark
+SEGMENT_SETTLE_MINUTES = int(os.getenv("SEGMENT_SETTLE_MINUTES", "10"))
+
+MAGIC = b"EVSEG001"
+NO_PROJECT = -1
+INT_COLUMNS = ("id", "timestamp", "project_id")
+CODE_COLUMNS = ("event_name", "user_id", "session_id")
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_micros(timestamp: datetime) -> int:
+    return (to_utc_naive(timestamp) - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def segment_name(day: datetime) -> str:
+    return f"events_{day:%Y%m%d}.seg"
+
+
+def _pad(file, position: int) -> int:
+    padding = -position % 8
+    file.write(b"\0" * padding)
+    return position + padding
+
+
+class SegmentWriter:
+    """
+    Build one day's segment from (id, project_id, event_name, user_id,
+    session_id, timestamp) rows given in timestamp order. Rows are kept as
+    typed arrays until finish() writes the file aside and renames it into place.
+    """
+
+    def __init__(self, path: str, day: datetime, watermark: int):
+        self.path = path
+        self.day = day
+        self.watermark = watermark
+        self.projects: dict[int, dict[str, array]] = {}
+        self.dictionaries = {name: {None: 0} for name in CODE_COLUMNS}
+
+    def extend(self, rows: Iterable[tuple]):
+        for event_id, project_id, event_name, user_id, session_id, timestamp in rows:
+            project = NO_PROJECT if project_id is None else project_id
+            columns = self.projects.get(project)
+            if columns is None:
+                columns = self.projects[project] = {
+                    **{name: array("q") for name in INT_COLUMNS},
+                    **{name: array("i") for name in CODE_COLUMNS},
+                }
+            columns["id"].append(event_id)
+            columns["timestamp"].append(to_micros(timestamp))
+            columns["project_id"].append(project)
+            for name, value in zip(CODE_COLUMNS, (event_name, user_id, session_id)):
+                codes = self.dictionaries[name]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                columns[name].append(code)
+
+    def finish(self) -> int:
+        """Write the segment; returns its row count"""
+        order = sorted(self.projects)
+        footer = {"day": self.day.isoformat(), "watermark": self.watermark,
+                  "rows": 0, "projects": {}, "columns": {}, "dictionaries": {}}
+        for project in order:
+            count = len(self.projects[project]["id"])
+            footer["projects"][str(project)] = [footer["rows"], footer["rows"] + count]
+            footer["rows"] += count
+
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(MAGIC)
+            position = len(MAGIC)
+            for name in INT_COLUMNS + CODE_COLUMNS:
+                position = _pad(file, position)
+                footer["columns"][name] = [position, "q" if name in INT_COLUMNS else "i"]
+                for project in order:
+                    data = self.projects[project][name].tobytes()
+                    file.write(data)
+                    position += len(data)
+            for name, codes in self.dictionaries.items():
+                data = json.dumps(list(codes)).encode()
+                footer["dictionaries"][name] = [position, len(data)]
+                file.write(data)
+                position += len(data)
+            data = json.dumps(footer).encode()
+            file.write(data)
+            file.write(struct.pack("<Q", len(data)) + MAGIC)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        return footer["rows"]
+
+
+class Segment:
+    """A memory-mapped segment; column() returns zero-copy views of the file"""
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise RuntimeError("Segments are only readable on little-endian hosts")
+        self.path = path
+        with open(path, "rb") as file:
+            self.mtime = os.fstat(file.fileno()).st_mtime_ns
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        length, magic = struct.unpack("<Q8s", self._mmap[-16:])
+        if magic != MAGIC or self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not an events segment: {path}")
+        footer = json.loads(self._mmap[-16 - length:-16])
+        self.day = datetime.fromisoformat(footer["day"])
+        self.end = self.day + timedelta(days=1)
+        self.watermark = footer["watermark"]
+        self.rows = footer["rows"]
+        self.projects = {int(project): tuple(bounds) for project, bounds in footer["projects"].items()}
+        self._columns = footer["columns"]
+        self._dictionary_offsets = footer["dictionaries"]
+        self._dictionaries: dict[str, list] = {}
+
+    def column(self, name: str) -> memoryview:
+        offset, typecode = self._columns[name]
+        size = self.rows * (8 if typecode == "q" else 4)
+        return memoryview(self._mmap)[offset:offset + size].cast(typecode)
+
+    def dictionary(self, name: str) -> list:
+        """Values of a dictionary-encoded column, indexed by code"""
+        values = self._dictionaries.get(name)
+        if values is None:
+            offset, length = self._dictionary_offsets[name]
+            values = self._dictionaries[name] = json.loads(self._mmap[offset:offset + length])
+        return values
+
+    def row_ranges(self, start_date: Optional[datetime] = None,
+                   end_date: Optional[datetime] = None,
+                   project_id: Optional[int] = None) -> list[tuple[int, int]]:
+        """Row ranges of a project (all projects if None) inside [start_date, end_date]"""
+        if project_id is None:
+            ranges = list(self.projects.values())
+        elif project_id in self.projects:
+            ranges = [self.projects[project_id]]
+        else:
+            return []
+        timestamps = self.column("timestamp")
+        low = to_micros(start_date) if start_date is not None else None
+        high = to_micros(end_date) if end_date is not None else None
+        result = []
+        for first, last in ranges:
+            if low is not None:
+                first = bisect.bisect_left(timestamps, low, first, last)
+            if high is not None:
+                last = bisect.bisect_right(timestamps, high, first, last)
+            if first < last:
+                result.append((first, last))
+        return result
+
+
+class EventScan:
+    """Exact event aggregates accumulated from segments and SQL rows"""
+
+    def __init__(self, users_by_event: bool = False):
+        self.total = 0
+        self.by_event: Counter = Counter()
+        self.users: set = set()
+        self.sessions: set = set()
+        self.users_by_event: Optional[dict[str, set]] = defaultdict(set) if users_by_event else None
+        self.min_timestamp: Optional[datetime] = None
+        self.max_timestamp: Optional[datetime] = None
+
+    def _extend_range(self, first: datetime, last: datetime):
+        if self.min_timestamp is None or first < self.min_timestamp:
+            self.min_timestamp = first
+        if self.max_timestamp is None or last > self.max_timestamp:
+            self.max_timestamp = last
+
+    def add_segment(self, segment: Segment, start_date: Optional[datetime] = None,
+                    end_date: Optional[datetime] = None, project_id: Optional[int] = None):
+        """Aggregate a segment's rows; counting and de-duplication run over the raw code arrays"""
+        names, users, sessions = (segment.column(name) for name in CODE_COLUMNS)
+        timestamps = segment.column("timestamp")
+        name_values, user_values, session_values = (segment.dictionary(name) for name in CODE_COLUMNS)
+        for first, last in segment.row_ranges(start_date, end_date, project_id):
+            self.total += last - first
+            for code, count in Counter(names[first:last]).items():
+                self.by_event[name_values[code]] += count
+            self.users.update(user_values[code] for code in set(users[first:last]) if code)
+            self.sessions.update(session_values[code] for code in set(sessions[first:last]) if code)
+            if self.users_by_event is not None:
+                for name_code, user_code in set(zip(names[first:last], users[first:last])):
+                    if user_code:
+                        self.users_by_event[name_values[name_code]].add(user_values[user_code])
+            self._extend_range(from_micros(timestamps[first]), from_micros(timestamps[last - 1]))
+
+    def add_rows(self, rows: Iterable[tuple]):
+        """Aggregate SQL rows of (event_name, user_id, session_id, count, min timestamp, max timestamp)"""
+        for event_name, user_id, session_id, count, first, last in rows:
+            self.total += count
+            self.by_event[event_name] += count
+            if user_id is not None:
+                self.users.add(user_id)
+                if self.users_by_event is not None:
+                    self.users_by_event[event_name].add(user_id)
+            if session_id is not None:
+                self.sessions.add(session_id)
+            self._extend_range(to_utc_naive(first), to_utc_naive(last))
+
+
+class SegmentStore:
+    """Directory of day segments, compacted from and read alongside the events table"""
+
+    def __init__(self, directory: str = SEGMENT_DIR, close_after_hours: int = SEGMENT_CLOSE_AFTER_HOURS,
+                 settle_minutes: int = SEGMENT_SETTLE_MINUTES):
+        self.directory = directory
+        self.close_after = timedelta(hours=close_after_hours)
+        self.settle = timedelta(minutes=settle_minutes)
+        self.segments: dict[datetime, Segment] = {}
+        self._mtime: Optional[int] = None
+
+    def refresh(self):
+        """Pick up segments written or removed by other processes"""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            self.segments, self._mtime = {}, None
+            return
+        if mtime == self._mtime:
+            return
+        segments = {}
+        for name in os.listdir(self.directory):
+            if not (name.startswith("events_") and name.endswith(".seg")):
+                continue
+            path = os.path.join(self.directory, name)
+            day = datetime.strptime(name[len("events_"):-len(".seg")], "%Y%m%d")
+            current = self.segments.get(day)
+            if current is not None and current.mtime == os.stat(path).st_mtime_ns:
+                segments[day] = current
+            else:
+                segments[day] = Segment(path)
+        self.segments, self._mtime = segments, mtime
+
+    def covering(self, start_date: Optional[datetime] = None,
+                 end_date: Optional[datetime] = None) -> list[Segment]:
+        """Segments of the days overlapping [start_date, end_date], in day order"""
+        self.refresh()
+        start_day = truncate(start_date, "day") if start_date is not None else None
+        end = to_utc_naive(end_date) if end_date is not None else None
+        return [
+            segment for day, segment in sorted(self.segments.items())
+            if (start_day is None or day >= start_day) and (end is None or day <= end)
+        ]
+
+    def tail_clause(self, segments: list[Segment]):
+        """
+        WHERE clause for the events not in segments: days without one, plus
+        rows committed to a compacted day after its watermark. Each branch is
+        a timestamp range or an id range, so both stay index scans.
+        """
+        from sqlalchemy import and_, or_
+
+        groups = []
+        for segment in segments:
+            if groups and groups[-1][1] == segment.day and groups[-1][2] == segment.watermark:
+                groups[-1][1] = segment.end
+            else:
+                groups.append([segment.day, segment.end, segment.watermark])
+
+        clauses = [Event.timestamp < groups[0][0]]
+        for (_, previous_end, _), (start, _, _) in zip(groups, groups[1:]):
+            if start > previous_end:
+                clauses.append(and_(Event.timestamp >= previous_end, Event.timestamp < start))
+        clauses.append(Event.timestamp >= groups[-1][1])
+        for start, end, watermark in groups:
+            clauses.append(and_(Event.id > watermark, Event.timestamp >= start, Event.timestamp < end))
+        return or_(*clauses)
+
+    def remove(self, days: Iterable[datetime]) -> list[datetime]:
+        """Delete the segments of days, which makes reads fall back to SQL for them"""
+        self.refresh()
+        removed = []
+        for day in days:
+            day = truncate(day, "day")
+            if self.segments.pop(day, None) is not None:
+                os.remove(os.path.join(self.directory, segment_name(day)))
+                removed.append(day)
+        return removed
+
+    def expire(self, cutoff: datetime) -> list[datetime]:
+        """Delete the segments of days starting before cutoff, which may hold rows retention deleted"""
+        self.refresh()
+        cutoff = to_utc_naive(cutoff)
+        return self.remove(sorted(day for day in self.segments if day < cutoff))
+
+    async def unsettled(self, session: AsyncSession) -> list[datetime]:
+        """
+        Days whose segment, written within the settle period, no longer
+        holds every row of the day with an id up to its watermark
+        """
+        from sqlalchemy import select, func
+
+        written_after = time.time_ns() - int(self.settle.total_seconds() * 1e9)
+        days = []
+        for day, segment in sorted(self.segments.items()):
+            if segment.mtime < written_after:
+                continue
+            result = await session.execute(select(func.count(Event.id)).where(
+                Event.timestamp >= day,
+                Event.timestamp < segment.end,
+                Event.id <= segment.watermark
+            ))
+            if result.scalar_one() != segment.rows:
+                days.append(day)
+        return days
+
+    async def compact(self, session: AsyncSession, now: Optional[datetime] = None) -> list[str]:
+        """
+        Write a segment for every closed day without one, or whose segment
+        missed rows that committed late; returns the new segment names.
+        Segments of days before the oldest remaining event (dropped by
+        retention) are removed.
+        """
+        from sqlalchemy import select, func
+
+        now = to_utc_naive(now or datetime.utcnow())
+        closed_until = truncate(now - self.close_after, "day")
+        result = await session.execute(
+            select(func.min(Event.timestamp)).where(Event.timestamp < closed_until)
+        )
+        oldest = result.scalar()
+
+        self.refresh()
+        first_day = truncate(oldest, "day") if oldest is not None else closed_until
+        self.remove([day for day in self.segments if day < first_day])
+        if oldest is None:
+            return []
+        self.remove(await self.unsettled(session))
+
+        os.makedirs(self.directory, exist_ok=True)
+        created = []
+        day = first_day
+        while day < closed_until:
+            if day not in self.segments:
+                query = select(
+                    Event.id, Event.project_id, Event.event_name, Event.user_id, Event.session_id, Event.timestamp
+                ).where(
+                    Event.timestamp >= day,
+                    Event.timestamp < day + timedelta(days=1)
+                ).order_by(Event.timestamp, Event.id).execution_options(yield_per=10000)
+                path = os.path.join(self.directory, segment_name(day))
+                writer = SegmentWriter(path, day, 0)
+                result = await session.stream(query)
+                async for partition in result.partitions():
+                    writer.extend(partition)
+                    # ids committed after this read, or still in flight, are not in the segment
+                    writer.watermark = max(writer.watermark, max(row[0] for row in partition))
+                writer.finish()
+                self.segments[day] = Segment(path)
+                created.append(segment_name(day))
+            day += timedelta(days=1)
+        self._mtime = None
+        return created
+
+
+# process-wide store consulted by DatabaseOperation, None when disabled
+segment_store: Optional[SegmentStore] = SegmentStore() if SEGMENTS_ENABLED else None
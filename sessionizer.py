@@ -0,0 +1,168 @@
+"""
+Incremental inactivity-gap sessionization of ingested events
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from database import async_session_maker
+from models import UserSession
+from rollups import to_utc_naive
+
+logger = logging.getLogger(__name__)
+
+SESSIONIZER_ENABLED = os.getenv("SESSIONIZER_ENABLED", "true").lower() == "true"
+SESSION_GAP_MINUTES = int(os.getenv("SESSION_GAP_MINUTES", "30"))
+# open sessions kept in memory; the least recently active is closed beyond this
+SESSION_MAX_OPEN = int(os.getenv("SESSION_MAX_OPEN", "100000"))
+SESSION_FLUSH_INTERVAL_SECONDS = int(os.getenv("SESSION_FLUSH_INTERVAL_SECONDS", "60"))
+
+
+class OpenSession:
+    """Running totals of a session that has not timed out yet"""
+
+    __slots__ = ("project_id", "user_id", "client_session_id", "started_at", "ended_at",
+                 "event_count", "entry_event", "exit_event")
+
+    def __init__(self, row: dict, timestamp: datetime):
+        self.project_id = row.get("project_id")
+        self.user_id = row.get("user_id")
+        self.client_session_id = row.get("session_id")
+        self.started_at = self.ended_at = timestamp
+        self.event_count = 1
+        self.entry_event = self.exit_event = row["event_name"]
+
+    def add(self, row: dict, timestamp: datetime):
+        self.event_count += 1
+        if timestamp < self.started_at:
+            self.started_at, self.entry_event = timestamp, row["event_name"]
+        if timestamp >= self.ended_at:
+            self.ended_at, self.exit_event = timestamp, row["event_name"]
+        if self.client_session_id is None:
+            self.client_session_id = row.get("session_id")
+
+    def to_row(self) -> dict:
+        return {
+            "project_id": self.project_id,
+            "user_id": self.user_id,
+            "client_session_id": self.client_session_id,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "duration_seconds": (self.ended_at - self.started_at).total_seconds(),
+            "event_count": self.event_count,
+            "entry_event": self.entry_event,
+            "exit_event": self.exit_event,
+        }
+
+
+class Sessionizer:
+    """
+    Group committed events into sessions per (project, user) that end after
+    gap of inactivity, and write closed sessions to the sessions table.
+
+    Events are keyed by user_id, or by the SDK's session_id when there is no
+    user. Open sessions live in memory, so a user's events should reach the
+    same worker; sessions still open at shutdown are written as closed.
+    """
+
+    def __init__(self, gap: timedelta = timedelta(minutes=SESSION_GAP_MINUTES),
+                 max_open: int = SESSION_MAX_OPEN,
+                 interval: float = SESSION_FLUSH_INTERVAL_SECONDS,
+                 session_factory=async_session_maker):
+        self.gap = gap
+        self.max_open = max_open
+        self.interval = interval
+        self.session_factory = session_factory
+        # least recently active first
+        self.open: OrderedDict[tuple, OpenSession] = OrderedDict()
+        self.closed: list[dict] = []
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, rows: list[dict]):
+        """Ingest listener: extend, close or open sessions with committed rows"""
+        with self._lock:
+            for row in rows:
+                if row.get("user_id") is not None:
+                    key = (row.get("project_id"), "user", row["user_id"])
+                elif row.get("session_id") is not None:
+                    key = (row.get("project_id"), "session", row["session_id"])
+                else:
+                    continue
+                timestamp = to_utc_naive(row["timestamp"])
+                current = self.open.get(key)
+                if current is not None and current.started_at - self.gap <= timestamp <= current.ended_at + self.gap:
+                    current.add(row, timestamp)
+                    self.open.move_to_end(key)
+                elif current is not None and timestamp < current.started_at:
+                    # too late for the open session: a session of its own
+                    self.closed.append(OpenSession(row, timestamp).to_row())
+                else:
+                    if current is not None:
+                        self.closed.append(current.to_row())
+                    self.open[key] = OpenSession(row, timestamp)
+                    self.open.move_to_end(key)
+            while len(self.open) > self.max_open:
+                _, evicted = self.open.popitem(last=False)
+                self.closed.append(evicted.to_row())
+
+    def expire(self, now: Optional[datetime] = None) -> int:
+        """Close sessions without events for longer than the gap; returns how many"""
+        cutoff = to_utc_naive(now or datetime.utcnow()) - self.gap
+        with self._lock:
+            expired = [key for key, current in self.open.items() if current.ended_at < cutoff]
+            for key in expired:
+                self.closed.append(self.open.pop(key).to_row())
+        return len(expired)
+
+    async def flush(self) -> int:
+        """Write closed sessions to the database; returns how many were written"""
+        from sqlalchemy import insert
+
+        with self._lock:
+            closed, self.closed = self.closed, []
+        if not closed:
+            return 0
+        try:
+            async with self.session_factory() as session:
+                await session.execute(insert(UserSession), closed)
+                await session.commit()
+        except Exception:
+            with self._lock:
+                self.closed[:0] = closed
+            raise
+        return len(closed)
+
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        self.expire(now)
+        return await self.flush()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task, then close and write every open session"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        with self._lock:
+            self.closed.extend(current.to_row() for current in self.open.values())
+            self.open.clear()
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Session flush failed")
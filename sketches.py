@@ -0,0 +1,115 @@
+"""
+Per-day HyperLogLog sketches of distinct users and sessions
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from hll import HyperLogLog, HLL_PRECISION
+from models import EventSketch
+from rollups import insert_for, truncate
+
+# event_name key of the sketch covering every event of a day
+ALL_EVENTS = "*"
+
+# which event column each sketch kind counts
+SKETCH_COLUMNS = {
+    "user": "user_id",
+    "session": "session_id",
+}
+
+
+def build_sketches(rows: list[dict], precision: int = HLL_PRECISION) -> dict[tuple, HyperLogLog]:
+    """Sketch rows per (project_id, event_name, day, kind), plus the all-events sketch"""
+    sketches = defaultdict(lambda: HyperLogLog(precision))
+    for row in rows:
+        project_id = row.get("project_id") or 0
+        day = truncate(row["timestamp"], "day")
+        for kind, column in SKETCH_COLUMNS.items():
+            value = row.get(column)
+            if value is None:
+                continue
+            sketches[(project_id, row["event_name"], day, kind)].add(value)
+            sketches[(project_id, ALL_EVENTS, day, kind)].add(value)
+    return sketches
+
+
+async def apply_sketches(session: AsyncSession, rows: list[dict]):
+    """
+    Merge rows into the stored sketches inside the caller's transaction.
+
+    Missing sketches are created empty first (ON CONFLICT DO NOTHING) and
+    the affected rows are then locked, merged and written back, so
+    concurrent batches never lose each other's registers.
+    """
+    from sqlalchemy import select, update, tuple_, bindparam
+
+    sketches = build_sketches(rows)
+    if not sketches:
+        return
+
+    insert = insert_for(session)
+    keys = sorted(sketches)
+    empty = [
+        {
+            "project_id": project_id, "event_name": event_name, "bucket": bucket, "kind": kind,
+            "precision": sketches[(project_id, event_name, bucket, kind)].precision,
+            "registers": bytes(sketches[(project_id, event_name, bucket, kind)].m),
+        }
+        for project_id, event_name, bucket, kind in keys
+    ]
+    await session.execute(insert(EventSketch).on_conflict_do_nothing(), empty)
+
+    key_columns = (EventSketch.project_id, EventSketch.event_name, EventSketch.bucket, EventSketch.kind)
+    query = select(*key_columns, EventSketch.precision, EventSketch.registers).where(
+        tuple_(*key_columns).in_(keys)
+    ).order_by(*key_columns).with_for_update()
+    result = await session.execute(query)
+
+    merged_rows = []
+    for project_id, event_name, bucket, kind, precision, registers in result.all():
+        merged = HyperLogLog(precision, registers).merge(sketches[(project_id, event_name, bucket, kind)])
+        merged_rows.append({
+            "k_project_id": project_id, "k_event_name": event_name, "k_bucket": bucket, "k_kind": kind,
+            "precision": merged.precision, "registers": merged.to_bytes(),
+        })
+
+    table = EventSketch.__table__
+    query = update(table).where(
+        table.c.project_id == bindparam("k_project_id"),
+        table.c.event_name == bindparam("k_event_name"),
+        table.c.bucket == bindparam("k_bucket"),
+        table.c.kind == bindparam("k_kind"),
+    )
+    await session.execute(query, merged_rows)
+
+
+async def merge_sketches(session: AsyncSession, kind: str,
+                         start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                         event_names: Optional[list[str]] = None,
+                         project_id: Optional[int] = None) -> dict[str, HyperLogLog]:
+    """Merge the stored sketches of a kind over a day range, one result per event name"""
+    from sqlalchemy import select
+
+    query = select(EventSketch.event_name, EventSketch.precision, EventSketch.registers).where(
+        EventSketch.kind == kind,
+        EventSketch.event_name.in_(event_names or [ALL_EVENTS])
+    )
+    if start_date is not None:
+        query = query.where(EventSketch.bucket >= truncate(start_date, "day"))
+    if end_date is not None:
+        query = query.where(EventSketch.bucket <= truncate(end_date, "day"))
+    if project_id is not None:
+        query = query.where(EventSketch.project_id == project_id)
+
+    merged = {}
+    result = await session.execute(query)
+    for event_name, precision, registers in result.all():
+        sketch = HyperLogLog(precision, registers)
+        if event_name in merged:
+            merged[event_name].merge(sketch)
+        else:
+            merged[event_name] = sketch
+    return merged
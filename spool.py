@@ -0,0 +1,454 @@
+"""
+Durable on-disk ingestion spool with consumer workers that bulk-load it
+
+Accepted events are appended to segment files as CRC-framed records and
+acknowledged once an fsync covering them has completed; fsyncs are shared
+by every append of the same interval. Consumers tail the segments and load
+them with create_events, storing how far they got in the same transaction,
+so after a crash loading resumes exactly where the last commit ended.
+
+Usage (consumers in separate processes, one per index):
+    python spool.py --index 0 --count 2
+    python spool.py --index 1 --count 2
+
+Standalone consumers register the same ingest listeners as the API and
+run their own sessionizer. Heavy hitters and live counters are kept per
+process, though, so /events/top/?window= and /ws/live of the API only
+see events loaded by its in-process consumers (SPOOL_ENABLED).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import zlib
+from datetime import datetime
+from typing import Optional
+
+from database import async_session_maker, DatabaseOperation
+from ingestion import BufferFullError
+from models import SpoolOffset
+from rollups import insert_for
+
+logger = logging.getLogger(__name__)
+
+SPOOL_ENABLED = os.getenv("SPOOL_ENABLED", "false").lower() == "true"
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+# name of this host's spool in spool_offsets; must differ between hosts sharing a database
+SPOOL_NAME = os.getenv("SPOOL_NAME", socket.gethostname())
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+# appends wait at most this long for the fsync that covers them
+SPOOL_FSYNC_INTERVAL_MS = int(os.getenv("SPOOL_FSYNC_INTERVAL_MS", "5"))
+# appends are rejected with 429 beyond this much unloaded data
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+SPOOL_CONSUMERS = int(os.getenv("SPOOL_CONSUMERS", "2"))
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", "1000"))
+SPOOL_POLL_INTERVAL_MS = int(os.getenv("SPOOL_POLL_INTERVAL_MS", "50"))
+# a batch failing this many times in a row is bisected and its bad records dead-lettered
+SPOOL_MAX_FAILURES = int(os.getenv("SPOOL_MAX_FAILURES", "3"))
+
+# record frame: payload length, CRC32 of the payload, payload
+HEADER = struct.Struct("<II")
+MAX_RECORD_BYTES = 16 * 1024 * 1024
+SEGMENT_PREFIX = "spool-"
+SEGMENT_SUFFIX = ".log"
+# records no consumer could load, framed like a segment
+DEAD_LETTER_NAME = "dead-letter.log"
+
+
+class SpoolFullError(BufferFullError):
+    """ Raised when consumers have fallen SPOOL_MAX_BYTES behind """
+
+
+def segment_name(sequence: int) -> str:
+    return f"{SEGMENT_PREFIX}{sequence:012d}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory: str) -> list[tuple[int, str]]:
+    """(sequence, path) of the segments in directory, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            segments.append((int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def encode_record(event_data: dict) -> bytes:
+    payload = json.dumps(event_data, default=lambda value: value.isoformat(), separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_record(payload: bytes) -> dict:
+    event_data = json.loads(payload)
+    event_data["timestamp"] = datetime.fromisoformat(event_data["timestamp"])
+    return event_data
+
+
+def read_records(path: str, offset: int, max_records: int) -> tuple[list[bytes], int, bool]:
+    """
+    Up to max_records payloads from offset, the offset after the last one,
+    and whether reading stopped at a bad frame rather than the end of data.
+    A record still being written reads as the end of data.
+    """
+    records = []
+    corrupt = False
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while len(records) < max_records:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, checksum = HEADER.unpack(header)
+            if not 0 < length <= MAX_RECORD_BYTES:
+                corrupt = True
+                break
+            payload = file.read(length)
+            if len(payload) < length:
+                break
+            if zlib.crc32(payload) != checksum:
+                corrupt = True
+                break
+            records.append(payload)
+            offset += HEADER.size + length
+    return records, offset, corrupt
+
+
+class SpoolWriter:
+    """
+    Appends records to the newest segment and rolls over at segment_bytes.
+    A started writer always opens a new segment, so every older one is
+    sealed and a torn tail left by a crash is never appended to.
+    """
+
+    def __init__(self, directory: str = SPOOL_DIR,
+                 segment_bytes: int = SPOOL_SEGMENT_BYTES,
+                 fsync_interval: float = SPOOL_FSYNC_INTERVAL_MS / 1000,
+                 max_bytes: int = SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.sequence = 0
+        self.spooled_bytes = 0
+        self._fd: Optional[int] = None
+        self._size = 0
+        self._retired: list[int] = []
+        self._new_segment = False
+        self._waiter: Optional[asyncio.Future] = None
+        self._dirty: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _open_segment(self):
+        segments = list_segments(self.directory)
+        self.sequence = max(self.sequence, segments[-1][0] if segments else 0) + 1
+        path = os.path.join(self.directory, segment_name(self.sequence))
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = 0
+        self._new_segment = True
+        self._recount()
+
+    def _recount(self):
+        """Consumers delete loaded segments, so count what is still waiting on disk"""
+        self.spooled_bytes = sum(os.path.getsize(path) for _, path in list_segments(self.directory))
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._open_segment()
+        self._waiter = asyncio.get_running_loop().create_future()
+        self._dirty = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def append(self, event_data: dict):
+        """Spool one event; returns once it is on disk"""
+        if not self.running:
+            raise RuntimeError("Ingestion spool is not running")
+        if self.spooled_bytes >= self.max_bytes:
+            self._recount()
+        if self.spooled_bytes >= self.max_bytes:
+            raise SpoolFullError(f"Ingestion spool is full ({self.spooled_bytes} bytes waiting to be loaded)")
+        # stamp the event now, not when a consumer gets to it
+        if event_data.get("timestamp") is None:
+            event_data = {**event_data, "timestamp": datetime.utcnow()}
+        frame = encode_record(event_data)
+        os.write(self._fd, frame)
+        self._size += len(frame)
+        self.spooled_bytes += len(frame)
+        waiter = self._waiter
+        if self._size >= self.segment_bytes:
+            self._retired.append(self._fd)
+            self._open_segment()
+        self._dirty.set()
+        await asyncio.shield(waiter)
+
+    def _sync(self, fd: int, retired: list[int], new_segment: bool):
+        for old in retired:
+            os.fsync(old)
+            os.close(old)
+        os.fsync(fd)
+        if new_segment:
+            # make the new file's directory entry durable too
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    async def _sync_once(self):
+        loop = asyncio.get_running_loop()
+        self._dirty.clear()
+        waiter, self._waiter = self._waiter, loop.create_future()
+        retired, self._retired = self._retired, []
+        new_segment, self._new_segment = self._new_segment, False
+        try:
+            await loop.run_in_executor(None, self._sync, self._fd, retired, new_segment)
+        except Exception as e:
+            logger.exception("Spool fsync failed")
+            waiter.set_exception(e)
+        else:
+            waiter.set_result(None)
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            # let the appends of one interval share an fsync
+            await asyncio.sleep(self.fsync_interval)
+            await self._sync_once()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._sync_once()
+        os.close(self._fd)
+        self._fd = None
+
+
+class SpoolConsumer:
+    """
+    Loads the segments whose sequence % count == index, oldest first, in
+    batches of batch_size. Each batch's events and the new segment offset
+    commit together; a sealed segment is deleted once fully loaded. A batch
+    that fails max_failures times is loaded in halves down to single
+    records, and records that still fail go to the dead-letter file.
+    """
+
+    def __init__(self, index: int = 0, count: int = 1,
+                 directory: str = SPOOL_DIR,
+                 name: str = SPOOL_NAME,
+                 batch_size: int = SPOOL_BATCH_SIZE,
+                 poll_interval: float = SPOOL_POLL_INTERVAL_MS / 1000,
+                 max_failures: int = SPOOL_MAX_FAILURES,
+                 session_factory=async_session_maker):
+        self.index = index
+        self.count = count
+        self.directory = directory
+        self.name = name
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_failures = max_failures
+        self.session_factory = session_factory
+        self.offsets: Optional[dict[str, int]] = None
+        self.failures: dict[str, int] = {}
+        self.loaded_events = 0
+        self.dead_letters = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _key(self, path: str) -> str:
+        return f"{self.name}/{os.path.basename(path)}"
+
+    async def _load_offsets(self):
+        from sqlalchemy import select
+
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(SpoolOffset.segment, SpoolOffset.position).where(SpoolOffset.segment.like(f"{self.name}/%"))
+            )
+            self.offsets = dict(result.all())
+
+    async def _load(self, path: str, records: list[bytes], position: int):
+        key = self._key(path)
+        async with self.session_factory() as session:
+            insert = insert_for(session)
+            await session.execute(insert(SpoolOffset).values(segment=key, position=position).on_conflict_do_update(
+                index_elements=["segment"], set_={"position": position}
+            ))
+            if records:
+                # create_events commits the offset together with the events
+                await DatabaseOperation(session).create_events([decode_record(payload) for payload in records])
+            else:
+                await session.commit()
+        self.offsets[key] = position
+        self.loaded_events += len(records)
+
+    def _dead_letter(self, path: str, payload: bytes):
+        frame = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with open(os.path.join(self.directory, DEAD_LETTER_NAME), "ab") as file:
+            file.write(frame)
+            file.flush()
+            os.fsync(file.fileno())
+        self.dead_letters += 1
+        logger.error("Dead-lettered a spooled event from %s that could not be loaded", path)
+
+    async def _bisect(self, path: str, records: list[bytes], offset: int) -> int:
+        """Load records from offset in halves; a single record that fails is dead-lettered and skipped"""
+        position = offset + sum(HEADER.size + len(payload) for payload in records)
+        try:
+            await self._load(path, records, position)
+            return len(records)
+        except Exception:
+            if len(records) == 1:
+                logger.exception("Spooled event in %s at offset %d cannot be loaded", path, offset)
+                self._dead_letter(path, records[0])
+                await self._load(path, [], position)
+                return 0
+        middle = len(records) // 2
+        loaded = await self._bisect(path, records[:middle], offset)
+        offset += sum(HEADER.size + len(payload) for payload in records[:middle])
+        return loaded + await self._bisect(path, records[middle:], offset)
+
+    async def _load_batch(self, path: str, records: list[bytes], offset: int, position: int) -> int:
+        key = self._key(path)
+        failures = self.failures.get(key, 0)
+        if failures >= self.max_failures:
+            loaded = await self._bisect(path, records, offset)
+        else:
+            try:
+                await self._load(path, records, position)
+            except Exception:
+                self.failures[key] = failures + 1
+                raise
+            loaded = len(records)
+        self.failures.pop(key, None)
+        return loaded
+
+    async def _forget(self, path: str):
+        from sqlalchemy import delete
+
+        key = self._key(path)
+        os.remove(path)
+        async with self.session_factory() as session:
+            await session.execute(delete(SpoolOffset).where(SpoolOffset.segment == key))
+            await session.commit()
+        self.offsets.pop(key, None)
+        self.failures.pop(key, None)
+
+    async def run_once(self) -> int:
+        """Load at most one batch from each assigned segment; returns the events loaded"""
+        if self.offsets is None:
+            await self._load_offsets()
+        segments = list_segments(self.directory)
+        newest = segments[-1][0] if segments else None
+        loaded = 0
+        for sequence, path in segments:
+            if sequence % self.count != self.index:
+                continue
+            offset = self.offsets.get(self._key(path), 0)
+            records, position, corrupt = read_records(path, offset, self.batch_size)
+            sealed = sequence != newest
+            if records:
+                try:
+                    loaded += await self._load_batch(path, records, offset, position)
+                except Exception:
+                    # keep loading the other segments; this batch is retried on the next pass
+                    logger.exception("Loading spooled events from %s failed", path)
+                    continue
+            if sealed and len(records) < self.batch_size:
+                if corrupt:
+                    logger.error("Spool segment %s is corrupt after offset %d; skipping %d bytes",
+                                 path, position, os.path.getsize(path) - position)
+                await self._forget(path)
+        return loaded
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop after the current batch; whatever is left is loaded on the next start"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                loaded = await self.run_once()
+            except Exception:
+                logger.exception("Loading spooled events failed; retrying")
+                # offsets may have moved on in a transaction that did not commit
+                self.offsets = None
+                loaded = 0
+            if not loaded:
+                await asyncio.sleep(self.poll_interval)
+
+
+class IngestionSpool:
+    """A writer plus SPOOL_CONSUMERS consumer tasks sharing one directory"""
+
+    def __init__(self, directory: str = SPOOL_DIR, consumers: int = SPOOL_CONSUMERS,
+                 session_factory=async_session_maker):
+        self.writer = SpoolWriter(directory)
+        self.consumers = [
+            SpoolConsumer(index, consumers, directory, session_factory=session_factory)
+            for index in range(consumers)
+        ]
+
+    @property
+    def running(self) -> bool:
+        return self.writer.running
+
+    async def append(self, event_data: dict):
+        await self.writer.append(event_data)
+
+    async def start(self):
+        await self.writer.start()
+        for consumer in self.consumers:
+            await consumer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+        for consumer in self.consumers:
+            await consumer.stop()
+
+
+async def main(index: int, count: int):
+    from database import engine
+    from main import SESSIONIZER_ENABLED, register_ingest_listeners, sessionizer
+
+    register_ingest_listeners()
+    if SESSIONIZER_ENABLED:
+        await sessionizer.start()
+    consumer = SpoolConsumer(index, count)
+    await consumer.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await consumer.stop()
+        # sessions still open, including those of the last loaded events
+        await sessionizer.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load spooled events into the database")
+    parser.add_argument("--index", type=int, default=0, help="This consumer's index")
+    parser.add_argument("--count", type=int, default=1, help="Number of consumers across processes")
+    args = parser.parse_args()
+    asyncio.run(main(args.index, args.count))
@@ -0,0 +1,38 @@
+"""
+Tests for the windowed Bloom filters behind event_uuid deduplication.
+"""
+
+import os
+import uuid
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from dedup import BloomFilter, DuplicateFilter
+
+
+def test_bloom_filter_has_no_false_negatives_and_bounded_false_positives():
+    bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+    items = [str(uuid.uuid4()) for _ in range(10_000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(str(uuid.uuid4()) in bloom for _ in range(10_000))
+    assert false_positives < 200
+    assert len(bloom.bits) < 10_000 * 10 // 8 * 1.1
+
+
+def test_duplicate_filter_forgets_after_window_and_rotates_at_capacity():
+    dedup = DuplicateFilter(window=100, generations=4, capacity=1000, error_rate=0.001)
+    assert not dedup.check_and_add("a", now=0)
+    assert dedup.check_and_add("a", now=10)
+    # "a" lives in the first generation, which the fourth rotation drops
+    for now in (25, 50, 75, 100):
+        dedup.check_and_add(f"tick-{now}", now=now)
+    assert len(dedup.filters) == 4
+    assert not dedup.check_and_add("a", now=100)
+
+    full = DuplicateFilter(window=100, generations=2, capacity=10, error_rate=0.01)
+    for index in range(25):
+        full.check_and_add(str(index), now=0)
+    assert len(full.filters) == 2
+    assert full.memory_bytes == sum(len(bloom.bits) for _, bloom in full.filters)
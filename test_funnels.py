@@ -0,0 +1,50 @@
+"""
+Tests for the single-pass funnel counter.
+"""
+
+from datetime import datetime, timedelta
+
+from funnels import DurationHistogram, FunnelCounter
+
+T0 = datetime(2024, 1, 1)
+DAY = 86400
+
+def rows_for(user_id, *steps):
+    return [(user_id, name, T0 + timedelta(hours=hours)) for name, hours in steps]
+
+
+def test_funnel_counts_and_window():
+    counter = FunnelCounter(["signup", "activate", "purchase"], window_seconds=7 * DAY)
+    rows = (
+        rows_for("a", ("signup", 0), ("activate", 1), ("purchase", 3))
+        # purchase outside the window of the only signup
+        + rows_for("b", ("signup", 0), ("activate", 2), ("purchase", 24 * 8))
+        # a later signup restarts the window, so the purchase counts
+        + rows_for("c", ("signup", 0), ("signup", 24 * 5), ("activate", 24 * 6), ("purchase", 24 * 11))
+        # steps out of order
+        + rows_for("d", ("activate", 0), ("signup", 1))
+        + rows_for("e", ("purchase", 0))
+    )
+    counter.add(rows[:5])
+    counter.add(rows[5:])
+    result = counter.result()
+
+    assert [step["count"] for step in result] == [4, 3, 2]
+    assert result[1]["conversion_rate"] == 0.75
+    assert result[2]["overall_conversion"] == 0.5
+    # activate after 1h (a), 2h (b) and 24h (c)
+    assert abs(result[1]["median_seconds_from_previous"] - 2 * 3600) < 2 * 3600 * 0.01
+    assert result[0]["median_seconds_from_previous"] is None
+
+
+def test_funnel_repeated_step_and_entry_range():
+    counter = FunnelCounter(["view", "view"], window_seconds=DAY, start_date=T0, end_date=T0 + timedelta(hours=5))
+    counter.add(rows_for("a", ("view", 1)) + rows_for("b", ("view", 1), ("view", 2)) + rows_for("c", ("view", 10)))
+    assert [step["count"] for step in counter.result()] == [2, 1]
+
+
+def test_duration_histogram_median():
+    histogram = DurationHistogram()
+    for seconds in [0, 5, 60, 3600, 86400]:
+        histogram.add(seconds)
+    assert abs(histogram.median() - 60) <= 60 * 0.005
@@ -0,0 +1,41 @@
+"""
+Tests for the streaming top-K trackers.
+"""
+
+from datetime import datetime, timedelta
+
+from heavy_hitters import SpaceSaving, HeavyHitters
+
+def test_space_saving_error_bound():
+    summary = SpaceSaving(capacity=5)
+    stream = ["a"] * 50 + ["b"] * 30 + [f"rare{i}" for i in range(40)] + ["c"] * 20
+    for key in stream:
+        summary.add(key)
+
+    assert len(summary.counters) == 5
+    assert summary.total == len(stream)
+    for key, (count, error) in summary.counters.items():
+        assert error <= summary.total / summary.capacity
+        assert count - error <= stream.count(key) <= count
+    assert summary.counters["a"][0] - summary.counters["a"][1] <= 50
+
+
+def test_heavy_hitters_windows_and_projects():
+    tracker = HeavyHitters(capacity=10)
+    now = datetime.utcnow()
+    rows = (
+        [{"event_name": "page_view", "user_id": f"user{i % 3}", "timestamp": now, "project_id": 1} for i in range(6)]
+        + [{"event_name": "signup", "user_id": "user9", "timestamp": now, "project_id": 2} for _ in range(2)]
+        # older than the 5 minute window but inside the hour
+        + [{"event_name": "signup", "user_id": "user8", "timestamp": now - timedelta(minutes=20), "project_id": 2}]
+    )
+    tracker.record(rows)
+
+    top = tracker.top("5m")
+    assert [(event["event_name"], event["count"]) for event in top] == [("page_view", 6), ("signup", 2)]
+    assert top[0]["unique_users"] is None
+    assert top[0]["max_error"] == 0
+    assert top[0]["percentage"] == 75
+
+    assert tracker.top("1h", project_id=2)[0]["count"] == 3
+    assert tracker.top("5m", project_id=3) == []
@@ -0,0 +1,36 @@
+"""
+Tests for the HyperLogLog sketch.
+"""
+
+import pytest
+from hll import HyperLogLog
+
+
+def test_count_within_error_bound():
+    sketch = HyperLogLog(precision=12)
+    sketch.update(f"user{i}" for i in range(50000))
+    assert abs(sketch.count() - 50000) < 50000 * sketch.relative_error * 3
+
+
+def test_merge_is_union():
+    first, second = HyperLogLog(precision=10), HyperLogLog(precision=10)
+    first.update(f"user{i}" for i in range(0, 3000))
+    second.update(f"user{i}" for i in range(2000, 5000))
+
+    union = HyperLogLog(precision=10)
+    union.update(f"user{i}" for i in range(5000))
+    assert first.merge(second).registers == union.registers
+
+
+def test_merge_across_precisions_reduces():
+    high, low = HyperLogLog(precision=12), HyperLogLog(precision=8)
+    high.update(f"user{i}" for i in range(1000))
+    low.update(f"user{i}" for i in range(1000))
+
+    assert high.reduce(8).registers == low.registers
+    assert high.merge(low).precision == 8
+
+
+def test_invalid_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=20)
@@ -0,0 +1,104 @@
+"""
+Tests for the ingestion buffer.
+"""
+
+import asyncio
+import os
+import pytest
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from ingestion import IngestionBuffer, BufferFullError
+
+
+class RecordingWriter:
+    """Writer that stores batches in memory and hands out sequential ids"""
+
+    def __init__(self):
+        self.batches = []
+        self.next_id = 1
+
+    async def __call__(self, events_data):
+        self.batches.append(events_data)
+        created = []
+        for _ in events_data:
+            created.append({"id": self.next_id, "timestamp": None})
+            self.next_id += 1
+        return created
+
+
+@pytest.mark.asyncio
+async def test_buffer_flushes_on_batch_size():
+    """A full batch is flushed without waiting for the delay"""
+    writer = RecordingWriter()
+    buffer = IngestionBuffer(writer=writer, max_size=100, batch_size=3, max_delay=10)
+    await buffer.start()
+
+    for i in range(3):
+        await buffer.submit({"event_name": f"event_{i}"})
+    await asyncio.sleep(0.05)
+
+    assert [len(batch) for batch in writer.batches] == [3]
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_buffer_flushes_on_delay_and_returns_ids():
+    """Waiting callers get their ids once the delayed flush commits"""
+    writer = RecordingWriter()
+    buffer = IngestionBuffer(writer=writer, max_size=100, batch_size=100, max_delay=0.01)
+    await buffer.start()
+
+    results = await asyncio.gather(
+        buffer.submit({"event_name": "a"}, wait=True),
+        buffer.submit({"event_name": "b"}, wait=True),
+    )
+
+    assert [row["id"] for row in results] == [1, 2]
+    assert len(writer.batches) == 1
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_buffer_rejects_when_full_and_drains_on_stop():
+    """Overflow raises BufferFullError and stop() flushes what was queued"""
+    writer = RecordingWriter()
+    buffer = IngestionBuffer(writer=writer, max_size=2, batch_size=10, max_delay=10)
+    await buffer.start()
+
+    await buffer.submit({"event_name": "a"})
+    await asyncio.sleep(0)
+    await buffer.submit({"event_name": "b"})
+    await buffer.submit({"event_name": "c"})
+    with pytest.raises(BufferFullError):
+        await buffer.submit({"event_name": "d"})
+
+    await buffer.stop()
+    assert sum(len(batch) for batch in writer.batches) == 3
+    assert not buffer.running
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_retries_halves_and_dead_letters_bad_events(tmp_path):
+    """One bad event does not lose its batch; it alone goes to the dead-letter file"""
+    import json
+
+    writer = RecordingWriter()
+
+    async def failing_writer(events_data):
+        if any(event_data["event_name"] == "bad" for event_data in events_data):
+            raise ValueError("cannot store")
+        return await writer(events_data)
+
+    path = tmp_path / "dead-letter.jsonl"
+    buffer = IngestionBuffer(writer=failing_writer, max_size=100, batch_size=100, max_delay=10,
+                             dead_letter_path=str(path))
+    await buffer.start()
+    for name in ("a", "b", "bad", "c", "d"):
+        await buffer.submit({"event_name": name})
+    await buffer.stop()
+
+    stored = [event_data["event_name"] for batch in writer.batches for event_data in batch]
+    assert stored == ["a", "b", "c", "d"]
+    assert [json.loads(line) for line in path.read_text().splitlines()] == [{"event_name": "bad"}]
+    assert (buffer.failed_events, buffer.dead_letters) == (1, 1)
@@ -0,0 +1,56 @@
+"""
+Tests for the live dashboard feed.
+"""
+
+import json
+from datetime import datetime
+
+import pytest
+
+from heavy_hitters import HeavyHitters
+from live import LiveFeed
+
+
+def rows(*names, project_id=1):
+    return [{"event_name": name, "project_id": project_id, "user_id": "u1", "timestamp": datetime.utcnow()}
+            for name in names]
+
+
+@pytest.mark.asyncio
+async def test_one_message_fans_out_as_deltas():
+    tracker = HeavyHitters()
+    feed = LiveFeed(interval=1, rate_window=2, tracker=tracker)
+    project, everything = feed.subscribe(1), [feed.subscribe(None) for _ in range(3)]
+
+    for batch in (rows("view", "view", "click"), rows("view", project_id=2)):
+        tracker.record(batch)
+        feed.record(batch)
+    assert feed.run_once(now=100.0) == 4
+
+    message = json.loads(project.get_nowait())
+    assert message["event_counts"] == {"view": 2, "click": 1}
+    assert (message["total_events"], message["events"], message["events_per_second"]) == (3, 3, 3.0)
+    assert message["top_events"][0]["event_name"] == "view"
+    # every subscriber of a scope receives the same serialised message
+    assert len({queue.get_nowait() for queue in everything}) == 1
+
+    feed.record(rows("click"))
+    feed.run_once(now=101.0)
+    message = json.loads(project.get_nowait())
+    assert (message["total_events"], message["event_counts"], message["events_per_second"]) == (4, {"click": 1}, 2.0)
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_keeps_newest_messages():
+    feed = LiveFeed(queue_size=2, tracker=None)
+    queue = feed.subscribe(None)
+    for tick in range(5):
+        feed.record(rows("view"))
+        feed.run_once(now=float(tick))
+    totals = [json.loads(queue.get_nowait())["total_events"] for _ in range(queue.qsize())]
+    assert totals == [4, 5]
+
+    feed.unsubscribe(None, queue)
+    assert feed.run_once() == 0
+    # a new subscriber starts from the last message
+    assert json.loads(feed.subscribe(None).get_nowait())["total_events"] == 5
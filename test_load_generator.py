@@ -0,0 +1,35 @@
+"""
+Tests for the benchmark event generator and latency reports.
+"""
+
+from collections import Counter
+from datetime import datetime
+
+from benchmarks.generator import EventGenerator
+from benchmarks.load import percentile, summarize
+
+END = datetime(2024, 3, 1)
+
+
+def test_generator_is_reproducible_and_skewed():
+    events = list(EventGenerator(seed=7, end=END).batches(20000))[0]
+    again = list(EventGenerator(seed=7, end=END).batches(20000))[0]
+    assert events == again
+
+    names = Counter(event["event_name"] for event in events)
+    # Zipf: the top name is far more common than the tenth
+    assert names["event_1"] > 5 * names["event_10"]
+    users = Counter(event["user_id"] for event in events)
+    assert users.most_common(1)[0][0] == "user1"
+
+    hours = Counter(event["timestamp"].hour for event in events)
+    assert hours[15] > 3 * hours[3]
+    assert all(datetime(2024, 1, 31) <= event["timestamp"] < END for event in events)
+
+
+def test_percentiles_use_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert [percentile(values, share) for share in (0.5, 0.95, 0.99)] == [50.0, 95.0, 99.0]
+    assert percentile([3.0], 0.99) == 3.0
+    report = summarize([5.0, 1.0, 3.0], errors=1, seconds=2)
+    assert (report["requests"], report["throughput_rps"], report["p50_ms"], report["max_ms"]) == (3, 1.5, 3.0, 5.0)
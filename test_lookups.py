@@ -0,0 +1,35 @@
+"""
+Tests for user-agent parsing and the lookup id cache.
+"""
+
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from lookups import LookupCache, parse_user_agent
+from models import IpAddress
+
+CHROME_WINDOWS = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+EDGE_WINDOWS = CHROME_WINDOWS + " Edg/120.0.0.0"
+SAFARI_IPAD = ("Mozilla/5.0 (iPad; CPU OS 17_0 like Mac OS X) AppleWebKit/605.1.15 "
+               "(KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1")
+CHROME_ANDROID = ("Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36")
+
+
+def test_parse_user_agent():
+    assert parse_user_agent(CHROME_WINDOWS) == ("Chrome", "Windows", "desktop")
+    assert parse_user_agent(EDGE_WINDOWS) == ("Edge", "Windows", "desktop")
+    assert parse_user_agent(SAFARI_IPAD) == ("Safari", "iOS", "tablet")
+    assert parse_user_agent(CHROME_ANDROID) == ("Chrome", "Android", "mobile")
+    assert parse_user_agent("Googlebot/2.1 (+http://www.google.com/bot.html)")[2] == "bot"
+    assert parse_user_agent("Unknown") == (None, None, None)
+
+
+def test_lookup_cache_evicts_least_recently_used():
+    cache = LookupCache(IpAddress, max_size=2)
+    cache.remember({"10.0.0.1": 1, "10.0.0.2": 2})
+    cache.remember({"10.0.0.1": 1})
+    cache.remember({"10.0.0.3": 3})
+    assert list(cache.ids) == ["10.0.0.1", "10.0.0.3"]
@@ -2,16 +2,25 @@
 Basic test for the main module.
 """
 
+import csv
+import json
+import os
 import pytest
 import pytest_asyncio
-from fastapi.testclient import TestClient
-from main import app
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from database import get_session
-from models import EventCreate
 
 # Test database setup
 TEST_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
+os.environ.setdefault("DATABASE_URL", TEST_DATABASE_URL)
+
+from fastapi.testclient import TestClient
+from main import app
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from database import get_session, DatabaseOperation
+from models import EventCreate, Event, EventPartition, Project
 
 test_engine = create_async_engine(
     TEST_DATABASE_URL,
@@ -39,6 +48,9 @@ client = TestClient(app)
 @pytest_asyncio.fixture(scope="function")
 async def setup_database():
     """Fixture to set up the test database"""
+    # data versions restart with the tables, so cache keys from earlier tests would repeat
+    from result_cache import result_cache
+    result_cache.entries.clear()
     async with test_engine.begin() as conn:
         # Create all tables
         await conn.run_sync(SQLModel.metadata.create_all)
@@ -48,7 +60,7 @@ async def setup_database():
         await conn.run_sync(SQLModel.metadata.drop_all)
 
 
-@pytest_asyncio
+@pytest.mark.asyncio
 async def test_create_event(setup_database):
     """Test creating an event"""
     event_data = {
@@ -87,8 +99,7 @@ async def test_get_events(setup_database):
             "session_id": f"session{i}",
             "properties": {"page": f"/page_{i}"},  
         }
-
-    response = client.post("/events/", json=event_data)
+        response = client.post("/events/", json=event_data)
 
 # then get the events
     response = client.get("/events/?limit=5&offset=0")
@@ -98,7 +109,7 @@ async def test_get_events(setup_database):
     data = response.json()
     assert data["total_events"] == 3
     assert len(data["events"]) == 3
-    assert data["limits"] == 5
+    assert data["limit"] == 5
     assert data["offset"] == 0
     assert "total_events" in data
     assert "events" in data
@@ -109,12 +120,14 @@ async def test_get_analytics_summary(setup_database):
     """Test getting analytics summary""" 
     # Create some events first
 
-    for i in range(5):
-        test_event_data = {
+    test_event_data = [
+        {
             "user_id": f"user{i}",
             "event_name": f"test_event_{i}",
             "session_id": f"session{i}",
         }
+        for i in range(5)
+    ]
 
     for event in test_event_data:
         client.post("/events/", json=event)
@@ -131,3 +144,830 @@ async def test_get_analytics_summary(setup_database):
     assert data["unique_sessions"] == 5
     assert "data_range" in data
 
+
+@pytest.mark.asyncio
+async def test_create_events_batch(setup_database):
+    """Test batch ingestion with per-item results"""
+    events = [
+        {"event_name": "page_view", "user_id": "user1", "properties": {"page": "/home"}},
+        {"user_id": "user2"},
+        {"event_name": "signup", "user_id": "user3", "timestamp": "2024-01-01T12:00:00"},
+    ]
+    response = client.post("/events/batch", json=events)
+    assert response.status_code == 200
+
+    data = response.json()
+    assert data["accepted"] == 2
+    assert data["rejected"] == 1
+    assert [item["status"] for item in data["results"]] == ["accepted", "rejected", "accepted"]
+    assert data["results"][0]["event_id"] < data["results"][2]["event_id"]
+    assert "event_name" in data["results"][1]["error"]
+
+
+def test_create_events_batch_too_large(monkeypatch):
+    """Test that oversized batches are refused"""
+    monkeypatch.setattr("main.MAX_BATCH_SIZE", 2)
+    response = client.post("/events/batch", json=[{"event_name": "a"}] * 3)
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_get_events_cursor_pagination(setup_database):
+    """Test walking all events with keyset cursors"""
+    events = [
+        {"event_name": f"event_{i}", "timestamp": "2024-01-01T12:00:00"} for i in range(5)
+    ]
+    client.post("/events/batch", json=events)
+
+    seen = []
+    cursor = None
+    while True:
+        url = "/events/?limit=2&total=exact"
+        if cursor:
+            url += f"&cursor={cursor}"
+        response = client.get(url)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total_events"] == 5
+        seen.extend(event["id"] for event in data["events"])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert seen == sorted(seen, reverse=True)
+    assert len(set(seen)) == 5
+
+
+@pytest.mark.asyncio
+async def test_get_events_totals_follow_filters(setup_database):
+    """Test exact totals count only matching events and estimates are null when filtered"""
+    client.post("/events/batch", json=[
+        {"event_name": "view", "user_id": "u1", "properties": {"plan": "pro"}},
+        {"event_name": "view", "user_id": "u2", "properties": {"plan": "free"}},
+        {"event_name": "click", "user_id": "u1", "properties": {"plan": "pro"}},
+    ])
+
+    assert client.get("/events/?total=estimate").json()["total_events"] == 3
+    assert client.get("/events/?total=exact&event_name=view").json()["total_events"] == 2
+    assert client.get("/events/?total=exact&user_id=u1&where[properties.plan]=pro").json()["total_events"] == 2
+    assert client.get("/events/?total=exact&where[properties.plan]=free").json()["total_events"] == 1
+    filtered = client.get("/events/?total=estimate&event_name=view").json()
+    assert filtered["total_events"] is None and len(filtered["events"]) == 2
+
+
+def test_get_events_invalid_cursor():
+    """Test that a malformed cursor is a client error"""
+    response = client.get("/events/?cursor=not-a-cursor")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_analytics_timeseries(setup_database):
+    """Test that the rollups merge late events into their own buckets"""
+    events = [
+        {"event_name": "page_view", "timestamp": "2024-01-01T10:05:00"},
+        {"event_name": "page_view", "timestamp": "2024-01-01T10:55:00"},
+        {"event_name": "signup", "timestamp": "2024-01-02T09:00:00", "project_id": 7},
+    ]
+    client.post("/events/batch", json=events)
+    # a late event for an existing bucket
+    client.post("/events/batch", json=[{"event_name": "page_view", "timestamp": "2024-01-01T23:59:00"}])
+
+    params = "start_date=2024-01-01T00:00:00&end_date=2024-01-03T00:00:00"
+    response = client.get(f"/analytics/timeseries?period=day&{params}")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["period"] == "day"
+    assert data["total_events"] == 4
+    assert [point["count"] for point in data["data"]] == [3, 1]
+
+    response = client.get(f"/analytics/timeseries?period=hour&event_name=page_view&{params}")
+    assert [point["count"] for point in response.json()["data"]] == [2, 1]
+
+    response = client.get(f"/analytics/timeseries?period=minute&project_id=7&{params}")
+    assert response.json()["total_events"] == 1
+
+
+@pytest.mark.asyncio
+async def test_unique_counts_approx_and_exact(setup_database):
+    """Test that sketch estimates match exact counts on small data"""
+    events = [
+        {"event_name": "page_view" if i % 3 else "signup", "user_id": f"user{i % 4}", "session_id": f"session{i}"}
+        for i in range(12)
+    ]
+    client.post("/events/batch", json=events[:6])
+    client.post("/events/batch", json=events[6:])
+
+    approx = client.get("/analytics/summary/").json()
+    exact = client.get("/analytics/summary/?exact=true").json()
+    assert approx["unique_users"] == exact["unique_users"] == 4
+    assert approx["unique_sessions"] == exact["unique_sessions"] == 12
+    assert approx["total_events"] == 12
+
+    top = client.get("/events/top/").json()
+    assert top == client.get("/events/top/?exact=true").json()
+    assert top[0]["event_name"] == "page_view"
+    assert top[0]["count"] == 8
+
+
+@pytest.mark.asyncio
+async def test_get_analytics_summary_scoped(setup_database):
+    """Test the summary scoped by time range and project, exact and approximate"""
+    events = [
+        {"event_name": "page_view", "user_id": "user1", "timestamp": "2024-01-01T10:00:00", "project_id": 1},
+        {"event_name": "signup", "user_id": "user2", "timestamp": "2024-01-02T10:00:00", "project_id": 1},
+        {"event_name": "page_view", "user_id": "user3", "timestamp": "2024-01-05T10:00:00", "project_id": 1},
+        {"event_name": "page_view", "user_id": "user4", "timestamp": "2024-01-02T11:00:00", "project_id": 2},
+    ]
+    client.post("/events/batch", json=events)
+
+    params = "project_id=1&start_date=2024-01-01T00:00:00&end_date=2024-01-03T00:00:00"
+    for exact in ("true", "false"):
+        response = client.get(f"/analytics/summary/?{params}&exact={exact}")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total_events"] == 2
+        assert data["unique_users"] == 2
+        assert data["events_type"] == {"page_view": 1, "signup": 1}
+        assert data["data_range"]["start_date"].startswith("2024-01-01T10:00:00")
+        assert data["data_range"]["end_date"].startswith("2024-01-02T10:00:00")
+
+
+@pytest.mark.asyncio
+async def test_get_top_events_streaming_window(setup_database):
+    """Test that windowed top events are answered from the in-memory tracker"""
+    client.post("/events/batch", json=[
+        {"event_name": "stream_test_event", "user_id": "user1", "project_id": 4242},
+        {"event_name": "stream_test_event", "user_id": "user2", "project_id": 4242},
+    ])
+
+    response = client.get("/events/top/?window=5m&project_id=4242")
+    assert response.status_code == 200
+    data = response.json()
+    assert data[0]["event_name"] == "stream_test_event"
+    assert data[0]["count"] == 2
+    assert data[0]["max_error"] == 0
+
+
+@pytest.mark.asyncio
+async def test_retention_drops_expired_partitions(setup_database):
+    """Test partition-drop retention honouring per-project settings"""
+    now = datetime(2024, 6, 1, 12, 0, 0)
+    async with TestSessionLocal() as session:
+        db_ops = DatabaseOperation(session)
+        session.add(Project(id=1, name="short", slug="short", event_retention_days=7))
+        session.add(Project(id=2, name="long", slug="long", event_retention_days=30))
+        await session.commit()
+
+        await db_ops.create_events([
+            {"event_name": "old", "project_id": 2, "user_id": "u1", "timestamp": now - timedelta(days=40)},
+            {"event_name": "mid", "project_id": 1, "user_id": "u1", "timestamp": now - timedelta(days=10)},
+            {"event_name": "mid", "project_id": 2, "user_id": "u1", "timestamp": now - timedelta(days=10)},
+            {"event_name": "new", "project_id": 1, "user_id": "u1", "timestamp": now - timedelta(days=1)},
+        ])
+        from partitions import ensure_partitions
+        await ensure_partitions(session, now - timedelta(days=45), now)
+
+        result = await db_ops.apply_retention(now=now)
+        # 40-day-old partition is past every retention: dropped as a whole
+        assert "events_p20240422" in result["dropped_partitions"]
+        assert len(result["dropped_partitions"]) == 45 - 30
+
+        rows = await session.execute(select(Event.event_name, Event.project_id).order_by(Event.id))
+        assert rows.all() == [("mid", 2), ("new", 1)]
+
+        partitions = await session.execute(select(EventPartition.name))
+        assert len(partitions.all()) == 31
+
+        # aggregates of the expired time go in the same pass
+        from models import ActiveUserBitmap, EventSketch
+        from rollups import ROLLUP_MODELS
+        assert result["purged_buckets"] > 0
+        for model in ROLLUP_MODELS.values():
+            rows = await session.execute(select(model.event_name, model.project_id).order_by(model.bucket))
+            assert rows.all() == [("mid", 2), ("new", 1)]
+        rows = await session.execute(select(EventSketch.project_id, EventSketch.bucket).distinct())
+        assert sorted(rows.all()) == [(1, datetime(2024, 5, 31)), (2, datetime(2024, 5, 22))]
+        rows = await session.execute(select(ActiveUserBitmap.project_id, ActiveUserBitmap.day))
+        assert sorted(rows.all()) == [(1, datetime(2024, 5, 31)), (2, datetime(2024, 5, 22))]
+
+
+@pytest.mark.asyncio
+async def test_default_retention_keeps_all_project_aggregates(setup_database, monkeypatch):
+    """Test the shorter default retention of events without a project spares all-project bitmaps"""
+    import partitions
+    from cohorts import ALL_PROJECTS
+    from models import FirstSeenBitmap
+
+    monkeypatch.setattr(partitions, "DEFAULT_RETENTION_DAYS", 7)
+    now = datetime(2024, 6, 1, 12, 0, 0)
+    async with TestSessionLocal() as session:
+        db_ops = DatabaseOperation(session)
+        session.add(Project(id=2, name="long", slug="long", event_retention_days=30))
+        await session.commit()
+        await db_ops.create_events([
+            {"event_name": "mid", "user_id": "u1", "timestamp": now - timedelta(days=10)},
+            {"event_name": "mid", "project_id": 2, "user_id": "u2", "timestamp": now - timedelta(days=10)},
+        ])
+
+        await db_ops.apply_retention(now=now)
+        rows = await session.execute(select(Event.event_name, Event.project_id))
+        assert rows.all() == [("mid", 2)]
+        rows = await session.execute(select(FirstSeenBitmap.project_id))
+        assert sorted(rows.scalars().all()) == [ALL_PROJECTS, 2]
+
+
+async def explain(sql, params=None):
+    """Return SQLite's query plan for a statement as one string"""
+    from sqlalchemy import text
+    async with TestSessionLocal() as session:
+        result = await session.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params or {})
+        return " | ".join(row[-1] for row in result.all())
+
+
+@pytest.mark.asyncio
+async def test_events_property_filter_and_promotion(setup_database):
+    """Test where[properties.<key>] filtering before and after promotion"""
+    client.post("/events/batch", json=[
+        {"event_name": "page_view", "properties": {"page": "/login"}},
+        {"event_name": "page_view", "properties": {"page": "/home"}},
+        {"event_name": "click", "properties": {"page": "/login"}},
+    ])
+
+    url = "/events/?where[properties.page]=/login&event_name=page_view"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert [event["properties"]["page"] for event in response.json()["events"]] == ["/login"]
+
+    response = client.post("/events/properties/page/promote")
+    assert response.status_code == 200
+    assert response.json()["column_name"] == "prop_page"
+
+    response = client.get("/events/?where[properties.page]=/login")
+    assert len(response.json()["events"]) == 2
+
+    plan = await explain("SELECT id FROM events WHERE prop_page = :v ORDER BY timestamp DESC", {"v": "/login"})
+    assert "ix_events_prop_page" in plan
+
+    assert client.post("/events/properties/bad-key!/promote").status_code == 400
+
+    # typed values match by their text, the same before and after promotion
+    client.post("/events/batch", json=[
+        {"event_name": "purchase", "properties": {"quantity": 2, "price": 9.5}},
+        {"event_name": "purchase", "properties": {"quantity": "2", "price": 12}},
+    ])
+    before = [len(client.get(f"/events/?where[properties.{key}]={value}").json()["events"])
+              for key, value in (("quantity", "2"), ("price", "9.5"), ("price", "12"))]
+    for key in ("quantity", "price"):
+        client.post(f"/events/properties/{key}/promote")
+    after = [len(client.get(f"/events/?where[properties.{key}]={value}").json()["events"])
+             for key, value in (("quantity", "2"), ("price", "9.5"), ("price", "12"))]
+    assert before == after == [2, 1, 1]
+
+
+@pytest.mark.asyncio
+async def test_event_filters_use_indexes(setup_database):
+    """Query-plan assertions so column filters keep using their indexes"""
+    plan = await explain(
+        "SELECT id FROM events WHERE event_name = :n AND timestamp >= :t ORDER BY timestamp DESC",
+        {"n": "signup", "t": "2024-01-01"}
+    )
+    assert "ix_events_event_name_timestamp (event_name=? AND timestamp>?)" in plan
+
+    plan = await explain("SELECT id FROM events WHERE user_id = :u ORDER BY timestamp DESC", {"u": "user1"})
+    assert "ix_events_user_id_timestamp (user_id=?)" in plan
+
+    plan = await explain("SELECT id FROM events ORDER BY timestamp DESC, id DESC LIMIT 10")
+    assert "ix_events_timestamp_id" in plan
+
+
+@pytest.mark.asyncio
+async def test_export_events_streams_ndjson_and_csv(setup_database, monkeypatch):
+    """Test the streaming export in both formats across several chunks"""
+    events = [
+        {"event_name": "page_view" if i % 2 else "click", "user_id": f"user{i}",
+         "timestamp": f"2024-01-01T12:00:{i:02d}", "properties": {"n": i}}
+        for i in range(7)
+    ]
+    client.post("/events/batch", json=events)
+
+    original = DatabaseOperation.stream_events
+    monkeypatch.setattr(
+        DatabaseOperation, "stream_events",
+        lambda self, **kwargs: original(self, chunk_size=3, **kwargs)
+    )
+
+    response = client.get("/events/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["properties"]["n"] for row in rows] == list(range(7))
+    assert rows[0]["timestamp"] == "2024-01-01T12:00:00"
+
+    response = client.get("/events/export?format=csv&event_name=click")
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = list(csv.reader(response.text.splitlines()))
+    assert lines[0][:3] == ["id", "project_id", "event_name"]
+    assert [line[2] for line in lines[1:]] == ["click"] * 4
+    assert json.loads(lines[1][6]) == {"n": 0}
+
+
+@pytest.mark.asyncio
+async def test_exact_reads_served_from_segments(setup_database, tmp_path):
+    """Test exact analytics agree with and without compacted segments, late rows included"""
+    from segments import SegmentStore
+
+    now = datetime(2024, 3, 10, 12, 0, 0)
+    events = [
+        {"event_name": "page_view" if i % 3 else "signup", "user_id": f"user{i % 5}",
+         "session_id": f"s{i % 7}", "project_id": 1 + i % 2, "timestamp": now - timedelta(hours=6 * i)}
+        for i in range(20)
+    ]
+    store = SegmentStore(str(tmp_path))
+    async with TestSessionLocal() as session:
+        await DatabaseOperation(session).create_events(events)
+        created = await DatabaseOperation(session, store).compact_segments(now=now)
+        # closed days only: the current day stays in SQL
+        assert created[0] == "events_20240305.seg" and "events_20240310.seg" not in created
+        assert len(created) == 5
+
+        # a late event for a compacted day
+        await DatabaseOperation(session).create_events([
+            {"event_name": "late", "user_id": "user9", "project_id": 1, "timestamp": now - timedelta(days=3)}
+        ])
+
+        start = now - timedelta(days=4, hours=3)
+        for kwargs in ({}, {"start_date": start}, {"start_date": start, "end_date": now - timedelta(days=1), "project_id": 1}):
+            expected = await DatabaseOperation(session, None).get_summary(exact=True, **kwargs)
+            assert await DatabaseOperation(session, store).get_summary(exact=True, **kwargs) == expected
+            expected = await DatabaseOperation(session, None).get_top_events(exact=True, **kwargs)
+            assert await DatabaseOperation(session, store).get_top_events(exact=True, **kwargs) == expected
+
+        summary = await DatabaseOperation(session, store).get_summary(exact=True)
+        assert summary["total_events"] == 21
+        assert summary["events_type"]["late"] == 1
+
+    plan = await explain(
+        "SELECT count(*) FROM events WHERE timestamp >= :a AND (timestamp < :b OR timestamp >= :c"
+        " OR (id > :w AND timestamp >= :b AND timestamp < :c))",
+        {"a": "2024-03-01", "b": "2024-03-05", "c": "2024-03-10", "w": 20}
+    )
+    assert "SCAN events" not in plan
+
+
+@pytest.mark.asyncio
+async def test_segments_pick_up_rows_committed_below_their_watermark(setup_database, tmp_path):
+    """Test a row that commits after compaction with an id below the watermark is not lost"""
+    from sqlalchemy import delete
+    from segments import SegmentStore
+
+    now = datetime(2024, 3, 10, 12, 0, 0)
+    day = now - timedelta(days=3)
+    store = SegmentStore(str(tmp_path))
+    async with TestSessionLocal() as session:
+        created = await DatabaseOperation(session).create_events([
+            {"event_name": "page_view", "timestamp": day + timedelta(hours=hours)} for hours in range(3)
+        ])
+        # the middle id stands for a transaction that has its id but has not committed yet
+        await session.execute(delete(Event).where(Event.id == created[1]["id"]))
+        await session.commit()
+        assert len(await DatabaseOperation(session, store).compact_segments(now=now)) == 3
+        assert store.segments[datetime(2024, 3, 7)].watermark == created[2]["id"]
+
+        session.add(Event(id=created[1]["id"], event_name="in_flight", timestamp=day + timedelta(hours=1)))
+        await session.commit()
+        # the next pass sees the settling segment is short of a row and rewrites it
+        assert await DatabaseOperation(session, store).compact_segments(now=now) == ["events_20240307.seg"]
+        summary = await DatabaseOperation(session, store).get_summary(exact=True)
+        assert summary["total_events"] == 3 and summary["events_type"]["in_flight"] == 1
+        assert await DatabaseOperation(session, store).compact_segments(now=now) == []
+
+
+@pytest.mark.asyncio
+async def test_analytics_query_endpoint(setup_database):
+    """Test an ad-hoc grouped query through the query engine"""
+    client.post("/events/batch", json=[
+        {"event_name": "page_view", "user_id": "user1", "timestamp": "2024-01-01T10:15:00"},
+        {"event_name": "page_view", "user_id": "user2", "timestamp": "2024-01-01T10:45:00"},
+        {"event_name": "page_view", "user_id": "user1", "timestamp": "2024-01-01T11:05:00"},
+        {"event_name": "signup", "user_id": "user2", "timestamp": "2024-01-01T11:10:00"},
+    ])
+    response = client.post("/analytics/query", json={
+        "group_by": ["event_name"],
+        "metrics": ["count", "unique_users"],
+        "grain": "hour",
+        "filters": {"event_name": ["page_view", "signup"]},
+    })
+    assert response.status_code == 200
+    assert response.json()["rows"] == [
+        {"bucket": "2024-01-01T10:00:00", "event_name": "page_view", "count": 2, "unique_users": 2},
+        {"bucket": "2024-01-01T11:00:00", "event_name": "page_view", "count": 1, "unique_users": 1},
+        {"bucket": "2024-01-01T11:00:00", "event_name": "signup", "count": 1, "unique_users": 1},
+    ]
+
+    response = client.post("/analytics/query", json={"metrics": []})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_funnel_endpoint(setup_database):
+    """Test step counts and window handling of the funnel endpoint"""
+    client.post("/events/batch", json=[
+        {"event_name": "signup", "user_id": "a", "timestamp": "2024-01-01T10:00:00"},
+        {"event_name": "purchase", "user_id": "a", "timestamp": "2024-01-01T12:00:00"},
+        {"event_name": "signup", "user_id": "b", "timestamp": "2024-01-01T11:00:00"},
+        {"event_name": "purchase", "user_id": "b", "timestamp": "2024-01-20T11:00:00"},
+        {"event_name": "page_view", "user_id": "c", "timestamp": "2024-01-01T11:00:00"},
+    ])
+    response = client.post("/analytics/funnel", json={
+        "steps": ["signup", "purchase"], "start_date": "2024-01-01T00:00:00", "end_date": "2024-01-02T00:00:00"
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert data["window_seconds"] == 7 * 86400
+    assert [(step["event_name"], step["count"]) for step in data["steps"]] == [("signup", 2), ("purchase", 1)]
+    assert abs(data["steps"][1]["median_seconds_from_previous"] - 7200) < 72
+
+    assert client.post("/analytics/funnel", json={"steps": ["signup"]}).status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_retention_matrix_from_bitmaps(setup_database):
+    """Test day cohorts built from the active-user bitmaps maintained on ingest"""
+    day = datetime(2024, 2, 1)
+    activity = {"a": [0, 1, 2], "b": [0, 2], "c": [1, 2], "d": [1], "e": [-3, 1]}
+    client.post("/events/batch", json=[
+        {"event_name": "visit", "user_id": user_id, "project_id": 1,
+         "timestamp": (day + timedelta(days=offset, hours=3)).isoformat()}
+        for user_id, offsets in activity.items() for offset in offsets
+    ])
+    # a second batch for an existing day merges into its bitmap
+    client.post("/events/", json={"event_name": "visit", "user_id": "f", "project_id": 1,
+                                  "timestamp": (day + timedelta(hours=5)).isoformat()})
+
+    response = client.get("/analytics/retention", params={
+        "period": "day", "start_date": day.isoformat(), "end_date": (day + timedelta(days=1)).isoformat(),
+        "project_id": 1, "max_periods": 2,
+    })
+    assert response.status_code == 200
+    cohorts = response.json()["cohorts"]
+    # day 0: a, b, f; day 1: c, d (e was seen before the range)
+    assert [(cohort["users"], cohort["retained"]) for cohort in cohorts] == [(3, [3, 1, 2]), (2, [2, 1, 0])]
+    assert cohorts[0]["retention"][2] == round(2 / 3, 4)
+
+    response = client.get("/analytics/retention", params={
+        "start_date": day.isoformat(), "end_date": day.isoformat(), "project_id": 2})
+    assert response.json()["cohorts"][0]["users"] == 0
+
+    # a late event moves its user to the earlier cohort, per project and across projects
+    client.post("/events/batch", json=[
+        {"event_name": "visit", "user_id": "c", "project_id": 1, "timestamp": (day + timedelta(hours=1)).isoformat()},
+        {"event_name": "visit", "user_id": "d", "project_id": 2, "timestamp": (day - timedelta(days=2)).isoformat()},
+    ])
+    params = {"period": "day", "start_date": day.isoformat(), "end_date": (day + timedelta(days=1)).isoformat(),
+              "max_periods": 2}
+    cohorts = client.get("/analytics/retention", params={**params, "project_id": 1}).json()["cohorts"]
+    assert [(cohort["users"], cohort["retained"]) for cohort in cohorts] == [(4, [4, 2, 3]), (1, [1, 0, 0])]
+    cohorts = client.get("/analytics/retention", params=params).json()["cohorts"]
+    assert [(cohort["users"], cohort["retained"]) for cohort in cohorts] == [(4, [4, 2, 3]), (0, [0, 0, 0])]
+
+
+@pytest.mark.asyncio
+async def test_sessionizer_writes_sessions_and_metrics(setup_database):
+    """Test closed sessions reach the sessions table and the metrics endpoint"""
+    from sessionizer import Sessionizer
+
+    sessionizer = Sessionizer(gap=timedelta(minutes=30), session_factory=TestSessionLocal)
+    start = datetime(2024, 1, 1, 9, 0, 0)
+    sessionizer.record([
+        {"event_name": name, "user_id": user_id, "project_id": 1, "timestamp": start + timedelta(minutes=minutes)}
+        for user_id, name, minutes in [
+            ("u1", "landing", 0), ("u1", "pricing", 5), ("u1", "signup", 20),
+            ("u2", "landing", 0),
+            ("u1", "landing", 120),
+        ]
+    ])
+    assert await sessionizer.run_once(now=start + timedelta(hours=1)) == 2
+    await sessionizer.stop()
+
+    response = client.get("/analytics/sessions", params={"project_id": 1})
+    assert response.status_code == 200
+    metrics = response.json()
+    assert metrics["total_sessions"] == 3
+    assert metrics["bounce_rate"] == round(2 / 3, 4)
+    assert metrics["top_entry_events"] == {"landing": 3}
+    assert metrics["avg_duration_seconds"] == round(20 * 60 / 3, 3)
+
+
+@pytest.mark.asyncio
+async def test_summary_sessions_include_events_without_session_ids(setup_database):
+    """Test unique_sessions counts the sessionizer's sessions of events sent without a session_id"""
+    from sessionizer import Sessionizer
+
+    start = datetime(2024, 1, 1, 9)
+    events = [
+        {"event_name": "view", "user_id": "u1", "session_id": "s1", "project_id": 1, "timestamp": start},
+        {"event_name": "view", "user_id": "u2", "project_id": 1, "timestamp": start},
+        {"event_name": "view", "user_id": "u2", "project_id": 1, "timestamp": start + timedelta(minutes=5)},
+        {"event_name": "view", "user_id": "u2", "project_id": 1, "timestamp": start + timedelta(hours=2)},
+    ]
+    sessionizer = Sessionizer(gap=timedelta(minutes=30), session_factory=TestSessionLocal)
+    async with TestSessionLocal() as session:
+        await DatabaseOperation(session).create_events(events)
+    sessionizer.record(events)
+    await sessionizer.stop()
+
+    async with TestSessionLocal() as session:
+        db_ops = DatabaseOperation(session)
+        assert await db_ops.get_unique_sessions_count(project_id=1) == 3
+        for exact in (True, False):
+            summary = await db_ops.get_summary(project_id=1, exact=exact)
+            assert summary["unique_sessions"] == 3
+
+
+@pytest.mark.asyncio
+async def test_quota_leases_checkpoints_and_rejects(setup_database, monkeypatch):
+    """Test quota chunks are leased across workers and enforced by POST /events/"""
+    import main
+    from quotas import QuotaManager, QuotaExceededError, month_start
+    from models import ProjectUsage
+
+    async with TestSessionLocal() as session:
+        project = Project(name="Quota", slug="quota", monthly_event_limit=5)
+        session.add(project)
+        await session.commit()
+        project_id = project.id
+
+    # two workers share the limit: the first leases 3, the second the last 2
+    first = QuotaManager(chunk_size=3, session_factory=TestSessionLocal)
+    second = QuotaManager(chunk_size=3, session_factory=TestSessionLocal)
+    await first.refill(project_id, first._quota(project_id))
+    await second.refill(project_id, second._quota(project_id))
+    assert (first.projects[project_id].remaining, second.projects[project_id].remaining) == (3, 2)
+    assert second.projects[project_id].exhausted
+
+    second.check(project_id)
+    second.check(project_id)
+    with pytest.raises(QuotaExceededError):
+        second.check(project_id)
+
+    first.check(project_id)
+    assert await first.checkpoint() == 1
+    # shutdown hands the unspent 2 back, so the second worker can lease them
+    await first.stop()
+    await second.checkpoint()
+    await second.stop()
+    async with TestSessionLocal() as session:
+        usage = await session.get(ProjectUsage, (project_id, month_start()))
+        assert (usage.used, usage.allocated) == (3, 3)
+
+    worker = QuotaManager(chunk_size=10, session_factory=TestSessionLocal)
+    await worker.refill(project_id, worker._quota(project_id))
+    monkeypatch.setattr(main, "quota_manager", worker)
+    payload = {"event_name": "page_view", "project_id": project_id}
+    assert client.post("/events/", json=payload).status_code == 200
+    response = client.post("/events/", json=payload)
+    assert response.headers["X-Quota-Warning"] == "90% of monthly event limit used"
+    response = client.post("/events/", json=payload)
+    assert response.status_code == 429
+
+    response = client.post("/events/batch", json=[payload, {"event_name": "no_project"}])
+    assert [item["status"] for item in response.json()["results"]] == ["rejected", "accepted"]
+
+
+@pytest.mark.asyncio
+async def test_user_agents_and_ips_interned(setup_database):
+    """Test repeated user agents share one lookup row and read back as strings"""
+    from lookups import LOOKUPS
+    from models import UserAgent
+
+    for cache in LOOKUPS.values():
+        cache.ids.clear()
+    user_agent = "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0"
+    headers = {"User-Agent": user_agent}
+    assert client.post("/events/", json={"event_name": "a"}, headers=headers).status_code == 200
+    response = client.post("/events/batch", json=[{"event_name": "b"}, {"event_name": "c"}], headers=headers)
+    assert response.json()["accepted"] == 2
+    assert LOOKUPS["user_agent"].ids[user_agent] == 1
+
+    async with TestSessionLocal() as session:
+        agents = (await session.execute(select(UserAgent))).scalars().all()
+        assert [(agent.value, agent.browser, agent.os, agent.device) for agent in agents] == \
+            [(user_agent, "Firefox", "Linux", "desktop")]
+        events = await DatabaseOperation(session).get_events(limit=10)
+        assert {(event.user_agent, event.ip_address, event.user_agent_id) for event in events} == \
+            {(user_agent, "testclient", 1)}
+
+    response = client.get("/events/export", params={"format": "ndjson"})
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["event_name"], row["user_agent"], row["ip_address"]) for row in rows] == \
+        [(name, user_agent, "testclient") for name in "abc"]
+
+
+@pytest.mark.asyncio
+async def test_live_websocket_pushes_deltas(setup_database):
+    """Test /ws/live delivers the counters of events ingested since the last tick"""
+    from main import live_feed
+
+    with client.websocket_connect("/ws/live") as websocket:
+        websocket.portal.call(live_feed.run_once)
+        websocket.receive_json()
+        response = client.post("/events/batch", json=[{"event_name": "live_view"}, {"event_name": "live_view"}])
+        assert response.json()["accepted"] == 2
+        websocket.portal.call(live_feed.run_once)
+        message = websocket.receive_json()
+    assert message["event_counts"] == {"live_view": 2}
+    assert message["events"] == 2
+    assert not live_feed.subscribers
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_reports_routes(setup_database):
+    """Test /metrics exposes per-route latency labelled by path template"""
+    client.get("/analytics/summary/")
+    client.get("/no/such/path")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/analytics/summary/",status="200"}' in body
+    assert 'route="unmatched",status="404"' in body
+    assert "# TYPE db_statement_duration_seconds histogram" in body
+
+
+@pytest.mark.asyncio
+async def test_spooled_event_acknowledged_then_loaded(setup_database, monkeypatch, tmp_path):
+    """Test POST /events/ returns 202 once spooled and consumers load the event"""
+    import httpx
+    import main
+    from spool import IngestionSpool
+
+    spool = IngestionSpool(str(tmp_path), consumers=1, session_factory=TestSessionLocal)
+    await spool.writer.start()
+    monkeypatch.setattr(main, "ingestion_spool", spool)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        response = await http.post("/events/", json={"event_name": "spooled", "user_id": "u1"})
+    assert response.status_code == 202
+    assert response.json()["message"] == "Event spooled for ingestion"
+
+    assert await spool.consumers[0].run_once() == 1
+    await spool.stop()
+    async with TestSessionLocal() as session:
+        events = await DatabaseOperation(session).get_events(limit=10)
+    assert [(event.event_name, event.user_id, event.ip_address) for event in events] == \
+        [("spooled", "u1", "127.0.0.1")]
+
+
+@pytest.mark.asyncio
+async def test_analytics_cached_until_ingestion_with_etags(setup_database):
+    """Test analytics responses are reused until the watermark moves and honour If-None-Match"""
+    from result_cache import result_cache
+
+    client.post("/events/batch", json=[{"event_name": "cached"}, {"event_name": "cached"}])
+    first = client.get("/analytics/summary/")
+    etag = first.headers["ETag"]
+    assert first.json()["total_events"] == 2
+    assert len(result_cache.entries) == 1
+
+    repeat = client.get("/analytics/summary/", headers={"If-None-Match": etag})
+    assert repeat.status_code == 304 and repeat.content == b""
+    top = client.get("/events/top/")
+    assert top.json()[0]["event_name"] == "cached"
+    assert client.get("/events/top/", headers={"If-None-Match": top.headers["ETag"]}).status_code == 304
+
+    client.post("/events/batch", json=[{"event_name": "cached"}])
+    changed = client.get("/analytics/summary/", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.json()["total_events"] == 3 and changed.headers["ETag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_closed_ranges_invalidated_by_other_workers_late_events(setup_database):
+    """Test a late event committed by one worker invalidates closed ranges cached by another"""
+    from result_cache import ResultCache
+    from test_result_cache import make_request
+
+    other_worker = ResultCache(refresh_interval=0, enabled=True)
+    closed_end = datetime.utcnow() - timedelta(days=3)
+
+    async def summary():
+        async with TestSessionLocal() as session:
+            async def compute():
+                return await DatabaseOperation(session).get_summary(end_date=closed_end)
+            response = await other_worker.respond(make_request(), session, "summary", {}, closed_end, compute)
+            return json.loads(response.body)["total_events"]
+
+    assert await summary() == 0
+    async with TestSessionLocal() as session:
+        await DatabaseOperation(session).create_events([{"event_name": "fresh"}])
+    assert await summary() == 0 and len(other_worker.entries) == 1
+
+    async with TestSessionLocal() as session:
+        late = {"event_name": "late", "timestamp": closed_end - timedelta(days=1)}
+        await DatabaseOperation(session).create_events([late])
+    assert await summary() == 1
+
+
+@pytest.mark.asyncio
+async def test_event_uuid_retries_stored_once(setup_database):
+    """Test events retried with the same event_uuid are stored once"""
+    import metrics
+    from dedup import DEDUP_DUPLICATES
+
+    before = DEDUP_DUPLICATES.series.get((), 0)
+    payload = {"event_name": "purchase", "event_uuid": "6f1c2a6e-0d39-4a7e-9d8c-1b2f3a4b5c6d"}
+    first = client.post("/events/?wait=true", json=payload).json()
+    retry = client.post("/events/?wait=true", json=payload).json()
+    assert retry["event_id"] == first["event_id"]
+
+    response = client.post("/events/batch", json=[
+        payload, {"event_name": "purchase", "event_uuid": "other"}, {"event_name": "purchase", "event_uuid": "other"},
+        {"event_name": "purchase"},
+    ]).json()
+    assert (response["accepted"], response["duplicates"], response["rejected"]) == (2, 2, 0)
+    statuses = [(item["status"], item["event_id"]) for item in response["results"]]
+    assert statuses[0] == ("duplicate", first["event_id"])
+    assert statuses[2] == ("duplicate", statuses[1][1])
+
+    async with TestSessionLocal() as session:
+        assert await DatabaseOperation(session).get_event_count() == 3
+    assert DEDUP_DUPLICATES.series[()] == before + 3
+    assert "dedup_filter_bytes" in metrics.registry.render()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_event_uuid_retries_conflict_into_duplicates(setup_database):
+    """Test retries that both miss the duplicate filter are still stored once"""
+    from dedup import DuplicateFilter
+
+    stamp = datetime(2024, 1, 1, 12)
+    async with TestSessionLocal() as session:
+        # separate filters stand in for two workers that each see the uuid first
+        first = await DatabaseOperation(session, dedup=DuplicateFilter()).create_event(
+            {"event_name": "purchase", "event_uuid": "race", "timestamp": stamp})
+        second = await DatabaseOperation(session, dedup=DuplicateFilter()).create_event(
+            {"event_name": "purchase", "event_uuid": "race", "timestamp": stamp})
+        assert second.id == first.id
+
+        results = await DatabaseOperation(session, dedup=None).create_events([
+            {"event_name": "purchase", "event_uuid": "race", "timestamp": stamp},
+            {"event_name": "purchase", "event_uuid": "fresh"},
+            {"event_name": "purchase", "event_uuid": "race", "timestamp": stamp},
+        ])
+        assert results[0] == {"id": first.id, "timestamp": results[0]["timestamp"], "duplicate": True}
+        assert results[2]["id"] == first.id and results[2]["duplicate"]
+        assert "duplicate" not in results[1]
+        assert await DatabaseOperation(session).get_event_count() == 2
+        summary = await DatabaseOperation(session).get_summary(exact=False)
+        assert summary["total_events"] == 2
+
+
+@pytest.mark.asyncio
+async def test_duplicate_lookup_is_bounded_to_the_filter_window(setup_database):
+    """Test suspects are confirmed among recent events or at their own older timestamp"""
+    from dedup import DuplicateFilter
+
+    dedup = DuplicateFilter(window=3600)
+    old = datetime.utcnow() - timedelta(days=3)
+    async with TestSessionLocal() as session:
+        db_ops = DatabaseOperation(session, dedup=dedup)
+        first = await db_ops.create_events([
+            {"event_name": "purchase", "event_uuid": "old", "timestamp": old},
+            {"event_name": "purchase", "event_uuid": "new"},
+        ])
+        retries = await db_ops.create_events([
+            {"event_name": "purchase", "event_uuid": "old", "timestamp": old},
+            {"event_name": "purchase", "event_uuid": "new"},
+        ])
+        assert [(item["id"], item["duplicate"]) for item in retries] == [(item["id"], True) for item in first]
+
+        # an old event retried without its timestamp is outside the window and stored again
+        again = await db_ops.create_events([{"event_name": "purchase", "event_uuid": "old"}])
+        assert "duplicate" not in again[0]
+        assert await db_ops.get_event_count() == 3
+
+
+@pytest.mark.asyncio
+async def test_approximate_summary_and_top_events_respect_partial_days(setup_database):
+    """Test rollup-served answers count only events inside bounds that are not midnight-aligned"""
+    async with TestSessionLocal() as session:
+        db_ops = DatabaseOperation(session)
+        await db_ops.create_events([
+            {"event_name": "a", "user_id": "u1", "timestamp": datetime(2024, 1, 1, 10)},
+            {"event_name": "a", "user_id": "u2", "timestamp": datetime(2024, 1, 3, 10)},
+            {"event_name": "b", "user_id": "u3", "timestamp": datetime(2024, 1, 1, 2)},
+            {"event_name": "c", "user_id": "u4", "timestamp": datetime(2024, 1, 2, 12, 30, 15)},
+        ])
+        start, end = datetime(2024, 1, 1, 5), datetime(2024, 1, 3)
+        for exact in (True, False):
+            summary = await db_ops.get_summary(start_date=start, end_date=end, exact=exact)
+            assert (summary["total_events"], summary["events_type"], summary["unique_users"]) == \
+                (2, {"a": 1, "c": 1}, 2)
+            top = await db_ops.get_top_events(start_date=start, end_date=end, exact=exact)
+            assert {(event["event_name"], event["count"], event["unique_users"]) for event in top} == \
+                {("a", 1, 1), ("c", 1, 1)}
+
+        # a bound inside a minute is served from the raw events
+        summary = await db_ops.get_summary(start_date=datetime(2024, 1, 2, 12, 30, 20), end_date=end)
+        assert summary["total_events"] == 0
@@ -0,0 +1,54 @@
+"""
+Tests for the Prometheus metrics registry and SQL instrumentation.
+"""
+
+import logging
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import metrics
+from metrics import Histogram, Registry, instrument_engine, statement_operation
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.register(Histogram("op_seconds", "Op time", ("op",), buckets=(0.1, 1.0)))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe("read", value=value)
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP op_seconds Op time", "# TYPE op_seconds histogram"]
+    assert lines[2:5] == [
+        'op_seconds_bucket{op="read",le="0.1"} 1',
+        'op_seconds_bucket{op="read",le="1.0"} 3',
+        'op_seconds_bucket{op="read",le="+Inf"} 4',
+    ]
+    assert lines[5:] == ['op_seconds_sum{op="read"} 4.25', 'op_seconds_count{op="read"} 4']
+
+
+def test_statement_operation():
+    assert statement_operation("SELECT 1") == "select"
+    assert statement_operation("\n  insert into events VALUES (?)") == "insert"
+    assert statement_operation("WITH recent AS (SELECT id FROM events) DELETE FROM events") == "delete"
+
+
+@pytest.mark.asyncio
+async def test_engine_statements_timed_and_slow_ones_logged(monkeypatch, caplog):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    instrument_engine(engine)
+    before = metrics.SQL_DURATION.series.get(("select",), [[0], 0])[0][:]
+    waits = sum(metrics.POOL_WAIT.series.get(("primary",), [[0], 0])[0])
+
+    monkeypatch.setattr(metrics, "SLOW_QUERY_MS", 1e-9)
+    with caplog.at_level(logging.WARNING, logger="sql.slow"):
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            with pytest.raises(Exception):
+                await conn.execute(text("SELECT * FROM missing_table"))
+    await engine.dispose()
+
+    assert sum(metrics.SQL_DURATION.series[("select",)][0]) == sum(before) + 1
+    assert sum(metrics.POOL_WAIT.series[("primary",)][0]) == waits + 1
+    assert metrics.SQL_ERRORS.series[("select",)] >= 1
+    assert "Slow select statement" in caplog.text and "SELECT 1" in caplog.text
@@ -0,0 +1,85 @@
+"""
+Tests for the vectorized query engine.
+"""
+
+import random
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from models import AnalyticsQuery
+from query_engine import QueryEngine
+from segments import Segment, SegmentWriter
+
+START = datetime(2024, 1, 1)
+
+def make_rows(count: int, seed: int = 7) -> list[tuple]:
+    """(id, project_id, event_name, user_id, session_id, timestamp) rows in time order"""
+    rng = random.Random(seed)
+    rows = [
+        (i + 1, rng.choice([1, 2, None]), rng.choice(["page_view", "click", "signup"]),
+         rng.choice([None, "u1", "u2", "u3", "u4"]), f"s{rng.randrange(6)}",
+         START + timedelta(minutes=rng.randrange(48 * 60)))
+        for i in range(count)
+    ]
+    return sorted(rows, key=lambda row: (row[5], row[0]))
+
+
+def expected(rows, query: AnalyticsQuery) -> dict:
+    """Reference result computed row by row"""
+    counts, users = Counter(), defaultdict(set)
+    for _, project_id, event_name, user_id, session_id, timestamp in rows:
+        if query.start_date and timestamp < query.start_date or query.end_date and timestamp > query.end_date:
+            continue
+        if query.project_id is not None and project_id != query.project_id:
+            continue
+        if "event_name" in query.filters and event_name not in query.filters["event_name"]:
+            continue
+        key = (timestamp.replace(minute=0),) if query.grain == "hour" else ()
+        key += tuple({"event_name": event_name, "project_id": project_id}[name] for name in query.group_by)
+        counts[key] += 1
+        if user_id is not None:
+            users[key].add(user_id)
+    return {key: (count, len(users[key])) for key, count in counts.items()}
+
+
+def as_dict(result, query: AnalyticsQuery) -> dict:
+    keys = (["bucket"] if query.grain else []) + list(query.group_by)
+    return {tuple(row[key] for key in keys): (row["count"], row["unique_users"]) for row in result}
+
+
+def test_engine_matches_row_by_row_results(tmp_path):
+    rows = make_rows(2000)
+    day_one = [row for row in rows if row[5] < START + timedelta(days=1)]
+    path = str(tmp_path / "events_20240101.seg")
+    writer = SegmentWriter(path, START, watermark=len(rows))
+    writer.extend(day_one)
+    writer.finish()
+    segment = Segment(path)
+
+    queries = [
+        AnalyticsQuery(group_by=["event_name"], metrics=["count", "unique_users"]),
+        AnalyticsQuery(group_by=["project_id"], metrics=["count", "unique_users"], grain="hour",
+                       start_date=START + timedelta(hours=20), end_date=START + timedelta(hours=30)),
+        AnalyticsQuery(metrics=["count", "unique_users"], project_id=2, filters={"event_name": ["click", "signup"]}),
+    ]
+    for query in queries:
+        engine = QueryEngine(query)
+        engine.add_segment(segment)
+        # the rest arrives as SQL rows, in two batches
+        rest = [(row[5], *row[1:5]) for row in rows[len(day_one):]]
+        engine.add_rows(rest[:300])
+        engine.add_rows(rest[300:])
+        result = engine.result()
+        assert as_dict(result, query) == expected(rows, query)
+
+    hourly = QueryEngine(queries[1])
+    hourly.add_rows([(row[5], *row[1:5]) for row in rows])
+    buckets = [row["bucket"] for row in hourly.result()]
+    assert buckets == sorted(buckets)
+
+
+def test_engine_orders_and_limits_by_first_metric():
+    query = AnalyticsQuery(group_by=["event_name"], limit=2)
+    engine = QueryEngine(query)
+    engine.add_rows([(START, None, name, None, None) for name in ["a"] * 3 + ["b"] * 5 + ["c"]])
+    assert engine.result() == [{"event_name": "b", "count": 5}, {"event_name": "a", "count": 3}]
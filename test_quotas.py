@@ -0,0 +1,39 @@
+"""
+Tests for in-memory quota checks that need no database.
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from quotas import QuotaManager, QuotaExceededError
+
+
+def test_overdraft_before_first_lease_is_bounded_by_one_chunk():
+    manager = QuotaManager(chunk_size=5)
+    # no running loop, so no lease arrives: five events on overdraft, then rejection
+    for _ in range(5):
+        assert manager.check(1) is None
+    with pytest.raises(QuotaExceededError):
+        manager.check(1)
+    assert manager.projects[1].unsaved == 5
+    assert manager.check(None) is None
+
+
+def test_exhausted_lease_rejects_and_warns():
+    manager = QuotaManager(chunk_size=10, thresholds=(0.5, 0.8))
+    quota = manager._quota(7)
+    quota.loaded, quota.limit = True, 4
+    quota.allocated = quota.remaining = 4
+    quota.exhausted = True
+
+    assert [manager.check(7) for _ in range(4)] == [None, 0.5, 0.5, 0.8]
+    assert quota.warned == 0.8
+    with pytest.raises(QuotaExceededError):
+        manager.check(7)
+    # a project not in the database is unlimited once its refill has run
+    unknown = manager._quota(8)
+    unknown.unlimited = True
+    assert all(manager.check(8) is None for _ in range(50))
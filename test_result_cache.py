@@ -0,0 +1,110 @@
+"""
+Tests for result cache keys, eviction and closed-range handling without a database.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+import pytest
+from starlette.requests import Request
+
+from result_cache import ResultCache
+
+
+class VersionSession:
+    """Answers the versions query with project and closed versions the test controls"""
+
+    def __init__(self):
+        self.projects = {0: 1}
+        self.closed_version = 0
+        self.reads = 0
+
+    async def execute(self, statement):
+        self.reads += 1
+        return self
+
+    def all(self):
+        return [("closed", self.closed_version)] + [
+            (f"project:{project_id}", version) for project_id, version in self.projects.items()
+        ]
+
+
+def make_request(if_none_match: str = "") -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+@pytest.mark.asyncio
+async def test_closed_ranges_follow_the_closed_version_and_lru_bounded():
+    cache = ResultCache(max_entries=2, closed_ttl=3600, refresh_interval=0, close_after=timedelta(hours=2),
+                        enabled=True)
+    session = VersionSession()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {"total_events": len(calls)}
+
+    closed_end = datetime.utcnow() - timedelta(days=3)
+    params = {"end_date": closed_end}
+    first = await cache.respond(make_request(), session, "summary", params, closed_end, compute)
+    second = await cache.respond(make_request(first.headers["ETag"]), session, "summary", params,
+                                 closed_end, compute)
+    assert second.status_code == 304 and len(calls) == 1
+    assert cache.entries[next(iter(cache.entries))].expires is not None
+
+    # fresh events anywhere do not touch closed ranges; late events or retention in any worker do
+    session.projects[0] = 2
+    await cache.respond(make_request(), session, "summary", params, closed_end, compute)
+    assert len(calls) == 1
+    session.closed_version = 1
+    await cache.respond(make_request(), session, "summary", params, closed_end, compute)
+    assert len(calls) == 2
+
+    for days in (4, 5):
+        end = datetime.utcnow() - timedelta(days=days)
+        await cache.respond(make_request(), session, "summary", {"end_date": end}, end, compute)
+    assert len(cache.entries) == 2
+
+
+@pytest.mark.asyncio
+async def test_closed_entries_expire_after_closed_ttl():
+    cache = ResultCache(closed_ttl=0, refresh_interval=60, close_after=timedelta(hours=2), enabled=True)
+    session = VersionSession()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {}
+
+    closed_end = datetime.utcnow() - timedelta(days=3)
+    for _ in range(2):
+        await cache.respond(make_request(), session, "summary", {}, closed_end, compute)
+    assert len(calls) == 2 and session.reads == 1
+
+
+@pytest.mark.asyncio
+async def test_open_ranges_follow_their_project_version():
+    cache = ResultCache(refresh_interval=0, enabled=True)
+    session = VersionSession()
+    session.projects = {1: 1, 2: 1}
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {"calls": len(calls)}
+
+    async def summary(project_id):
+        await cache.respond(make_request(), session, "summary", {"project_id": project_id}, None, compute)
+
+    for project_id in (1, 2, None):
+        await summary(project_id)
+    assert len(calls) == 3
+
+    # ingestion into project 2 leaves project 1 cached; the all-project answer moves with any project
+    session.projects[2] = 2
+    for project_id in (1, 2, None):
+        await summary(project_id)
+    assert len(calls) == 5
@@ -0,0 +1,37 @@
+"""
+Tests for the roaring bitmap.
+"""
+
+import random
+
+from roaring import RoaringBitmap, ARRAY_LIMIT
+
+def test_roaring_set_algebra_matches_sets():
+    rng = random.Random(3)
+    # a dense container, a sparse one and values far apart
+    left = set(range(0, 20000, 2)) | {rng.randrange(1 << 20) for _ in range(500)} | {(1 << 32) - 1}
+    right = set(range(0, 20000, 3)) | {rng.randrange(1 << 20) for _ in range(500)}
+    a, b = RoaringBitmap.from_values(left), RoaringBitmap.from_values(right)
+
+    assert isinstance(a.containers[0], int) and len(a.containers[0].to_bytes(8192, "little")) == 8192
+    assert len(a) == len(left)
+    assert set(a | b) == left | right
+    assert set(a & b) == left & right
+    assert set(a - b) == left - right
+    assert set(b - a) == right - left
+    assert len(a & b) == len(left & right)
+    assert (1 << 32) - 1 in a and 1 not in a
+
+
+def test_roaring_update_and_serialisation():
+    bitmap = RoaringBitmap.from_values(range(100))
+    bitmap.update(range(100, ARRAY_LIMIT + 10))
+    # crossing the array limit turns the container into a bitset
+    assert isinstance(bitmap.containers[0], int)
+    bitmap.update([70000, 70001])
+
+    restored = RoaringBitmap.from_bytes(bitmap.to_bytes())
+    assert restored == bitmap
+    assert list(restored)[-3:] == [ARRAY_LIMIT + 9, 70000, 70001]
+    # the sparse container is stored as 2 bytes per value
+    assert len(RoaringBitmap.from_values([1, 2, 3]).to_bytes()) == 4 + 7 + 6
@@ -0,0 +1,49 @@
+"""
+Tests for read/write routing across a primary and a read database.
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+from database import DatabaseOperation, RoutingSession, engine_options
+
+
+@pytest.mark.asyncio
+async def test_reads_go_to_read_engine_until_the_session_writes(tmp_path):
+    primary_url = f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}"
+    replica_url = f"sqlite+aiosqlite:///{tmp_path / 'replica.db'}"
+    primary = create_async_engine(primary_url, **engine_options(primary_url, 2, 1))
+    replica = create_async_engine(replica_url, **engine_options(replica_url, 2, 1))
+    assert primary.sync_engine.pool.size() == 2
+    for target in (primary, replica):
+        async with target.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    class TwoDatabaseSession(RoutingSession):
+        write_engine = primary.sync_engine
+        read_engine = replica.sync_engine
+
+    session_maker = sessionmaker(class_=AsyncSession, sync_session_class=TwoDatabaseSession,
+                                 expire_on_commit=False)
+    async with session_maker() as session:
+        db_ops = DatabaseOperation(session, segments=None)
+        await db_ops.create_events([{"event_name": "signup"}, {"event_name": "signup"}])
+        # read-your-writes: the writing session now reads the primary
+        assert await db_ops.get_event_count() == 2
+
+    async with session_maker() as session:
+        db_ops = DatabaseOperation(session, segments=None)
+        # a fresh session reads the replica, which has not seen the events
+        assert await db_ops.get_event_count() == 0
+        summary = await db_ops.get_summary()
+        assert summary["total_events"] == 0
+
+    await primary.dispose()
+    await replica.dispose()
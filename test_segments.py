@@ -0,0 +1,54 @@
+"""
+Tests for the columnar segment files.
+"""
+
+from datetime import datetime, timedelta
+
+from segments import Segment, SegmentStore, SegmentWriter, EventScan, segment_name
+
+def test_segment_round_trip_and_scan(tmp_path):
+    day = datetime(2024, 1, 1)
+    rows = [
+        (i + 1, 1 if i % 2 else None, "page_view" if i % 3 else "signup",
+         f"user{i % 4}" if i % 5 else None, f"session{i % 2}", day + timedelta(hours=i))
+        for i in range(10)
+    ]
+    path = str(tmp_path / "events_20240101.seg")
+    writer = SegmentWriter(path, day, watermark=10)
+    writer.extend(rows)
+    assert writer.finish() == 10
+
+    segment = Segment(path)
+    assert segment.watermark == 10
+    assert set(segment.projects) == {-1, 1}
+    # grouped by project, time-ordered inside each
+    ids = list(segment.column("id"))
+    assert ids == [1, 3, 5, 7, 9, 2, 4, 6, 8, 10]
+    names = segment.dictionary("event_name")
+    assert names[0] is None
+    assert [names[code] for code in segment.column("event_name")][:2] == ["signup", "page_view"]
+
+    scan = EventScan(users_by_event=True)
+    scan.add_segment(segment, start_date=day + timedelta(hours=2), end_date=day + timedelta(hours=7), project_id=1)
+    # project 1 rows at hours 3, 5, 7
+    assert scan.total == 3
+    assert scan.by_event == {"signup": 1, "page_view": 2}
+    assert scan.users == {"user3"}
+    assert scan.min_timestamp == day + timedelta(hours=3)
+    assert scan.max_timestamp == day + timedelta(hours=7)
+    assert scan.users_by_event["page_view"] == {"user3"}
+    assert scan.sessions == {"session1"}
+
+
+def test_store_expire_drops_every_day_before_the_cutoff(tmp_path):
+    first = datetime(2024, 1, 1)
+    for days in range(5):
+        day = first + timedelta(days=days)
+        writer = SegmentWriter(str(tmp_path / segment_name(day)), day, watermark=days + 1)
+        writer.extend([(days + 1, None, "page_view", None, None, day + timedelta(hours=1))])
+        writer.finish()
+
+    store = SegmentStore(str(tmp_path))
+    # the day holding the cutoff goes too, it may have lost its morning
+    assert store.expire(first + timedelta(days=3, hours=6)) == [first + timedelta(days=days) for days in range(4)]
+    assert list(store.segments) == [first + timedelta(days=4)]
@@ -0,0 +1,43 @@
+"""
+Tests for the incremental sessionizer.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from sessionizer import Sessionizer
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+def event(name, minutes, user_id="u1", session_id=None, project_id=1):
+    return {"event_name": name, "user_id": user_id, "session_id": session_id,
+            "project_id": project_id, "timestamp": T0 + timedelta(minutes=minutes)}
+
+
+def test_sessions_split_on_inactivity_gap():
+    sessionizer = Sessionizer(gap=timedelta(minutes=30))
+    sessionizer.record([event("landing", 0), event("click", 10), event("checkout", 35)])
+    # 40 minutes of silence starts a new session
+    sessionizer.record([event("landing", 75), event("landing", 0, user_id=None, session_id="sdk-1")])
+    # arrives late, but within the gap before the open session's first event
+    sessionizer.record([event("early", 70)])
+
+    assert len(sessionizer.closed) == 1
+    closed = sessionizer.closed[0]
+    assert (closed["entry_event"], closed["exit_event"], closed["event_count"]) == ("landing", "checkout", 3)
+    assert closed["duration_seconds"] == 35 * 60
+
+    assert sessionizer.expire(now=T0 + timedelta(minutes=80)) == 1
+    # the anonymous session, keyed by the SDK's session id
+    assert sessionizer.closed[-1]["client_session_id"] == "sdk-1"
+    assert sessionizer.closed[-1]["user_id"] is None
+    assert list(sessionizer.open.values())[0].entry_event == "early"
+
+
+def test_sessions_evicted_beyond_max_open():
+    sessionizer = Sessionizer(max_open=2)
+    sessionizer.record([event("a", 0, user_id="u1"), event("b", 1, user_id="u2"), event("c", 2, user_id="u3")])
+    assert [row["user_id"] for row in sessionizer.closed] == ["u1"]
+    assert len(sessionizer.open) == 2
@@ -0,0 +1,144 @@
+"""
+Tests for the on-disk ingestion spool: record framing, crash recovery and loading.
+"""
+
+import os
+import zlib
+
+import pytest
+import pytest_asyncio
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
+
+from sqlalchemy import func, select
+from sqlmodel import SQLModel
+
+from database import async_session_maker, engine
+from models import Event, SpoolOffset
+from spool import (
+    DEAD_LETTER_NAME, HEADER, SpoolConsumer, SpoolFullError, SpoolWriter, encode_record, list_segments,
+    read_records, segment_name,
+)
+
+
+@pytest_asyncio.fixture
+async def tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+    await engine.dispose()
+
+
+async def count_events() -> int:
+    async with async_session_maker() as session:
+        return (await session.execute(select(func.count(Event.id)))).scalar_one()
+
+
+def test_read_records_stops_at_torn_and_corrupt_frames(tmp_path):
+    path = tmp_path / "spool-000000000001.log"
+    frames = [encode_record({"event_name": f"e{i}", "timestamp": "2024-01-01T00:00:00"}) for i in range(3)]
+    path.write_bytes(b"".join(frames) + frames[0][:HEADER.size + 2])
+
+    records, offset, corrupt = read_records(str(path), 0, 10)
+    assert len(records) == 3 and not corrupt
+    assert offset == sum(len(frame) for frame in frames)
+    # a partly written record is just the end of data; the next read resumes from it
+    assert read_records(str(path), offset, 10) == ([], offset, False)
+    assert len(read_records(str(path), 0, 2)[0]) == 2
+
+    damaged = bytearray(path.read_bytes())
+    damaged[len(frames[0]) + HEADER.size] ^= 0xFF
+    path.write_bytes(bytes(damaged))
+    records, offset, corrupt = read_records(str(path), 0, 10)
+    assert len(records) == 1 and offset == len(frames[0]) and corrupt
+
+
+@pytest.mark.asyncio
+async def test_writer_rolls_segments_and_rejects_when_full(tmp_path):
+    writer = SpoolWriter(str(tmp_path), segment_bytes=200, fsync_interval=0, max_bytes=10_000)
+    await writer.start()
+    for i in range(10):
+        await writer.append({"event_name": f"event_{i}", "project_id": 1})
+    await writer.stop()
+
+    segments = list_segments(str(tmp_path))
+    assert len(segments) > 2
+    payloads = [record for _, path in segments for record in read_records(path, 0, 100)[0]]
+    assert len(payloads) == 10
+
+    # a restarted writer never appends to an old, possibly torn, segment
+    full = SpoolWriter(str(tmp_path), max_bytes=1)
+    await full.start()
+    assert full.sequence == segments[-1][0] + 1
+    with pytest.raises(SpoolFullError):
+        await full.append({"event_name": "rejected"})
+    await full.stop()
+
+
+@pytest.mark.asyncio
+async def test_full_spool_accepts_appends_again_once_drained(tmp_path, tables):
+    writer = SpoolWriter(str(tmp_path), segment_bytes=200, fsync_interval=0, max_bytes=600)
+    await writer.start()
+    with pytest.raises(SpoolFullError):
+        for i in range(20):
+            await writer.append({"event_name": f"event_{i}", "project_id": 1})
+
+    consumer = SpoolConsumer(0, 1, str(tmp_path), name="test", batch_size=100)
+    await consumer.run_once()
+    # the writer learns from the disk that consumers freed space, without rolling a segment
+    await writer.append({"event_name": "accepted"})
+    assert writer.spooled_bytes < writer.max_bytes
+    await writer.stop()
+
+
+@pytest.mark.asyncio
+async def test_poison_record_is_dead_lettered_without_blocking_other_segments(tmp_path, tables):
+    good = [encode_record({"event_name": f"event_{i}", "timestamp": "2024-01-01T00:00:00"}) for i in range(3)]
+    poison = b'{"event_name":"no_timestamp"}'
+    (tmp_path / segment_name(1)).write_bytes(
+        good[0] + HEADER.pack(len(poison), zlib.crc32(poison)) + poison + good[1]
+    )
+    (tmp_path / segment_name(2)).write_bytes(good[2])
+
+    consumer = SpoolConsumer(0, 1, str(tmp_path), name="test", batch_size=10, max_failures=2)
+    # the failing batch does not stop the next segment from loading
+    assert await consumer.run_once() == 1
+    assert await consumer.run_once() == 0
+    assert await count_events() == 1
+
+    # after max_failures the batch is bisected: good records load, the bad one is set aside
+    assert await consumer.run_once() == 2
+    assert await count_events() == 3
+    assert [path for _, path in list_segments(str(tmp_path))] == [str(tmp_path / segment_name(2))]
+    records, _, corrupt = read_records(str(tmp_path / DEAD_LETTER_NAME), 0, 10)
+    assert records == [poison] and not corrupt
+
+
+@pytest.mark.asyncio
+async def test_consumers_load_resume_and_delete_segments(tmp_path, tables):
+    writer = SpoolWriter(str(tmp_path), segment_bytes=400, fsync_interval=0)
+    await writer.start()
+    for i in range(12):
+        await writer.append({"event_name": f"event_{i}", "user_id": "u1", "project_id": 1,
+                             "ip_address": "10.0.0.1", "user_agent": "curl/8.0"})
+
+    first = SpoolConsumer(0, 2, str(tmp_path), name="test", batch_size=2)
+    second = SpoolConsumer(1, 2, str(tmp_path), name="test", batch_size=2)
+    assert await first.run_once() + await second.run_once() > 0
+    loaded = await count_events()
+
+    # a consumer started after a crash picks up from the committed offsets, not from zero
+    restarted = SpoolConsumer(0, 2, str(tmp_path), name="test", batch_size=2)
+    while await restarted.run_once() + await second.run_once():
+        pass
+    assert await count_events() == 12 > loaded
+
+    # only the segment still being written is left, and only it keeps an offset
+    await writer.stop()
+    segments = list_segments(str(tmp_path))
+    assert len(segments) == 1
+    async with async_session_maker() as session:
+        offsets = (await session.execute(select(SpoolOffset.segment))).scalars().all()
+    assert all(offset.endswith(os.path.basename(segments[0][1])) for offset in offsets)